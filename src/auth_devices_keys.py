@@ -43,11 +43,33 @@ self.device_pub_keys_provider = AuthDevicesKeysProvider(
     charm=self, devices_keys_file=self._devices_keys_file
 )
 ```
+
+A fleet of thousands of devices makes a relation payload of megabytes, which
+Juju sends again to every related unit on every change. The provider can
+then publish the keys in a compact encoding, optionally sharded across
+several keys of the relation data:
+```
+self.device_pub_keys_provider = AuthDevicesKeysProvider(charm=self, compact=True, shards=16)
+```
+Every shard holds the devices whose uid hashes to it, as JSON compressed
+with zlib and encoded in base64, under `auth_devices_keys_shard_<i>`. The
+`auth_devices_keys_manifest` key lists the SHA-256 of every shard and a
+digest of them all, along with the version of the encoding:
+```
+{"version": 1, "compression": "zlib", "shards": ["<sha256>", ...], "digest": "<sha256>"}
+```
+A change to a few devices only changes their shards. The consumer compares
+the manifest with the one it last read, and only decodes the shards that
+changed, keeping the others from its stored state. It reads either encoding,
+use `AuthDevicesKeysConsumer.auth_devices_keys` to get the list of devices.
 """
 
+import base64
+import hashlib
 import json
 import logging
-from typing import Any, Optional
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
 
 from ops.charm import (
     CharmBase,
@@ -76,12 +98,18 @@ LIBAPI = 0
 
 # Increment this PATCH version before using `charmcraft publish-lib` or reset
 # to 0 if you are raising the major API version
-LIBPATCH = 1
+LIBPATCH = 2
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_RELATION_NAME = "auth_devices_keys"
 
+# Relation data keys of the plain JSON and of the compact encoding
+DATA_KEY = "auth_devices_keys"
+MANIFEST_KEY = "auth_devices_keys_manifest"
+SHARD_KEY_PREFIX = "auth_devices_keys_shard_"
+ENCODING_VERSION = 1
+
 
 class RelationNotFoundError(Exception):
     """Raised if there is no relation with the given name."""
@@ -130,6 +158,67 @@ class RelationRoleMismatchError(Exception):
         super().__init__(self.message)
 
 
+class AuthDevicesKeysDecodeError(Exception):
+    """Raised if the compact encoding of the devices keys cannot be decoded."""
+
+
+def encode_auth_devices_keys(auth_devices_keys: List[dict], shards: int = 1) -> Dict[str, str]:
+    """Return the relation data of the devices keys in the compact encoding.
+
+    Args:
+        auth_devices_keys: the devices and their keys, with their `uid`.
+        shards: number of relation data keys to spread the devices across.
+    """
+    buckets: List[List[dict]] = [[] for _ in range(shards)]
+    for entry in sorted(auth_devices_keys, key=lambda entry: entry["uid"]):
+        buckets[zlib.crc32(entry["uid"].encode()) % shards].append(entry)
+
+    data = {}
+    digests = []
+    for i, bucket in enumerate(buckets):
+        payload = json.dumps(bucket, separators=(",", ":"), sort_keys=True).encode()
+        value = base64.b64encode(zlib.compress(payload, 9)).decode()
+        data[f"{SHARD_KEY_PREFIX}{i}"] = value
+        digests.append(hashlib.sha256(value.encode()).hexdigest())
+    manifest = {
+        "version": ENCODING_VERSION,
+        "compression": "zlib",
+        "shards": digests,
+        "digest": hashlib.sha256("".join(digests).encode()).hexdigest(),
+    }
+    data[MANIFEST_KEY] = json.dumps(manifest, sort_keys=True)
+    return data
+
+
+def _read_manifest(value: str) -> dict:
+    """Return the manifest of the compact encoding, checking its version."""
+    try:
+        manifest = json.loads(value)
+    except ValueError as e:
+        raise AuthDevicesKeysDecodeError(f"Invalid manifest: {e}")
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("shards"), list):
+        raise AuthDevicesKeysDecodeError("Invalid manifest: not an object with shards")
+    if manifest.get("version") != ENCODING_VERSION or manifest.get("compression") != "zlib":
+        raise AuthDevicesKeysDecodeError(
+            f"Unsupported encoding version {manifest.get('version')}, "
+            f"compression {manifest.get('compression')}"
+        )
+    return manifest
+
+
+def _decode_shard(value: str, digest: str) -> List[dict]:
+    """Return the devices of a shard, checking it against its digest in the manifest."""
+    if hashlib.sha256(value.encode()).hexdigest() != digest:
+        raise AuthDevicesKeysDecodeError("A shard does not match the manifest")
+    try:
+        entries = json.loads(zlib.decompress(base64.b64decode(value)))
+    except (ValueError, zlib.error) as e:
+        raise AuthDevicesKeysDecodeError(f"Invalid shard: {e}")
+    if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+        raise AuthDevicesKeysDecodeError("Invalid shard: not a list of devices")
+    return entries
+
+
 def _type_convert_stored(obj):
     """Convert Stored* to their appropriate types, recursively."""
     if isinstance(obj, StoredList):
@@ -165,7 +254,9 @@ class AuthDevicesKeysConsumer(Object):
         self._charm = charm
         self._relation_name = relation_name
 
-        self._stored.set_default(auth_devices_keys=[])  # type: ignore
+        self._stored.set_default(auth_devices_keys=[], manifest_digest="", shards={})  # type: ignore
+        self._parsed: Tuple[str, List[dict]] = ("", [])
+        self._decoded: Tuple[str, str, Dict[str, dict]] = ("", "", {})
         self.framework.observe(
             self._charm.on[relation_name].relation_changed,
             self._on_relation_changed,
@@ -189,25 +280,80 @@ class AuthDevicesKeysConsumer(Object):
             return
 
         try:
-            databag = event.relation.data[event.relation.app].get("auth_devices_keys", "")
+            changed = self._update(event.relation.data[event.relation.app])
         except ModelError as e:
             logger.debug(
                 f"Error {e} attempting to read remote app data; "
                 f"probably we are in a relation_departed hook"
             )
             return
-
-        if not databag:
+        except AuthDevicesKeysDecodeError as e:
+            logger.error(f"Cannot decode the devices keys, keeping the previous ones: {e}")
             return
 
-        coerced_data = (
+        if changed:
+            self.on.auth_devices_keys_changed.emit()
+
+    def _update(self, databag: RelationDataContent) -> bool:
+        """Store the devices keys of the relation data, return whether they changed."""
+        decoded = self._decode(databag)
+        if not decoded:
+            return False
+        data, manifest_digest, shards = decoded
+        stored_data = (
             _type_convert_stored(self._stored.auth_devices_keys)
             if self._stored.auth_devices_keys
             else []
         )
-        if coerced_data != databag:
-            self._stored.auth_devices_keys = databag
-            self.on.auth_devices_keys_changed.emit()
+        if stored_data == data and self._stored.manifest_digest == manifest_digest:
+            return False
+        self._stored.auth_devices_keys = data
+        self._stored.manifest_digest = manifest_digest
+        self._stored.shards = shards
+        return True
+
+    def _stored_shards(self) -> Dict[str, dict]:
+        """Return the shards of the last update."""
+        shards = _type_convert_stored(self._stored.shards)
+        return shards if isinstance(shards, dict) else {}
+
+    def _decode(self, databag: RelationDataContent) -> Optional[Tuple[str, str, Dict[str, dict]]]:
+        """Decode the devices keys of the relation data without storing them.
+
+        Only the shards of the compact encoding that changed since the last
+        update, or the last decoding, are decoded.
+
+        Returns:
+            The JSON list of the devices, the manifest digest and the shards,
+            or None if the relation data holds no keys.
+        """
+        manifest_data = databag.get(MANIFEST_KEY)
+        if not manifest_data:
+            data = databag.get(DATA_KEY, "")
+            return (data, "", {}) if data else None
+
+        manifest = _read_manifest(manifest_data)
+        if manifest["digest"] == self._stored.manifest_digest:
+            return (
+                str(self._stored.auth_devices_keys),
+                str(self._stored.manifest_digest),
+                self._stored_shards(),
+            )
+        if manifest["digest"] == self._decoded[1]:
+            return self._decoded
+        known_shards = {**self._stored_shards(), **self._decoded[2]}
+        shards = {}
+        for i, digest in enumerate(manifest["shards"]):
+            key = f"{SHARD_KEY_PREFIX}{i}"
+            shard = known_shards.get(key)
+            if not shard or shard["digest"] != digest:
+                entries = _decode_shard(databag.get(key, ""), digest)
+                shard = {"digest": digest, "entries": json.dumps(entries)}
+            shards[key] = shard
+        # Join the JSON lists of the shards without parsing them again
+        items = [shard["entries"][1:-1] for shard in shards.values()]
+        self._decoded = ("[" + ",".join(filter(None, items)) + "]", manifest["digest"], shards)
+        return self._decoded
 
     def _on_relation_broken(self, event: RelationBrokenEvent) -> None:
         """Update job config when providers depart.
@@ -220,6 +366,30 @@ class AuthDevicesKeysConsumer(Object):
 
         pass
 
+    @property
+    def auth_devices_keys(self) -> List[dict]:
+        """Return the devices and their keys, from either encoding of the relation data.
+
+        The last keys decoded are kept if the relation data cannot be decoded.
+        """
+        relation = self.model.get_relation(self._relation_name)
+        if not relation:
+            return []
+        try:
+            decoded = self._decode(relation.data[relation.app])
+        except AuthDevicesKeysDecodeError as e:
+            logger.error(f"Cannot decode the devices keys, keeping the previous ones: {e}")
+            decoded = None
+
+        # Reading the keys does not store them, so that the next relation
+        # changed event still reports the change.
+        data = decoded[0] if decoded else self._stored.auth_devices_keys
+        if not data:
+            return []
+        if self._parsed[0] != data:
+            self._parsed = (data, json.loads(data))
+        return self._parsed[1]
+
     @property
     def relation_data(self) -> Optional[RelationDataContent]:
         """Retrieve the relation data.
@@ -244,12 +414,24 @@ class AuthDevicesKeysProvider(Object):
         self,
         charm: CharmBase,
         relation_name: str = DEFAULT_RELATION_NAME,
+        compact: bool = False,
+        shards: int = 1,
     ) -> None:
-        """A class implementing the auth_devices_keys provides relation."""
+        """A class implementing the auth_devices_keys provides relation.
+
+        Args:
+            charm: the charm providing the devices keys.
+            relation_name: name of the relation.
+            compact: whether to publish the keys in the compact encoding, which
+                consumers older than LIBPATCH 2 cannot read.
+            shards: number of relation data keys of the compact encoding.
+        """
         super().__init__(charm, relation_name)
 
         self._charm = charm
         self._relation_name = relation_name
+        self._compact = compact
+        self._shards = shards
 
         self._stored.set_default(auth_devices_keys=[])  # type: ignore
 
@@ -298,11 +480,27 @@ class AuthDevicesKeysProvider(Object):
 
     def _update_auth_devices_keys_on_relation(self, relation: Relation) -> None:
         """Update the available devices public keys in the relation data bucket."""
-        logger.debug(self._stored.auth_devices_keys)
-        stored_data = _type_convert_stored(self._stored.auth_devices_keys)
+        stored = _type_convert_stored(self._stored.auth_devices_keys)
+        stored_data = [entry for entry in stored if isinstance(entry, dict)] if stored else []
+        logger.debug(f"Sharing the keys of {len(stored_data)} devices")
+
+        databag = relation.data[self._charm.app]
+        if not self._compact:
+            for key in [
+                key for key in databag if key.startswith((MANIFEST_KEY, SHARD_KEY_PREFIX))
+            ]:
+                del databag[key]
+            databag[DATA_KEY] = json.dumps(stored_data)
+            return
 
-        logger.debug(type(stored_data))
-        relation.data[self._charm.app]["auth_devices_keys"] = json.dumps(stored_data)
+        encoded = encode_auth_devices_keys(stored_data, self._shards)
+        # Shards left from a larger number of them, and the plain JSON
+        for key in [key for key in databag if key.startswith(DATA_KEY) and key not in encoded]:
+            del databag[key]
+        # Unchanged shards are not written again
+        for key, value in encoded.items():
+            if databag.get(key) != value:
+                databag[key] = value
 
     def _on_relation_changed(self, event: RelationChangedEvent) -> None:
         """Handle relation changes in related providers.
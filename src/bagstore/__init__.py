@@ -0,0 +1,19 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Workload-side helpers for the ROS 2 bag fileserver.
+
+The charm pushes this package into the workload container and runs its
+commands as Pebble services, see `python3 -m bagstore --help`. Everything
+in here must only depend on the Python standard library, since the workload
+image does not ship any third-party Python packages.
+"""
+
+STORAGE_ROOT = "/var/lib/caddy-fileserver"
+
+# Directory, relative to the storage root, holding the persistent state of
+# the workload helpers. It is hidden from the HTTP listing.
+STATE_DIR = ".bagstore"
+
+# Namespace of the SSH signatures devices authenticate HTTP uploads with
+SIGNATURE_NAMESPACE = "ros2bag-upload"
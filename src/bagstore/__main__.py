@@ -0,0 +1,334 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Command line entry point of the workload helpers, run by Pebble."""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import List
+
+from bagstore import STORAGE_ROOT
+from bagstore.admission import Admission, run_ssh_command
+from bagstore.catchup import CatchUp, progress_metrics, read_progress
+from bagstore.index import BagIndex
+from bagstore.layout import (
+    PartitionedLayout,
+    RedirectServer,
+    UploadWatch,
+    record_upload,
+    reload_caddy,
+)
+from bagstore.mcap import can_compress_chunks
+from bagstore.metrics import MetricsServer
+from bagstore.pipeline import Pipeline, Stage, remove_stale_etags
+from bagstore.preview_bags import PreviewBagStage
+from bagstore.previews import PreviewStage
+from bagstore.recompress import Recompressor
+from bagstore.scheduler import ResourceScheduler, Throttle, decision_metrics, read_decision
+from bagstore.timeindex import ChunkQueryServer, TimeIndexStage, parse_time
+from bagstore.upload import DeviceAuthenticator, UploadServer, UploadStore
+from bagstore.verify import VerifyStage
+
+logger = logging.getLogger("bagstore")
+
+
+def _partition(args: argparse.Namespace) -> None:
+    admission = Admission(args.root, args.limits) if args.limits else None
+    index = BagIndex(args.root)
+    layout = PartitionedLayout(
+        args.root,
+        args.snippet,
+        redirect_address=args.listen,
+        settle_seconds=args.settle,
+        admission=admission,
+        index=index,
+        uploads=UploadWatch(args.root, index),
+    )
+    host, _, port = args.listen.rpartition(":")
+    server = RedirectServer((host, int(port)), layout)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("Serving the redirects of the moved bags on %s", args.listen)
+    if layout.write_snippet():
+        reload_caddy(args.caddyfile)
+
+    walked = 0.0
+    while True:
+        # Walk the storage from time to time, should an upload have been missed
+        full = time.monotonic() - walked >= args.rescan
+        if full:
+            walked = time.monotonic()
+        layout.run_once(full)
+        if not args.interval:
+            return
+        time.sleep(args.interval)
+
+
+def _process(args: argparse.Namespace) -> None:
+    index = BagIndex(args.root)
+    stages: List[Stage] = []
+    if args.verify:
+        stages.append(VerifyStage(args.root))
+    if args.previews:
+        stages.append(PreviewStage(args.root, index))
+    if args.preview_bags:
+        stages.append(PreviewBagStage(args.preview_rate))
+    if args.time_index:
+        stages.append(TimeIndexStage(index))
+    pipeline = Pipeline(
+        args.root,
+        index,
+        stages,
+        workers=args.workers,
+        settle_seconds=args.settle,
+        admission=Admission(args.root, args.limits) if args.limits else None,
+        throttle=Throttle(args.root),
+        recompression=args.recompression,
+        uploads=UploadWatch(args.root, index),
+    )
+    restored = pipeline.restore_etags()
+    if restored:
+        logger.info("Wrote the ETags of %d processed files", restored)
+
+    walked = 0.0
+    while True:
+        full = time.monotonic() - walked >= args.rescan
+        if full:
+            walked = time.monotonic()
+        pipeline.run_once(full)
+        if not args.interval:
+            return
+        time.sleep(args.interval)
+
+
+def _recompress(args: argparse.Namespace) -> None:
+    if args.nice:
+        os.nice(args.nice)
+    recompressor = Recompressor(
+        args.root,
+        BagIndex(args.root),
+        chunk_size=args.chunk_mib << 20,
+        level=args.level,
+        cpu_budget=args.cpu_budget,
+        admission=Admission(args.root, args.limits) if args.limits else None,
+    )
+
+    while True:
+        recompressor.run_once()
+        # Without zstd, the files left to recompress were kept as they are once and for all
+        if not args.interval or not can_compress_chunks():
+            return
+        time.sleep(args.interval)
+
+
+def _upload(args: argparse.Namespace) -> None:
+    host, _, port = args.listen.rpartition(":")
+    server = UploadServer(
+        (host, int(port)),
+        UploadStore(
+            args.root,
+            fsync_bytes=args.fsync_mib << 20,
+            preallocate=args.preallocate,
+            index=BagIndex(args.root),
+        ),
+        DeviceAuthenticator(args.allowed_signers, max_age=args.max_age),
+        admission=Admission(args.root, args.limits) if args.limits else None,
+    )
+    logger.info("Serving resumable uploads on %s", args.listen)
+    server.serve_forever()
+
+
+def _serve_index(args: argparse.Namespace) -> None:
+    host, _, port = args.listen.rpartition(":")
+    server = ChunkQueryServer(
+        (host, int(port)),
+        BagIndex(args.root),
+        metrics=lambda: (
+            progress_metrics(read_progress(args.root)) + decision_metrics(read_decision(args.root))
+        ),
+    )
+    logger.info("Serving time index lookups on %s", args.listen)
+    server.serve_forever()
+
+
+def _serve_metrics(args: argparse.Namespace) -> None:
+    host, _, port = args.listen.rpartition(":")
+    server = MetricsServer((host, int(port)), Admission(args.root, args.limits))
+    logger.info("Serving the metrics on %s", args.listen)
+    server.serve_forever()
+
+
+def _catch_up(args: argparse.Namespace) -> None:
+    catch_up = CatchUp(
+        args.root,
+        BagIndex(args.root),
+        processes=args.processes,
+        batch_size=args.batch,
+        settle_seconds=args.settle,
+        throttle=Throttle(args.root),
+    )
+    indexed = catch_up.run()
+    logger.info("Indexed a backlog of %d bags", indexed)
+
+
+def _schedule(args: argparse.Namespace) -> None:
+    scheduler = ResourceScheduler(
+        args.root, probe_url=args.probe_url, upload_metrics_url=args.upload_metrics
+    )
+    logger.info("Scheduling the background workers every %.0f s", args.interval)
+    while True:
+        scheduler.update()
+        time.sleep(args.interval)
+
+
+def _inspect(args: argparse.Namespace) -> None:
+    index = BagIndex(args.root)
+    if args.query == "store-stats":
+        json.dump(index.stats(args.uid), sys.stdout)
+        return
+
+    since = parse_time(args.since) if args.since else None
+    until = parse_time(args.until) if args.until else None
+    if args.query == "find-bags":
+        if not args.topic:
+            sys.exit("find-bags needs a --topic")
+        rows = index.find_bags(args.topic, args.uid, since, until, args.cursor, args.limit)
+    else:
+        rows = index.list_bags(args.uid, since, until, args.cursor, args.limit)
+    bags = [dict(row) for row in rows]
+    # The last bag of a full page is where the next page starts
+    cursor = bags[-1]["bag"] if len(bags) == args.limit else None
+    json.dump({"bags": bags, "next-cursor": cursor}, sys.stdout)
+
+
+def _ssh_gate(args: argparse.Namespace) -> None:
+    admission = Admission(args.root, args.limits)
+    command = os.environ.get("SSH_ORIGINAL_COMMAND")
+
+    def uploaded(path: str) -> None:
+        # rsync may have replaced processed files, which are not final anymore
+        remove_stale_etags(path)
+        record_upload(args.root, BagIndex(args.root), path)
+
+    sys.exit(
+        run_ssh_command(
+            admission, args.uid, command, preallocate=args.preallocate, uploaded=uploaded
+        )
+    )
+
+
+def main() -> None:
+    """Parse the command line and run the requested helper."""
+    parser = argparse.ArgumentParser(prog="bagstore")
+    parser.add_argument("--root", default=STORAGE_ROOT, help="storage root served over HTTP")
+    parser.add_argument("--log-level", default="info")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    partition = subparsers.add_parser(
+        "partition", help="move completed bags to /<uid>/<YYYY>/<MM>/<DD>/"
+    )
+    partition.add_argument("--snippet", required=True, help="Caddyfile snippet of redirects")
+    partition.add_argument("--caddyfile", required=True, help="Caddyfile to reload")
+    partition.add_argument("--listen", default="127.0.0.1:8083", help="address of the redirects")
+    partition.add_argument("--settle", type=float, default=60.0, help="seconds of quiet")
+    partition.add_argument("--interval", type=float, default=0, help="0 runs only once")
+    partition.add_argument(
+        "--rescan", type=float, default=3600, help="seconds between walks of the storage"
+    )
+    partition.add_argument("--limits", help="admission limits, to yield to priority uploads")
+    partition.set_defaults(func=_partition)
+
+    process = subparsers.add_parser("process", help="run completed bags through the pipeline")
+    process.add_argument("--verify", action="store_true", help="quarantine corrupt bags")
+    process.add_argument("--previews", action="store_true", help="render the bag previews")
+    process.add_argument(
+        "--preview-bags", action="store_true", help="write downsampled previews of the bags"
+    )
+    process.add_argument("--preview-rate", type=float, default=2.0, help="Hz of every topic")
+    process.add_argument("--time-index", action="store_true", help="index the MCAP chunks by time")
+    process.add_argument("--workers", type=int, default=2, help="bags processed in parallel")
+    process.add_argument("--settle", type=float, default=60.0, help="seconds of quiet")
+    process.add_argument("--interval", type=float, default=0, help="0 runs only once")
+    process.add_argument(
+        "--rescan", type=float, default=3600, help="seconds between walks of the storage"
+    )
+    process.add_argument("--limits", help="admission limits, to yield to priority uploads")
+    process.add_argument(
+        "--recompression", action="store_true", help="leave the MCAP ETags to the recompression"
+    )
+    process.set_defaults(func=_process)
+
+    recompress = subparsers.add_parser(
+        "recompress", help="rewrite the MCAP files to zstd, in large chunks"
+    )
+    recompress.add_argument("--chunk-mib", type=int, default=4, help="MiB of the new chunks")
+    recompress.add_argument("--level", type=int, default=9, help="zstd compression level")
+    recompress.add_argument("--cpu-budget", type=float, default=0.5, help="CPUs, 0 for all")
+    recompress.add_argument("--nice", type=int, default=10, help="niceness increment")
+    recompress.add_argument("--interval", type=float, default=0, help="0 runs only once")
+    recompress.add_argument("--limits", help="admission limits, to yield to priority uploads")
+    recompress.set_defaults(func=_recompress)
+
+    upload = subparsers.add_parser("upload", help="serve resumable uploads (tus protocol)")
+    upload.add_argument("--listen", default="127.0.0.1:8081", help="address to listen on")
+    upload.add_argument("--allowed-signers", required=True, help="ssh-keygen allowed signers")
+    upload.add_argument("--max-age", type=float, default=300, help="signature lifetime")
+    upload.add_argument("--fsync-mib", type=int, default=64, help="MiB written between fsyncs")
+    upload.add_argument("--limits", help="admission limits of the uploads")
+    upload.add_argument("--preallocate", action="store_true", help="reserve whole files")
+    upload.set_defaults(func=_upload)
+
+    serve_index = subparsers.add_parser("serve-index", help="serve time index lookups")
+    serve_index.add_argument("--listen", default="127.0.0.1:8082", help="address to listen on")
+    serve_index.set_defaults(func=_serve_index)
+
+    serve_metrics = subparsers.add_parser("serve-metrics", help="serve the upload metrics")
+    serve_metrics.add_argument("--listen", default="127.0.0.1:8084", help="address to listen on")
+    serve_metrics.add_argument("--limits", help="admission limits of the uploads")
+    serve_metrics.set_defaults(func=_serve_metrics)
+
+    catch_up = subparsers.add_parser(
+        "catch-up", help="index the chunks of the bags missing from the time index"
+    )
+    catch_up.add_argument("--processes", type=int, help="default from the cgroup CPU limit")
+    catch_up.add_argument("--batch", type=int, default=100, help="bags per transaction")
+    catch_up.add_argument("--settle", type=float, default=60.0, help="seconds of quiet")
+    catch_up.set_defaults(func=_catch_up)
+
+    schedule = subparsers.add_parser(
+        "schedule", help="throttle the background workers when the container is under pressure"
+    )
+    schedule.add_argument("--probe-url", help="URL of Caddy whose latency is watched")
+    schedule.add_argument("--upload-metrics", help="metrics URL of the upload server")
+    schedule.add_argument("--interval", type=float, default=5.0, help="seconds between samples")
+    schedule.set_defaults(func=_schedule)
+
+    inspect = subparsers.add_parser("inspect", help="query the bag index, as JSON")
+    inspect.add_argument("query", choices=["list-bags", "find-bags", "store-stats"])
+    inspect.add_argument("--uid", help="only the bags of the device")
+    inspect.add_argument("--topic", help="topic of the bags to find, prefix if ending with *")
+    inspect.add_argument("--since", help="nanoseconds since the epoch, or ISO 8601 date")
+    inspect.add_argument("--until", help="nanoseconds since the epoch, or ISO 8601 date")
+    inspect.add_argument("--cursor", help="next-cursor of the previous page")
+    inspect.add_argument("--limit", type=int, default=100, help="bags per page")
+    inspect.set_defaults(func=_inspect)
+
+    ssh_gate = subparsers.add_parser("ssh-gate", help="admit the rsync uploads of a device")
+    ssh_gate.add_argument("--uid", required=True, help="device the SSH key belongs to")
+    ssh_gate.add_argument("--limits", required=True, help="admission limits of the uploads")
+    ssh_gate.add_argument("--preallocate", action="store_true", help="reserve whole files")
+    ssh_gate.set_defaults(func=_ssh_gate)
+
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=args.log_level.upper(), format="%(asctime)s %(name)s %(levelname)s %(message)s"
+    )
+    args.func(args)
+
+
+if __name__ == "__main__":  # pragma: nocover
+    main()
@@ -0,0 +1,457 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Admission control and bandwidth shaping of uploads.
+
+When a whole fleet comes back and uploads at once, sshd and the disk thrash
+and every upload slows down. Uploads are therefore admitted through a limited
+number of slots, globally and per device, and wait in a queue for a slot to be
+free.
+
+Slots are `flock`-ed files under `<root>/.bagstore/admission/`, so that rsync
+over SSH, where every upload is its own process, and the threads of the HTTP
+upload server share the same limits. A lock is released by the kernel when its
+holder dies, so a killed upload never leaks its slot.
+
+The limits are read from a JSON file written by the charm::
+
+    {
+        "max_concurrent": 16,
+        "max_per_device": 2,
+        "rate_limit": 10240,
+        "rate_limits": {"<uid>": 2048},
+        "priorities": {"<uid>": "high"},
+        "high_water": 95
+    }
+
+where a limit of 0 means unlimited and rates are in KiB/s, per device. All
+the uploads of a device, the streams of its HTTP uploads and its rsync
+processes alike, share a token bucket kept in a `flock`-ed file next to the
+slots. Every rsync pipes its input through it.
+
+Uploads have a priority class, "high", "normal" or "low". Bags recorded
+around an incident, under an `incident/` directory or from a device with a
+"high" priority, wait ahead of the others and are not rate limited. Background
+jobs check `Admission.preempted()` to yield the disk to them.
+
+New upload sessions are refused while the storage is used above the
+`high_water` percentage, or would be once the announced upload is written,
+rather than failing once the volume is full, halfway through a transfer.
+Uploads in progress go on.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import random
+import re
+import secrets
+import shlex
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from bagstore import STATE_DIR
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_DIR = "admission"
+PRIORITIES = ["high", "normal", "low"]
+INCIDENT_DIR = "incident"
+_POLL_SECONDS = 0.5
+
+
+class AdmissionTimeout(Exception):
+    """No upload slot became free in time."""
+
+
+class StorageFull(Exception):
+    """The storage is used above its high-water mark."""
+
+
+def storage_usage(path: str) -> Tuple[int, int]:
+    """Return the used and total bytes of the filesystem of `path`."""
+    stat = os.statvfs(path)
+    size = stat.f_blocks * stat.f_frsize
+    # What is reserved to root is not available to the uploads either
+    return size - stat.f_bavail * stat.f_frsize, size
+
+
+class TokenBucket:
+    """Thread-safe token bucket limiting a rate in bytes per second."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def throttle(self, size: int) -> None:
+        """Wait until `size` bytes can be sent."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Borrow the missing tokens, so that concurrent streams queue up
+            self._tokens -= size
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class SharedTokenBucket(TokenBucket):
+    """Token bucket whose state is in a file, shared by every process using it."""
+
+    _STATE = struct.Struct("<dd")
+
+    def __init__(self, path: str, rate: float, burst: Optional[float] = None):
+        super().__init__(rate, burst)
+        self.path = path
+
+    def throttle(self, size: int) -> None:
+        """Wait until `size` bytes can be sent."""
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                now = time.time()
+                state = os.pread(fd, self._STATE.size, 0)
+                tokens, updated = (
+                    self._STATE.unpack(state) if len(state) == self._STATE.size else (0.0, 0.0)
+                )
+                # Full after a long idle time, or should the clock go back
+                elapsed = now - updated if now >= updated else self.burst / self.rate
+                tokens = min(self.burst, tokens + elapsed * self.rate) - size
+                os.pwrite(fd, self._STATE.pack(tokens, now), 0)
+            finally:
+                # Releases the lock
+                os.close(fd)
+        if tokens < 0:
+            time.sleep(-tokens / self.rate)
+
+
+def load_limits(path: Optional[str]) -> dict:
+    """Return the admission limits, without any if the file does not exist."""
+    limits = {
+        "max_concurrent": 0,
+        "max_per_device": 0,
+        "rate_limit": 0,
+        "rate_limits": {},
+        "priorities": {},
+        "high_water": 0,
+    }
+    if path:
+        try:
+            with open(path) as f:
+                limits.update(json.load(f))
+        except FileNotFoundError:
+            pass
+    return limits
+
+
+def upload_priority(limits: dict, uid: str, path: str) -> str:
+    """Return the priority class of an upload of a device, to `path` in its directory."""
+    if INCIDENT_DIR in path.lower().split("/"):
+        return "high"
+    priority = limits["priorities"].get(uid, "normal")
+    return priority if priority in PRIORITIES else "normal"
+
+
+def device_rate(limits: dict, uid: str, priority: str = "normal") -> int:
+    """Return the upload rate limit of a device in bytes/s, 0 if unlimited."""
+    if priority == "high":
+        return 0
+    return int(limits["rate_limits"].get(uid, limits["rate_limit"])) << 10
+
+
+class Admission:
+    """Admit uploads through the slots shared by all the upload processes."""
+
+    def __init__(self, root: str, config_path: Optional[str] = None):
+        self.root = root
+        self.directory = os.path.join(root, STATE_DIR, ADMISSION_DIR)
+        self.config_path = config_path
+        for state in ("waiting", "active"):
+            os.makedirs(os.path.join(self.directory, state), exist_ok=True)
+        self._limits = load_limits(None)
+        self._limits_mtime: Optional[float] = None
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def limits(self) -> dict:
+        """Return the limits, reloaded whenever the charm updates them."""
+        try:
+            mtime = os.stat(self.config_path).st_mtime if self.config_path else None
+        except FileNotFoundError:
+            mtime = None
+        with self._lock:
+            if mtime != self._limits_mtime:
+                self._limits = load_limits(self.config_path)
+                self._limits_mtime = mtime
+                self._buckets.clear()
+            return self._limits
+
+    def check_storage(self, length: int = 0) -> None:
+        """Refuse a new upload of `length` bytes if the storage would be above its high-water mark.
+
+        Raises:
+            StorageFull: if the upload must be refused.
+        """
+        high_water = self.limits["high_water"]
+        if not high_water:
+            return
+        used, size = storage_usage(self.root)
+        if size and (used + length) * 100 >= high_water * size:
+            raise StorageFull(
+                f"Storage {used * 100 // size}% full, new uploads are refused above {high_water}%"
+            )
+
+    def bucket(self, uid: str, priority: str = "normal") -> Optional[TokenBucket]:
+        """Return the token bucket shared by the uploads of a device, if it is rate limited."""
+        rate = device_rate(self.limits, uid, priority)
+        if not rate:
+            return None
+        with self._lock:
+            if uid not in self._buckets:
+                path = os.path.join(self.directory, f"rate-{uid}.bucket")
+                self._buckets[uid] = SharedTokenBucket(path, rate)
+            return self._buckets[uid]
+
+    @contextmanager
+    def admit(
+        self, uid: str, timeout: Optional[float] = None, priority: str = "normal"
+    ) -> Iterator[List[int]]:
+        """Wait for an upload slot of the device, and hold it.
+
+        An upload only takes a slot once no upload of a higher priority waits.
+
+        Yields:
+            the file descriptors of the held locks, to keep them across an exec.
+
+        Raises:
+            AdmissionTimeout: if no slot was free within `timeout` seconds.
+        """
+        limits = self.limits
+        slots = self._slots(uid, limits)
+        fds: Optional[List[int]] = []
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if slots:
+            with self._marker("waiting", priority):
+                while self._outranked(priority) or (fds := self._try_acquire(slots)) is None:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise AdmissionTimeout(f"No upload slot for '{uid}'")
+                    time.sleep(_POLL_SECONDS * random.uniform(0.5, 1.5))
+        try:
+            with self._marker("active", priority):
+                yield fds  # pyright: ignore
+        finally:
+            for fd in fds or []:
+                os.close(fd)
+
+    def _outranked(self, priority: str) -> bool:
+        """Whether an upload of a higher priority is waiting."""
+        higher = PRIORITIES[: PRIORITIES.index(priority)]
+        return any(self.count("waiting", p) for p in higher)
+
+    def preempted(self) -> bool:
+        """Whether background jobs should yield the disk to high priority uploads."""
+        return bool(self.count("waiting", "high") or self.count("active", "high"))
+
+    def _slots(self, uid: str, limits: dict) -> List[List[str]]:
+        """Return the groups of slot files an upload needs one of each of."""
+        groups = []
+        if limits["max_per_device"]:
+            groups.append([f"device-{uid}-{i}.lock" for i in range(int(limits["max_per_device"]))])
+        if limits["max_concurrent"]:
+            groups.append([f"slot-{i}.lock" for i in range(int(limits["max_concurrent"]))])
+        return groups
+
+    def _try_acquire(self, groups: List[List[str]]) -> Optional[List[int]]:
+        fds = []
+        for group in groups:
+            fd = self._lock_any(group)
+            if fd is None:
+                for held in fds:
+                    os.close(held)
+                return None
+            fds.append(fd)
+        return fds
+
+    def _lock_any(self, names: List[str]) -> Optional[int]:
+        for name in random.sample(names, len(names)):
+            fd = os.open(os.path.join(self.directory, name), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    @contextmanager
+    def _marker(self, state: str, priority: str) -> Iterator[None]:
+        name = f"{os.getpid()}-{priority}-{secrets.token_hex(8)}"
+        path = os.path.join(self.directory, state, name)
+        open(path, "w").close()
+        try:
+            yield
+        finally:
+            os.remove(path)
+
+    def count(self, state: str, priority: Optional[str] = None) -> int:
+        """Return the number of uploads waiting or active, dropping those of dead processes."""
+        directory = os.path.join(self.directory, state)
+        count = 0
+        for name in os.listdir(directory):
+            if priority is not None and name.split("-")[1:2] != [priority]:
+                continue
+            try:
+                os.kill(int(name.partition("-")[0]), 0)
+            except ProcessLookupError:
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+                continue
+            except (ValueError, PermissionError):
+                pass
+            count += 1
+        return count
+
+    def metrics(self) -> str:
+        """Return the admission metrics in the Prometheus text format."""
+        lines = []
+        for state, metric, description in [
+            ("waiting", "bagstore_upload_queue_depth", "Uploads waiting for a slot."),
+            ("active", "bagstore_upload_active", "Uploads holding a slot."),
+        ]:
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} gauge")
+            for priority in PRIORITIES:
+                lines.append(f'{metric}{{priority="{priority}"}} {self.count(state, priority)}')
+        used, size = storage_usage(self.root)
+        for metric, value, description in [
+            ("bagstore_storage_used_bytes", used, "Bytes used on the storage."),
+            ("bagstore_storage_size_bytes", size, "Size of the storage."),
+            (
+                "bagstore_storage_high_water_ratio",
+                self.limits["high_water"] / 100,
+                "Usage above which new uploads are refused, 0 if never.",
+            ),
+        ]:
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def rsync_destination(argv: List[str]) -> str:
+    """Return the destination of an `rsync --server` command, its last argument."""
+    return argv[-1] if len(argv) > 2 else ""
+
+
+# Lines of the rsync log file are prefixed with their time and the rsync pid
+_RSYNC_LOG_RE = re.compile(r"^\d{4}/\d\d/\d\d \d\d:\d\d:\d\d \[\d+\] (.+)$")
+
+
+def rsync_written_dirs(destination: str, log: str) -> List[str]:
+    """Return the directories an rsync server wrote files to, from its log.
+
+    Args:
+        destination: destination of the rsync server.
+        log: content of its log file, with the `%n` file name format.
+    """
+    # The names are relative to the destination, or to its parent when a
+    # single file was copied to a new name
+    base = destination if os.path.isdir(destination) else os.path.dirname(destination)
+    dirs = set()
+    for line in log.splitlines():
+        match = _RSYNC_LOG_RE.match(line)
+        if match and not match.group(1).endswith("/"):
+            path = os.path.normpath(os.path.join(base, match.group(1)))
+            # Also skips the messages of rsync, e.g. the transfer statistics
+            if os.path.isfile(path):
+                dirs.add(os.path.dirname(path))
+    return sorted(dirs)
+
+
+def run_ssh_command(
+    admission: Admission,
+    uid: str,
+    command: Optional[str],
+    preallocate: bool = False,
+    uploaded: Optional[Callable[[str], object]] = None,
+) -> int:
+    """Run the command of an SSH session, admitting the rsync uploads.
+
+    This is the forced command of the device keys in `authorized_keys`. Other
+    commands, e.g. downloads, run right away. With `preallocate`, the receiving
+    rsync reserves the whole size of every file before writing it. Once rsync
+    exits, `uploaded` is called with the absolute path of every directory it
+    wrote files to, as logged by rsync, or of its destination when the log
+    cannot be read.
+
+    Returns:
+        the exit status of the command.
+    """
+    if not command:
+        shell = os.environ.get("SHELL", "/bin/sh")
+        os.execv(shell, [f"-{os.path.basename(shell)}"])
+    argv = shlex.split(command)
+    if argv[:2] != ["rsync", "--server"] or "--sender" in argv:
+        os.execvp("/bin/sh", ["/bin/sh", "-c", command])
+    if preallocate:
+        # Sizes are known from the file list, ahead of the data
+        argv.insert(2, "--preallocate")
+
+    try:
+        admission.check_storage()
+    except StorageFull as e:
+        # Shown by rsync on the device
+        print(f"ros2bag-fileserver: {e}", file=sys.stderr)
+        return 1
+
+    log_path = None
+    if uploaded:
+        # The files rsync writes, to look at their bags only
+        fd, log_path = tempfile.mkstemp(prefix="rsync-", suffix=".log", dir=admission.directory)
+        os.close(fd)
+        argv[2:2] = [f"--log-file={log_path}", "--log-file-format=%n"]
+
+    limits = admission.limits
+    priority = upload_priority(limits, uid, rsync_destination(argv))
+    with admission.admit(uid, priority=priority):
+        bucket = admission.bucket(uid, priority)
+        if bucket is None:
+            status = subprocess.call(argv)
+        else:
+            process = subprocess.Popen(argv, stdin=subprocess.PIPE)
+            try:
+                while chunk := os.read(0, max(4096, int(bucket.rate) >> 3)):
+                    bucket.throttle(len(chunk))
+                    process.stdin.write(chunk)  # pyright: ignore
+                    process.stdin.flush()  # pyright: ignore
+            except BrokenPipeError:
+                pass
+            finally:
+                process.stdin.close()  # pyright: ignore
+            status = process.wait()
+    if uploaded and log_path:
+        destination = os.path.abspath(rsync_destination(argv))
+        try:
+            with open(log_path, errors="replace") as f:
+                written = rsync_written_dirs(destination, f.read())
+            os.remove(log_path)
+        except OSError:
+            written = [destination]
+        for path in written:
+            uploaded(path)
+    return status
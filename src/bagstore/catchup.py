@@ -0,0 +1,193 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Catch-up of the time index over a backlog of bags.
+
+The pipeline only indexes the bags it processes, so enabling the time index
+on an existing store, or restoring the bag index from a backup, leaves
+hundreds of thousands of bags out of it. Reading their chunk indexes is CPU
+bound, the memory map of `McapIndex` only pages in summaries or record
+headers, so `CatchUp` spreads the bags over a pool of processes, as many as
+the CPU limit of the container lets run at once (see `bagstore.cgroup`).
+The chunks are written to the bag index by the parent process, with one
+transaction per batch of bags rather than one per file. The pool rests
+between the batches when the resource scheduler throttles the background
+work (see `bagstore.scheduler`).
+
+The progress is written to `.bagstore/catch-up.json`, where the charm reads
+it for the unit status and the time index service serves it as metrics:
+
+    {"total": 250000, "done": 12000, "started": 1690034520.0,
+     "rate": 140.2, "eta": 1697.6}
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import time
+from typing import List, Optional, Tuple
+
+from bagstore import STATE_DIR
+from bagstore.cgroup import cpu_count
+from bagstore.index import BagIndex
+from bagstore.layout import is_bag_complete
+from bagstore.mcap import McapIndex
+from bagstore.pipeline import CorruptFile, iter_bags
+from bagstore.scheduler import Throttle
+from bagstore.timeindex import chunk_rows
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_FILE = "catch-up.json"
+
+# Chunks of a file: its path, device and `(topic, start, end, offset, length)` rows
+FileChunks = Tuple[str, str, List[Tuple[str, int, int, int, int]]]
+
+
+def _index_bag(task: Tuple[str, str]) -> Tuple[List[FileChunks], List[str]]:
+    """Return the chunks of the MCAP files of a bag, and the problems met.
+
+    This runs in the worker processes, it does not touch the bag index.
+    """
+    root, bag = task
+    uid = bag.split("/", 1)[0]
+    files: List[FileChunks] = []
+    problems: List[str] = []
+    try:
+        names = sorted(os.listdir(os.path.join(root, bag)))
+    except OSError as e:
+        # Moved or deleted since it was listed
+        return files, [f"{bag}: {e}"]
+    for name in names:
+        if not name.endswith(".mcap"):
+            continue
+        try:
+            with open(os.path.join(root, bag, name), "rb") as f:
+                rows = chunk_rows(McapIndex(f))
+        except (CorruptFile, OSError) as e:
+            problems.append(f"{bag}/{name}: {e}")
+            continue
+        files.append((f"{bag}/{name}", uid, rows))
+    return files, problems
+
+
+def progress_path(root: str) -> str:
+    """Return the path of the progress of the catch-up."""
+    return os.path.join(root, STATE_DIR, PROGRESS_FILE)
+
+
+def read_progress(root: str) -> Optional[dict]:
+    """Return the progress of the last catch-up, None if none ran."""
+    try:
+        with open(progress_path(root)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def progress_metrics(progress: Optional[dict]) -> str:
+    """Return the progress of the catch-up in the Prometheus text format."""
+    progress = progress or {"total": 0, "done": 0, "eta": 0}
+    lines = []
+    for metric, value, description in [
+        ("bagstore_catch_up_bags_total", progress["total"], "Bags in the indexing backlog."),
+        ("bagstore_catch_up_bags_done", progress["done"], "Bags of the backlog indexed."),
+        (
+            "bagstore_catch_up_eta_seconds",
+            progress["eta"] or 0,
+            "Estimated time left to index the backlog.",
+        ),
+    ]:
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class CatchUp:
+    """Index the chunks of the bags missing from the time index, in parallel.
+
+    Args:
+        root: storage root served by Caddy.
+        index: index the chunks are recorded in.
+        processes: number of worker processes, from the CPU limit if not given.
+        batch_size: number of bags recorded per transaction.
+        settle_seconds: how long a bag must be left untouched to be indexed.
+        throttle: pace set by the resource scheduler, the pool rests between batches.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        index: BagIndex,
+        processes: Optional[int] = None,
+        batch_size: int = 100,
+        settle_seconds: float = 60.0,
+        throttle: Optional[Throttle] = None,
+    ):
+        self.root = root
+        self.index = index
+        self.processes = processes or cpu_count()
+        self.batch_size = batch_size
+        self.settle_seconds = settle_seconds
+        self.throttle = throttle
+
+    def pending(self) -> List[str]:
+        """Return the completed bags with MCAP files whose chunks are not recorded."""
+        now = time.time()
+        bags = []
+        for bag_dir in iter_bags(self.root):
+            bag = os.path.relpath(bag_dir, self.root).replace(os.sep, "/")
+            names = [name for name in os.listdir(bag_dir) if name.endswith(".mcap")]
+            if all(self.index.has_chunks(f"{bag}/{name}") for name in names):
+                continue
+            if is_bag_complete(bag_dir, self.settle_seconds, now):
+                bags.append(bag)
+        return bags
+
+    def _write_progress(self, total: int, done: int, started: float) -> None:
+        elapsed = time.time() - started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        progress = {
+            "total": total,
+            "done": done,
+            "started": started,
+            "rate": round(rate, 1),
+            "eta": round((total - done) / rate, 1) if rate else None,
+        }
+        path = progress_path(self.root)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(progress, f)
+        os.replace(path + ".tmp", path)
+
+    def run(self) -> int:
+        """Index the pending bags.
+
+        Returns:
+            the number of bags indexed.
+        """
+        bags = self.pending()
+        started = time.time()
+        self._write_progress(len(bags), 0, started)
+        if not bags:
+            return 0
+        logger.info("Indexing a backlog of %d bags in %d processes", len(bags), self.processes)
+
+        done = 0
+        with multiprocessing.Pool(self.processes) as pool:
+            for i in range(0, len(bags), self.batch_size):
+                start = time.monotonic()
+                tasks = [(self.root, bag) for bag in bags[i : i + self.batch_size]]
+                batch: List[FileChunks] = []
+                for files, problems in pool.imap_unordered(_index_bag, tasks, chunksize=4):
+                    for problem in problems:
+                        logger.warning("Cannot index %s", problem)
+                    batch += files
+                    done += 1
+                self.index.record_chunks_many(batch)
+                self._write_progress(len(bags), done, started)
+                if self.throttle:
+                    self.throttle.rest(time.monotonic() - start)
+        return done
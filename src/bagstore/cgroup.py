@@ -0,0 +1,123 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Resource limits and usage of the workload container, read from its cgroup.
+
+Kubernetes enforces the CPU limit of a container with a CFS quota, while
+`os.cpu_count()` returns the CPUs of the node. A pool sized from the latter
+on a large node runs many more processes than the quota lets run at once,
+which only adds throttling. Both the cgroup v2 `cpu.max` and the cgroup v1
+`cpu.cfs_quota_us` of the container are understood, and likewise for the
+memory limit and the CPU and memory usage.
+
+The pressure stall information (PSI) of the cgroup tells how much of the
+time its tasks waited for the CPU, memory or I/O. cgroup v1 has none, the
+pressure of the whole node is read from /proc/pressure instead, if any.
+"""
+
+import math
+import os
+from typing import Optional
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+PROC_PRESSURE = "/proc/pressure"
+# Memory limit of cgroup v1 when there is none, rounded down to a page
+_V1_UNLIMITED = 1 << 62
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _cpu_quota(root: str) -> Optional[float]:
+    """Return the CPU quota of the cgroup in CPUs, None if it has none."""
+    cpu_max = _read(os.path.join(root, "cpu.max"))
+    if cpu_max is not None:
+        quota, _, period = cpu_max.partition(" ")
+        if quota == "max":
+            return None
+        return int(quota) / int(period or 100000)
+
+    quota = _read(os.path.join(root, "cpu", "cpu.cfs_quota_us"))
+    period = _read(os.path.join(root, "cpu", "cpu.cfs_period_us"))
+    if quota is None or period is None or int(quota) < 0:
+        return None
+    return int(quota) / int(period)
+
+
+def available_cpus() -> int:
+    """Return the number of CPUs the process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def cpu_limit(root: str = CGROUP_ROOT) -> float:
+    """Return the CPUs the container may use, from its quota or its CPU affinity."""
+    cpus = available_cpus()
+    try:
+        quota = _cpu_quota(root)
+    except ValueError:
+        quota = None
+    return cpus if quota is None else min(quota, cpus)
+
+
+def cpu_count(root: str = CGROUP_ROOT) -> int:
+    """Return the number of processes that can run at once within the CPU limit."""
+    return max(1, math.ceil(cpu_limit(root)))
+
+
+def memory_limit(root: str = CGROUP_ROOT) -> Optional[int]:
+    """Return the memory limit of the container in bytes, None if it has none."""
+    limit = _read(os.path.join(root, "memory.max"))
+    if limit is None:
+        limit = _read(os.path.join(root, "memory", "memory.limit_in_bytes"))
+    if limit is None or limit == "max" or int(limit) >= _V1_UNLIMITED:
+        return None
+    return int(limit)
+
+
+def memory_usage(root: str = CGROUP_ROOT) -> Optional[int]:
+    """Return the memory used by the container in bytes, None if unknown."""
+    usage = _read(os.path.join(root, "memory.current"))
+    if usage is None:
+        usage = _read(os.path.join(root, "memory", "memory.usage_in_bytes"))
+    return int(usage) if usage is not None else None
+
+
+def cpu_usage(root: str = CGROUP_ROOT) -> Optional[float]:
+    """Return the CPU time used by the container in seconds, None if unknown."""
+    stat = _read(os.path.join(root, "cpu.stat"))
+    if stat is not None:
+        for line in stat.splitlines():
+            name, _, value = line.partition(" ")
+            if name == "usage_usec":
+                return int(value) / 1e6
+    usage = _read(os.path.join(root, "cpuacct", "cpuacct.usage"))
+    return int(usage) / 1e9 if usage is not None else None
+
+
+def pressure(resource: str, root: str = CGROUP_ROOT, proc: str = PROC_PRESSURE) -> Optional[float]:
+    """Return the share of the last 10 s some tasks stalled on a resource, from 0 to 1.
+
+    Args:
+        resource: `cpu`, `memory` or `io`.
+        root: root of the cgroup of the container.
+        proc: pressure of the node, read if the cgroup has none.
+    """
+    content = _read(os.path.join(root, f"{resource}.pressure"))
+    if content is None:
+        content = _read(os.path.join(proc, resource))
+    if content is None:
+        return None
+    for line in content.splitlines():
+        kind, *fields = line.split()
+        if kind == "some":
+            values = dict(field.split("=", 1) for field in fields)
+            return float(values["avg10"]) / 100
+    return None
@@ -0,0 +1,109 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Extraction of a time range of a MCAP file, without copying its data.
+
+Opening the minute around an incident should not mean downloading a bag of
+hours. `ChunkQueryServer` answers
+`GET /_index/extract/<path>?start=2023-07-22T14:02:00Z&end=2023-07-22T14:03:00Z&topic=/camera/*`
+with a standalone MCAP file made of the chunks of `<path>` overlapping the
+time range, with messages of the topic if given.
+
+Chunks are sent whole, as they are on the storage: they are not decompressed,
+and may hold a few messages out of the range or of other topics. Their bytes
+go from the page cache to the socket with `sendfile`, as Caddy serves static
+files, rather than through the Python process. Only the schemas and channels,
+read from a memory map of the file with `McapIndex`, are written by the
+service.
+"""
+
+import io
+import os
+from typing import List, Optional, Tuple, Union
+
+from bagstore.mcap import McapIndex, McapWriter, footer_without_summary
+from bagstore.pipeline import CorruptFile
+
+# Bytes to write, or `(offset, length)` ranges of the file to send
+Part = Union[bytes, Tuple[int, int]]
+
+
+class ExtractError(Exception):
+    """Raised when a file cannot be extracted."""
+
+
+def topic_matches(topic: str, pattern: Optional[str]) -> bool:
+    """Whether a topic matches a topic pattern, a prefix if it ends with `*`."""
+    if pattern is None:
+        return True
+    if pattern.endswith("*"):
+        return topic.startswith(pattern[:-1])
+    return topic == pattern
+
+
+def extract_parts(f, start: int, end: int, topic: Optional[str] = None) -> List[Part]:
+    """Return the parts of the MCAP file holding the chunks of a time range.
+
+    Args:
+        f: MCAP file opened for reading.
+        start: start of the time range, in nanoseconds.
+        end: end of the time range, in nanoseconds.
+        topic: topic of the messages, or prefix of the topics if it ends with `*`.
+
+    Raises:
+        ExtractError: if the file is not a MCAP file, or has no chunks.
+    """
+    try:
+        index = McapIndex(f)
+    except CorruptFile as e:
+        raise ExtractError(str(e))
+    if not index.chunks:
+        raise ExtractError("The file has no chunks")
+
+    channels = [c for c in index.channels.values() if topic_matches(c.topic, topic)]
+    wanted = {channel.id for channel in channels}
+    chunks = [
+        chunk
+        for chunk in index.chunks
+        if chunk.start <= end
+        and chunk.end >= start
+        and (topic is None or not chunk.channels or chunk.channels & wanted)
+    ]
+
+    prefix = io.BytesIO()
+    writer = McapWriter(prefix)
+    # Every channel of the chunks, as they may hold messages of other topics
+    for channel in sorted(index.channels.values(), key=lambda c: c.id):
+        writer.add_channel(channel)
+    return [
+        prefix.getvalue(),
+        *((chunk.offset, chunk.length) for chunk in chunks),
+        footer_without_summary(),
+    ]
+
+
+def parts_length(parts: List[Part]) -> int:
+    """Return the length of the extracted file."""
+    return sum(len(part) if isinstance(part, bytes) else part[1] for part in parts)
+
+
+def send_parts(sock, f, parts: List[Part]) -> None:
+    """Send the extracted file to a socket, the ranges of the file with `sendfile`."""
+    for part in parts:
+        if isinstance(part, bytes):
+            sock.sendall(part)
+        else:
+            offset, length = part
+            sock.sendfile(f, offset, length)
+
+
+def storage_file(root: str, path: str) -> str:
+    """Return the path of a file of the storage, given relative to its root.
+
+    Raises:
+        ExtractError: if the path is outside of the storage, or hidden.
+    """
+    path = os.path.normpath(path.lstrip("/"))
+    if any(part.startswith(".") for part in path.split(os.sep)):
+        raise ExtractError(f"Invalid path '{path}'")
+    return os.path.join(root, path)
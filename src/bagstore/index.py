@@ -0,0 +1,514 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Index of the bag files on the storage.
+
+The index is a SQLite database in the state directory, recording for every
+file what the post-upload stages learnt about it, e.g. its checksum and
+whether it is intact. Paths are relative to the storage root.
+
+It also holds the queue of the bags waiting for the post-upload pipeline, so
+that the queue survives restarts, the directories uploads completed to, from
+which the bags to process and move are found without walking the storage,
+and the time index of the MCAP chunks: which
+chunk of which file holds the messages of a topic of a device at a given time.
+Chunks are found by their start time, within the longest chunk of the device
+of the time range queried, so that lookups only scan the matching chunks.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from bagstore import STATE_DIR
+from bagstore.admission import PRIORITIES
+
+INDEX_FILE = "index.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    bag TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha256 TEXT,
+    status TEXT NOT NULL,
+    detail TEXT NOT NULL DEFAULT '',
+    verified REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_bag ON files (bag);
+CREATE INDEX IF NOT EXISTS files_status ON files (status);
+CREATE TABLE IF NOT EXISTS bags (
+    bag TEXT PRIMARY KEY,
+    uid TEXT NOT NULL,
+    start_time INTEGER,
+    end_time INTEGER
+);
+CREATE INDEX IF NOT EXISTS bags_uid ON bags (uid, bag);
+CREATE TABLE IF NOT EXISTS jobs (
+    bag TEXT PRIMARY KEY,
+    priority INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    enqueued REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (state, priority, enqueued);
+CREATE TABLE IF NOT EXISTS chunks (
+    path TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    topic TEXT NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    chunk_offset INTEGER NOT NULL,
+    chunk_length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_topic ON chunks (uid, topic, start_time);
+CREATE INDEX IF NOT EXISTS chunks_time ON chunks (uid, start_time);
+CREATE INDEX IF NOT EXISTS chunks_path ON chunks (path);
+-- Files whose chunks are recorded, even if they have none
+CREATE TABLE IF NOT EXISTS chunk_files (
+    path TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS chunk_spans (
+    uid TEXT PRIMARY KEY,
+    longest INTEGER NOT NULL
+);
+-- Files rewritten by the recompression, or not worth it, as they are now
+CREATE TABLE IF NOT EXISTS recompressions (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    saved INTEGER NOT NULL
+);
+-- Directories uploads completed to, for the background workers to look at
+CREATE TABLE IF NOT EXISTS uploads (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    completed REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS previews (
+    bag TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    summary TEXT NOT NULL
+);
+"""
+
+STATUS_OK = "ok"
+STATUS_CORRUPT = "corrupt"
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_FAILED = "failed"
+ACTIVE_JOB_STATES = (JOB_PENDING, JOB_RUNNING)
+MAX_JOB_ATTEMPTS = 3
+# Uploads are recorded for the background workers to see them for that long
+UPLOADS_KEPT_SECONDS = 86400.0
+
+
+class BagIndex:
+    """SQLite index of the bag files, shared by the workload helpers."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.path = os.path.join(root, STATE_DIR, INDEX_FILE)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        """Close the database."""
+        self._db.close()
+
+    def is_current(self, path: str, size: int, mtime: float) -> bool:
+        """Whether a file is indexed, and did not change since."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, mtime FROM files WHERE path = ?", (path,)
+            ).fetchone()
+        return row is not None and row["size"] == size and row["mtime"] == mtime
+
+    def checksum(self, path: str) -> Optional[str]:
+        """Return the SHA-256 of a file, None if it is not indexed or corrupt."""
+        with self._lock:
+            row = self._db.execute("SELECT sha256 FROM files WHERE path = ?", (path,)).fetchone()
+        return row["sha256"] if row else None
+
+    def record(
+        self,
+        path: str,
+        bag: str,
+        size: int,
+        mtime: float,
+        sha256: Optional[str],
+        status: str,
+        detail: str = "",
+    ) -> None:
+        """Record the verification of a file."""
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, bag, size, mtime, sha256, status, detail, time.time()),
+            )
+
+    def move(self, source: str, target: str) -> None:
+        """Follow a bag moved from `source` to `target`, both directories."""
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE files SET path = ? || substr(path, ?), bag = ? || substr(bag, ?) "
+                "WHERE bag = ? OR bag LIKE ? ESCAPE '\\'",
+                (
+                    target,
+                    len(source) + 1,
+                    target,
+                    len(source) + 1,
+                    source,
+                    _escape_like(source) + "/%",
+                ),
+            )
+            self._db.execute(
+                "UPDATE bags SET bag = ? || substr(bag, ?) WHERE bag = ? OR bag LIKE ? ESCAPE '\\'",
+                (target, len(source) + 1, source, _escape_like(source) + "/%"),
+            )
+            for table in ("chunks", "chunk_files", "recompressions"):
+                self._db.execute(
+                    f"UPDATE {table} SET path = ? || substr(path, ?) "
+                    "WHERE path LIKE ? ESCAPE '\\'",
+                    (target, len(source) + 1, _escape_like(source) + "/%"),
+                )
+            self._db.execute(
+                "UPDATE previews SET bag = ? || substr(bag, ?) "
+                "WHERE bag = ? OR bag LIKE ? ESCAPE '\\'",
+                (target, len(source) + 1, source, _escape_like(source) + "/%"),
+            )
+
+    def record_bag(self, bag: str, start: Optional[int], end: Optional[int]) -> None:
+        """Record a processed bag, and the time range it covers in nanoseconds."""
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO bags VALUES (?, ?, ?, ?)",
+                (bag, bag.split("/", 1)[0], start, end),
+            )
+
+    def list_bags(
+        self,
+        uid: Optional[str] = None,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+        after: Optional[str] = None,
+        limit: int = 100,
+    ) -> List[sqlite3.Row]:
+        """Return a page of the bags, by path, with their number of files and size.
+
+        Args:
+            uid: only the bags of the device.
+            since: only the bags recorded after, in nanoseconds since the epoch.
+            until: only the bags recorded before, in nanoseconds since the epoch.
+            after: only the bags after this one, the last of the previous page.
+            limit: size of the page.
+        """
+        conditions, args = _bag_filters("b", uid, since, until, after)
+        query = (
+            "SELECT b.bag, b.start_time, b.end_time, count(f.path) AS files, "
+            "coalesce(sum(f.size), 0) AS size, coalesce(sum(f.status = ?), 0) AS corrupt "
+            "FROM bags b LEFT JOIN files f ON f.bag = b.bag"
+            f"{conditions} GROUP BY b.bag ORDER BY b.bag LIMIT ?"
+        )
+        with self._lock:
+            return self._db.execute(query, [STATUS_CORRUPT, *args, limit]).fetchall()
+
+    def find_bags(
+        self,
+        topic: str,
+        uid: Optional[str] = None,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+        after: Optional[str] = None,
+        limit: int = 100,
+    ) -> List[sqlite3.Row]:
+        """Return a page of the bags with messages of a topic, from the time index.
+
+        Args:
+            topic: topic of the messages, or prefix of the topics if it ends with `*`.
+            uid: only the bags of the device.
+            since: only the messages after, in nanoseconds since the epoch.
+            until: only the messages before, in nanoseconds since the epoch.
+            after: only the bags after this one, the last of the previous page.
+            limit: size of the page.
+        """
+        conditions, args = _bag_filters("c", uid, since, until, None)
+        if topic.endswith("*"):
+            conditions += " AND substr(c.topic, 1, ?) = ?"
+            args += [len(topic) - 1, topic[:-1]]
+        else:
+            conditions += " AND c.topic = ?"
+            args.append(topic)
+        if after is not None:
+            conditions += " AND f.bag > ?"
+            args.append(after)
+        query = (
+            "SELECT f.bag, min(c.start_time) AS start_time, max(c.end_time) AS end_time "
+            "FROM chunks c JOIN files f ON f.path = c.path"
+            f"{conditions} GROUP BY f.bag ORDER BY f.bag LIMIT ?"
+        )
+        with self._lock:
+            return self._db.execute(query, [*args, limit]).fetchall()
+
+    def stats(self, uid: Optional[str] = None) -> dict:
+        """Return the number of bags, files and bytes, and the state of the queue."""
+        where, args = "", []
+        if uid is not None:
+            where, args = " WHERE bag LIKE ? ESCAPE '\\'", [_escape_like(uid) + "/%"]
+        with self._lock:
+            files = self._db.execute(
+                "SELECT count(DISTINCT bag) AS bags, count(*) AS files, "
+                "coalesce(sum(size), 0) AS size, coalesce(sum(status = ?), 0) AS corrupt "
+                f"FROM files{where}",
+                [STATUS_CORRUPT, *args],
+            ).fetchone()
+            devices = self._db.execute(
+                f"SELECT count(DISTINCT uid) FROM bags{where}", args
+            ).fetchone()[0]
+            saved = self._db.execute(
+                "SELECT coalesce(sum(saved), 0) FROM recompressions"
+                + (" WHERE path LIKE ? ESCAPE '\\'" if uid is not None else ""),
+                args,
+            ).fetchone()[0]
+            jobs = dict(
+                self._db.execute(
+                    f"SELECT state, count(*) FROM jobs{where} GROUP BY state", args
+                ).fetchall()
+            )
+        return {
+            "devices": devices,
+            "bags": files["bags"],
+            "files": files["files"],
+            "size": files["size"],
+            "corrupt-files": files["corrupt"],
+            "pending-jobs": jobs.get(JOB_PENDING, 0) + jobs.get(JOB_RUNNING, 0),
+            "failed-jobs": jobs.get(JOB_FAILED, 0),
+            "recompression-saved": saved,
+        }
+
+    def enqueue(self, bag: str, priority: int) -> None:
+        """Queue a bag for the pipeline, unless it already is, anew if its job failed."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM jobs WHERE bag = ? AND state = ?", (bag, JOB_FAILED))
+            self._db.execute(
+                "INSERT OR IGNORE INTO jobs (bag, priority, state, enqueued) VALUES (?, ?, ?, ?)",
+                (bag, priority, JOB_PENDING, time.time()),
+            )
+
+    def job_state(self, bag: str) -> Optional[str]:
+        """Return the state of the job of a bag, None if it has none."""
+        job = self.job(bag)
+        return job["state"] if job else None
+
+    def job(self, bag: str) -> Optional[sqlite3.Row]:
+        """Return the job of a bag, None if it has none."""
+        with self._lock:
+            return self._db.execute("SELECT * FROM jobs WHERE bag = ?", (bag,)).fetchone()
+
+    def claim_job(self, max_priority: Optional[int] = None) -> Optional[str]:
+        """Take the next pending job, the highest priority first, return its bag."""
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT bag FROM jobs WHERE state = ? AND priority <= ? "
+                "ORDER BY priority, enqueued LIMIT 1",
+                (JOB_PENDING, len(PRIORITIES) if max_priority is None else max_priority),
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE jobs SET state = ?, attempts = attempts + 1 WHERE bag = ?",
+                (JOB_RUNNING, row["bag"]),
+            )
+        return row["bag"]
+
+    def complete_job(self, bag: str) -> None:
+        """Drop a job once done."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM jobs WHERE bag = ?", (bag,))
+
+    def fail_job(self, bag: str) -> None:
+        """Queue a failed job again, until it failed too many times."""
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END WHERE bag = ?",
+                (MAX_JOB_ATTEMPTS, JOB_FAILED, JOB_PENDING, bag),
+            )
+
+    def requeue_running_jobs(self) -> None:
+        """Queue again the jobs interrupted by a restart."""
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE jobs SET state = ? WHERE state = ?", (JOB_PENDING, JOB_RUNNING)
+            )
+
+    def record_upload(self, path: str) -> None:
+        """Record that an upload completed to a directory."""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("INSERT INTO uploads (path, completed) VALUES (?, ?)", (path, now))
+            self._db.execute(
+                "DELETE FROM uploads WHERE completed < ?", (now - UPLOADS_KEPT_SECONDS,)
+            )
+
+    def uploads(self, after: int = 0) -> List[Tuple[int, str]]:
+        """Return the `(id, path)` of the uploads recorded after the one of id `after`."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, path FROM uploads WHERE id > ? ORDER BY id", (after,)
+            ).fetchall()
+        return [(row["id"], row["path"]) for row in rows]
+
+    def last_upload(self) -> int:
+        """Return the id of the last upload recorded, 0 if none."""
+        with self._lock:
+            row = self._db.execute("SELECT MAX(id) AS id FROM uploads").fetchone()
+        return row["id"] or 0
+
+    def record_chunks(self, path: str, uid: str, chunks: Iterable[Tuple[str, int, int, int, int]]):
+        """Record the `(topic, start, end, offset, length)` chunks of a file, replacing any."""
+        self.record_chunks_many([(path, uid, list(chunks))])
+
+    def record_chunks_many(
+        self, files: Iterable[Tuple[str, str, Iterable[Tuple[str, int, int, int, int]]]]
+    ) -> None:
+        """Record the chunks of several `(path, uid, chunks)` files in one transaction."""
+        longest: Dict[str, int] = {}
+        with self._lock, self._db:
+            for path, uid, chunks in files:
+                chunks = list(chunks)
+                self._db.execute("DELETE FROM chunks WHERE path = ?", (path,))
+                self._db.executemany(
+                    "INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(path, uid, *chunk) for chunk in chunks],
+                )
+                self._db.execute("INSERT OR IGNORE INTO chunk_files VALUES (?)", (path,))
+                span = max((end - start for _, start, end, _, _ in chunks), default=0)
+                longest[uid] = max(longest.get(uid, 0), span)
+            self._db.executemany(
+                "INSERT INTO chunk_spans VALUES (?, ?) "
+                "ON CONFLICT (uid) DO UPDATE SET longest = max(longest, excluded.longest)",
+                longest.items(),
+            )
+
+    def has_chunks(self, path: str) -> bool:
+        """Whether the chunks of a file are recorded."""
+        with self._lock:
+            # Files indexed before `chunk_files` only have their chunks
+            row = self._db.execute(
+                "SELECT 1 FROM chunk_files WHERE path = ? "
+                "UNION ALL SELECT 1 FROM chunks WHERE path = ? LIMIT 1",
+                (path, path),
+            ).fetchone()
+        return row is not None
+
+    def is_recompressed(self, path: str, size: int, mtime: float) -> bool:
+        """Whether a file was recompressed, or found not worth it, and did not change since."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, mtime FROM recompressions WHERE path = ?", (path,)
+            ).fetchone()
+        return row is not None and row["size"] == size and row["mtime"] == mtime
+
+    def record_recompression(self, path: str, size: int, mtime: float, saved: int) -> None:
+        """Record the recompression of a file, its size and mtime now and the bytes saved."""
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO recompressions VALUES (?, ?, ?, ?) ON CONFLICT (path) DO UPDATE "
+                "SET size = excluded.size, mtime = excluded.mtime, saved = saved + excluded.saved",
+                (path, size, mtime, saved),
+            )
+
+    def find_chunks(
+        self, uid: str, start: int, end: int, topic: Optional[str] = None
+    ) -> List[sqlite3.Row]:
+        """Return the chunks of a device with messages between `start` and `end`.
+
+        Args:
+            uid: device that recorded the chunks.
+            start: start of the time range, in nanoseconds since the epoch.
+            end: end of the time range, in nanoseconds since the epoch.
+            topic: only the chunks of the topic, or of the topics starting with
+                it if it ends with `*`.
+        """
+        query = (
+            "SELECT path, topic, start_time, end_time, chunk_offset, chunk_length FROM chunks "
+            "WHERE uid = ? AND start_time BETWEEN ? AND ? AND end_time >= ?"
+        )
+        with self._lock:
+            row = self._db.execute(
+                "SELECT longest FROM chunk_spans WHERE uid = ?", (uid,)
+            ).fetchone()
+            if row is None:
+                return []
+            args: list = [uid, start - row["longest"], end, start]
+            if topic is not None and topic.endswith("*"):
+                query += " AND substr(topic, 1, ?) = ?"
+                args += [len(topic) - 1, topic[:-1]]
+            elif topic is not None:
+                query += " AND topic = ?"
+                args.append(topic)
+            return self._db.execute(query + " ORDER BY start_time, path", args).fetchall()
+
+    def record_preview(self, bag: str, digest: str, summary: str) -> Optional[str]:
+        """Record the previews of a bag, return the digest of those they replace."""
+        with self._lock, self._db:
+            row = self._db.execute("SELECT digest FROM previews WHERE bag = ?", (bag,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO previews VALUES (?, ?, ?)", (bag, digest, summary)
+            )
+        return row["digest"] if row else None
+
+    def previews(self) -> Iterator[Tuple[str, str]]:
+        """Yield the bags with previews, and the JSON summary of their previews."""
+        with self._lock:
+            rows = self._db.execute("SELECT bag, summary FROM previews ORDER BY bag").fetchall()
+        for row in rows:
+            yield row["bag"], row["summary"]
+
+    def files(self, status: Optional[str] = None) -> Iterator[sqlite3.Row]:
+        """Yield the indexed files, only those with `status` if given."""
+        with self._lock:
+            if status is None:
+                rows = self._db.execute("SELECT * FROM files ORDER BY path").fetchall()
+            else:
+                rows = self._db.execute(
+                    "SELECT * FROM files WHERE status = ? ORDER BY path", (status,)
+                ).fetchall()
+        yield from rows
+
+
+def _bag_filters(
+    table: str,
+    uid: Optional[str],
+    since: Optional[int],
+    until: Optional[int],
+    after: Optional[str],
+) -> Tuple[str, list]:
+    """Return the WHERE clause filtering bags by device, time and page."""
+    conditions, args = [], []
+    if uid is not None:
+        conditions.append(f"{table}.uid = ?")
+        args.append(uid)
+    if since is not None:
+        conditions.append(f"{table}.end_time >= ?")
+        args.append(since)
+    if until is not None:
+        conditions.append(f"{table}.start_time <= ?")
+        args.append(until)
+    if after is not None:
+        conditions.append(f"{table}.bag > ?")
+        args.append(after)
+    return (" WHERE " + " AND ".join(conditions) if conditions else " WHERE 1"), args
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
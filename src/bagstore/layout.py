@@ -0,0 +1,437 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Time-partitioned storage layout.
+
+Robots push their bags to whatever path they like under their own top-level
+`/<uid>/` directory. In the partitioned layout, completed bags are moved to
+`/<uid>/<YYYY>/<MM>/<DD>/<bag>` based on the bag start time found in the
+rosbag2 `metadata.yaml`, so that no directory grows without bound.
+
+Every move is recorded in a redirect map persisted on the storage, so that
+the old paths keep resolving over HTTP. A `RedirectServer` answers from the
+map, and a single Caddyfile route hands it the requests of the paths that
+no longer exist, so the Caddy configuration does not grow with the moves.
+The first bag moved away from a path keeps its redirect, should another bag
+be uploaded to the same path and moved later.
+
+Rather than walking the storage, the background workers look at the bags
+under the directories the uploads completed to, which the upload processes
+record in the bag index (see `UploadWatch`), and only walk it from time to
+time, should an upload have been missed.
+
+Bags recorded around an incident are moved first, and the other ones wait
+while high priority uploads are in progress, see `bagstore.admission`.
+"""
+
+import json
+import logging
+import os
+import re
+import subprocess
+import time
+from datetime import datetime, timezone
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote, unquote, urlsplit
+
+from bagstore import STATE_DIR
+from bagstore.admission import PRIORITIES, Admission, load_limits, upload_priority
+from bagstore.index import ACTIVE_JOB_STATES, BagIndex
+
+logger = logging.getLogger(__name__)
+
+REDIRECTS_FILE = "redirects.json"
+
+BAG_METADATA_FILE = "metadata.yaml"
+
+# Partition directories are named after the year, month and day of the bag.
+_PARTITION_RE = re.compile(r"^\d{4}$")
+
+# rsync writes into hidden temporary files named `.<name>.<6 random chars>`
+# and renames them once the transfer of the file is done.
+_RSYNC_TEMP_RE = re.compile(r"^\..+\.[A-Za-z0-9]{6}$")
+
+_STARTING_TIME_RE = re.compile(r"starting_time:\s*\n\s*nanoseconds_since_epoch:\s*(\d+)")
+_DURATION_RE = re.compile(r"duration:\s*\n\s*nanoseconds:\s*(\d+)")
+_TOPIC_RE = re.compile(
+    r"name:\s*(?P<name>\S+)\s*\n\s*type:\s*(?P<type>\S+)(?:.|\n)*?message_count:\s*(?P<count>\d+)"
+)
+
+
+def bag_start_time(bag_dir: str) -> Optional[datetime]:
+    """Return the start time of a rosbag2 bag, or None if it cannot be read.
+
+    The start time is read from the `metadata.yaml` rosbag2 writes once a
+    recording is closed, which is the same for every storage plugin.
+    """
+    try:
+        with open(os.path.join(bag_dir, BAG_METADATA_FILE)) as f:
+            match = _STARTING_TIME_RE.search(f.read())
+    except OSError:
+        return None
+
+    if not match:
+        return None
+    return datetime.fromtimestamp(int(match.group(1)) / 1e9, tz=timezone.utc)
+
+
+def read_bag_metadata(bag_dir: str) -> dict:
+    """Return the start time, duration and topics recorded in `metadata.yaml`."""
+    try:
+        with open(os.path.join(bag_dir, BAG_METADATA_FILE)) as f:
+            metadata = f.read()
+    except OSError:
+        return {"start": None, "duration": None, "topics": {}}
+    start = _STARTING_TIME_RE.search(metadata)
+    duration = _DURATION_RE.search(metadata)
+    return {
+        "start": int(start.group(1)) if start else None,
+        "duration": int(duration.group(1)) if duration else None,
+        "topics": {
+            m["name"]: {"type": m["type"], "count": int(m["count"])}
+            for m in _TOPIC_RE.finditer(metadata)
+        },
+    }
+
+
+def is_bag_complete(bag_dir: str, settle_seconds: float, now: Optional[float] = None) -> bool:
+    """Whether the bag directory is a finished upload.
+
+    A bag is finished when it holds a `metadata.yaml`, no rsync temporary file
+    and nothing in it changed for `settle_seconds`.
+    """
+    now = time.time() if now is None else now
+    newest = 0.0
+    with os.scandir(bag_dir) as entries:
+        for entry in entries:
+            if _RSYNC_TEMP_RE.match(entry.name):
+                return False
+            newest = max(newest, entry.stat(follow_symlinks=False).st_mtime)
+    return now - newest >= settle_seconds
+
+
+def bags_under(path: str, root: Optional[str] = None) -> List[str]:
+    """Return the bag directories at or under `path`, skipping hidden directories.
+
+    With the storage `root`, the partitions of the devices are not walked into,
+    their bags are in place already.
+    """
+    if os.path.isfile(os.path.join(path, BAG_METADATA_FILE)):
+        return [path]
+    uid_parent = os.path.normpath(root) if root else None
+    bags = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        if os.path.dirname(os.path.normpath(dirpath)) == uid_parent:
+            dirnames[:] = [d for d in dirnames if not _PARTITION_RE.match(d)]
+        if BAG_METADATA_FILE in filenames:
+            dirnames[:] = []
+            bags.append(dirpath)
+    return bags
+
+
+class UploadWatch:
+    """The bags under the directories uploads completed to, until they are dealt with.
+
+    Upload processes record the directories they wrote files to in the bag
+    index once an upload completes, so that only the bags they touched are
+    looked at. A bag is watched until it is marked as done, or for
+    `keep_seconds`, e.g. if it never completes. Only the uploads recorded
+    after the watch is created are seen.
+
+    Args:
+        root: storage root.
+        index: bag index holding the uploads.
+        keep_seconds: how long a bag is watched at most.
+    """
+
+    def __init__(self, root: str, index: BagIndex, keep_seconds: float = 86400.0):
+        self.root = root
+        self.index = index
+        self.keep_seconds = keep_seconds
+        self._last = index.last_upload()
+        self._bags: Dict[str, float] = {}
+
+    def bags(self) -> List[str]:
+        """Return the watched bag directories, those of the new uploads included."""
+        now = time.time()
+        for upload_id, path in self.index.uploads(self._last):
+            self._last = upload_id
+            for bag_dir in bags_under(os.path.join(self.root, path), self.root):
+                self._bags[bag_dir] = now
+        for bag_dir, seen in list(self._bags.items()):
+            if now - seen > self.keep_seconds or not os.path.isdir(bag_dir):
+                del self._bags[bag_dir]
+        return sorted(self._bags)
+
+    def done(self, bag_dir: str) -> None:
+        """Stop watching a bag."""
+        self._bags.pop(bag_dir, None)
+
+
+def record_upload(root: str, index: BagIndex, path: str) -> None:
+    """Record the directory an upload completed to, given as an absolute path."""
+    directory = path if os.path.isdir(path) else os.path.dirname(path)
+    relpath = os.path.relpath(directory, root)
+    if relpath.startswith(os.pardir) or relpath.split(os.sep)[0] == STATE_DIR:
+        return
+    index.record_upload("" if relpath == os.curdir else relpath.replace(os.sep, "/"))
+
+
+class PartitionedLayout:
+    """Move completed bags into per-day partitions and track redirects.
+
+    Args:
+        root: storage root served by Caddy.
+        snippet_path: path of the Caddyfile snippet routing to the redirects.
+        redirect_address: address the `RedirectServer` listens on.
+        settle_seconds: how long a bag must be left untouched to be moved.
+        admission: admission of the uploads, to yield to high priority ones.
+        index: bag index to keep up to date with the moves.
+        uploads: uploads to find the bags to move from, between full walks.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        snippet_path: str,
+        redirect_address: str = "127.0.0.1:8083",
+        settle_seconds: float = 60.0,
+        admission: Optional[Admission] = None,
+        index: Optional[BagIndex] = None,
+        uploads: Optional[UploadWatch] = None,
+    ):
+        self.root = root
+        self.snippet_path = snippet_path
+        self.uploads = uploads
+        self.redirect_address = redirect_address
+        self.settle_seconds = settle_seconds
+        self.admission = admission
+        self.index = index
+        self._redirects_path = os.path.join(root, STATE_DIR, REDIRECTS_FILE)
+        self.redirects = self._load_redirects()
+
+    def _load_redirects(self) -> Dict[str, str]:
+        try:
+            with open(self._redirects_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_redirects(self) -> None:
+        os.makedirs(os.path.dirname(self._redirects_path), exist_ok=True)
+        tmp_path = self._redirects_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.redirects, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self._redirects_path)
+
+    def _candidate_bags(self, full: bool = True) -> Iterator[str]:
+        """Yield the bags not partitioned yet, only those uploaded to unless `full`."""
+        if self.uploads and not full:
+            for bag_dir in self.uploads.bags():
+                parts = self._relpath(bag_dir).split("/")
+                if len(parts) > 1 and _PARTITION_RE.match(parts[1]):
+                    self.uploads.done(bag_dir)
+                else:
+                    yield bag_dir
+            return
+
+        with os.scandir(self.root) as uids:
+            uid_dirs = [e.path for e in uids if e.is_dir() and not e.name.startswith(".")]
+
+        for uid_dir in uid_dirs:
+            for dirpath, dirnames, filenames in os.walk(uid_dir):
+                if dirpath == uid_dir:
+                    # Never walk into the partitions, their content is in place.
+                    dirnames[:] = [d for d in dirnames if not _PARTITION_RE.match(d)]
+                if BAG_METADATA_FILE in filenames and dirpath != uid_dir:
+                    dirnames[:] = []
+                    yield dirpath
+                dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+
+    def _prioritized(self, bag_dirs: Iterator[str]) -> List[Tuple[str, str]]:
+        """Return the priority class of the bags, the highest first."""
+        limits = self.admission.limits if self.admission else load_limits(None)
+        bags = []
+        for bag_dir in bag_dirs:
+            uid, _, path = os.path.relpath(bag_dir, self.root).partition(os.sep)
+            bags.append((upload_priority(limits, uid, path.replace(os.sep, "/")), bag_dir))
+        return sorted(bags, key=lambda bag: PRIORITIES.index(bag[0]))
+
+    def _relpath(self, path: str) -> str:
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def _destination(self, bag_dir: str, start: datetime) -> str:
+        uid = os.path.relpath(bag_dir, self.root).split(os.sep)[0]
+        partition = os.path.join(self.root, uid, start.strftime("%Y/%m/%d"))
+        name = os.path.basename(bag_dir)
+        destination = os.path.join(partition, name)
+        suffix = 1
+        while os.path.exists(destination):
+            destination = os.path.join(partition, f"{name}-{suffix}")
+            suffix += 1
+        return destination
+
+    def run_once(self, full: bool = True) -> int:
+        """Move every completed bag to its partition.
+
+        Args:
+            full: whether to walk the storage, rather than look at the uploads only.
+
+        Returns:
+            the number of bags moved.
+        """
+        now = time.time()
+        moved = 0
+        for priority, bag_dir in self._prioritized(self._candidate_bags(full)):
+            if priority != "high" and self.admission and self.admission.preempted():
+                logger.debug("Yielding to high priority uploads")
+                break
+            if not is_bag_complete(bag_dir, self.settle_seconds, now):
+                continue
+            if self.index and self.index.job_state(self._relpath(bag_dir)) in ACTIVE_JOB_STATES:
+                # Being read by the post-upload pipeline, move it afterwards
+                continue
+            start = bag_start_time(bag_dir)
+            if start is None:
+                logger.warning("Cannot read the start time of '%s', leaving it in place", bag_dir)
+                continue
+
+            destination = self._destination(bag_dir, start)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            os.rename(bag_dir, destination)
+            logger.info("Moved '%s' to '%s'", bag_dir, destination)
+            if self.uploads:
+                self.uploads.done(bag_dir)
+
+            old_url = "/" + os.path.relpath(bag_dir, self.root)
+            new_url = "/" + os.path.relpath(destination, self.root)
+            # Point earlier redirects straight to the final location.
+            for source, target in self.redirects.items():
+                if target == old_url:
+                    self.redirects[source] = new_url
+            if old_url in self.redirects:
+                logger.warning(
+                    "'%s' keeps redirecting to '%s', the first bag moved away from it",
+                    old_url,
+                    self.redirects[old_url],
+                )
+            else:
+                self.redirects[old_url] = new_url
+            if self.index:
+                self.index.move(old_url[1:], new_url[1:])
+                # For the pipeline to see the bag where it is now
+                self.index.record_upload(new_url[1:])
+            moved += 1
+
+        if moved:
+            self._save_redirects()
+        return moved
+
+    def redirect(self, path: str) -> Optional[str]:
+        """Return where a path moved to, None if it did not."""
+        prefix = path.rstrip("/")
+        rest = path[len(prefix) :]
+        while prefix:
+            target = self.redirects.get(prefix)
+            if target is not None:
+                return target + rest
+            prefix, _, name = prefix.rpartition("/")
+            rest = f"/{name}{rest}"
+        return None
+
+    def write_snippet(self) -> bool:
+        """Render the Caddyfile snippet routing to the redirects.
+
+        Returns:
+            whether the snippet changed.
+        """
+        content = render_redirect_route(self.redirect_address)
+        try:
+            with open(self.snippet_path) as f:
+                if f.read() == content:
+                    return False
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(os.path.dirname(self.snippet_path), exist_ok=True)
+        with open(self.snippet_path, "w") as f:
+            f.write(content)
+        return True
+
+
+def render_redirect_route(address: str) -> str:
+    """Render the Caddyfile route of the paths that may have moved.
+
+    A redirect only applies while nothing exists at the old path anymore, so a
+    new upload to a path that was moved before is still served.
+    """
+    lines = [
+        "# Rendered by bagstore, do not edit.",
+        "handle_errors {",
+        "\t@bagstore_moved expression {err.status_code} == 404",
+        "\treverse_proxy @bagstore_moved " + address,
+        "}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+class RedirectRequestHandler(BaseHTTPRequestHandler):
+    """Answer the requests of the moved paths of a `RedirectServer`."""
+
+    protocol_version = "HTTP/1.1"
+    server: "RedirectServer"  # pyright: ignore[reportIncompatibleVariableOverride]
+
+    def log_message(self, format, *args):
+        """Log requests through logging rather than stderr."""
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def _redirect(self) -> None:
+        url = urlsplit(self.path)
+        target = self.server.layout.redirect(unquote(url.path))
+        if target is None:
+            self.send_response(HTTPStatus.NOT_FOUND)
+        else:
+            # Honour the prefix stripped by the ingress, if any
+            location = self.headers.get("X-Forwarded-Prefix", "") + quote(target)
+            self.send_response(HTTPStatus.PERMANENT_REDIRECT)
+            self.send_header("Location", location + (f"?{url.query}" if url.query else ""))
+        # A new upload to the old path takes precedence over the redirect
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):  # noqa: N802
+        """Redirect a path that moved."""
+        self._redirect()
+
+    def do_HEAD(self):  # noqa: N802
+        """Redirect a path that moved."""
+        self._redirect()
+
+
+class RedirectServer(ThreadingHTTPServer):
+    """HTTP server of the redirects of the moved bags.
+
+    Args:
+        address: address to listen on.
+        layout: layout holding the redirects.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], layout: PartitionedLayout):
+        self.layout = layout
+        super().__init__(address, RedirectRequestHandler)
+
+
+def reload_caddy(config: str) -> None:
+    """Ask the running Caddy to reload its configuration."""
+    try:
+        subprocess.run(
+            ["caddy", "reload", "--config", config], check=True, capture_output=True, text=True
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.error("Failed to reload Caddy: %s", getattr(e, "stderr", e))
@@ -0,0 +1,737 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Streaming reader and writer of MCAP files, and of the ROS 2 messages they hold.
+
+`McapStream` is fed the content of a file in order, in buffers of any size,
+and calls back with the schemas, channels and messages it finds, including
+those of the chunks. Chunks compressed with zstd are only read when a zstd
+module is available, from the standard library (Python 3.14+) or the
+`zstandard` package, since the workload only ships the standard library. LZ4
+chunks are likewise only read with the `lz4` package, and skipped otherwise.
+
+`McapWriter` writes indexed MCAP files, so that players can seek in them,
+compressing the chunks with zstd when available. `McapIndex` reads where
+the chunks of a file are, from a memory map, without reading them.
+
+`CdrReader` decodes the few fields of the ROS 2 messages the workload helpers
+need, serialized in CDR.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import zlib
+from typing import Callable, Dict, List, Optional, Set, Union
+
+from bagstore.pipeline import CorruptFile, ScanConsumer
+
+logger = logging.getLogger(__name__)
+
+try:
+    from compression import zstd as _zstd  # type: ignore
+
+    def _zstd_decompress(data: bytes, size: int) -> bytes:
+        return _zstd.decompress(data)
+
+    def _zstd_compress(data: bytes, level: int = 3) -> bytes:
+        return _zstd.compress(data, level=level)
+
+except ImportError:  # pragma: nocover
+    try:
+        import zstandard as _zstandard  # type: ignore
+
+        def _zstd_decompress(data: bytes, size: int) -> bytes:
+            return _zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+
+        def _zstd_compress(data: bytes, level: int = 3) -> bytes:
+            return _zstandard.ZstdCompressor(level=level).compress(data)
+
+    except ImportError:
+        _zstd_decompress = None  # type: ignore
+        _zstd_compress = None  # type: ignore
+
+try:
+    import lz4.frame as _lz4  # type: ignore
+
+    def _lz4_decompress(data: bytes, size: int) -> bytes:
+        return _lz4.decompress(data)
+
+except ImportError:
+    _lz4_decompress = None  # type: ignore
+
+MAGIC = b"\x89MCAP0\r\n"
+
+OP_HEADER = 0x01
+OP_FOOTER = 0x02
+OP_SCHEMA = 0x03
+OP_CHANNEL = 0x04
+OP_MESSAGE = 0x05
+OP_CHUNK = 0x06
+OP_MESSAGE_INDEX = 0x07
+OP_CHUNK_INDEX = 0x08
+OP_ATTACHMENT = 0x09
+OP_ATTACHMENT_INDEX = 0x0A
+OP_STATISTICS = 0x0B
+OP_METADATA = 0x0C
+OP_METADATA_INDEX = 0x0D
+OP_SUMMARY_OFFSET = 0x0E
+OP_DATA_END = 0x0F
+
+# Records are buffered whole, skip the unreasonably large ones
+MAX_RECORD_SIZE = 256 << 20
+
+_RECORD_HEADER = struct.Struct("<BQ")
+# Opcode, length, summary start, summary offset start and CRC
+_FOOTER = struct.Struct("<BQQQI")
+
+
+class Schema:
+    """A MCAP schema, e.g. the definition of a ROS 2 message type."""
+
+    def __init__(self, schema_id: int, name: str, encoding: str, data: bytes = b""):
+        self.id = schema_id
+        self.name = name
+        self.encoding = encoding
+        self.data = data
+
+
+class Channel:
+    """A MCAP channel, e.g. a ROS 2 topic."""
+
+    def __init__(
+        self,
+        channel_id: int,
+        topic: str,
+        schema: Optional[Schema],
+        encoding: str,
+        metadata: Optional[Dict[str, str]] = None,
+    ):
+        self.id = channel_id
+        self.topic = topic
+        self.schema = schema
+        self.encoding = encoding
+        self.metadata = metadata or {}
+        self.message_count = 0
+
+    @property
+    def type(self) -> str:
+        """Return the name of the message type of the channel."""
+        return self.schema.name if self.schema else ""
+
+
+def _string(data, offset: int):
+    (length,) = struct.unpack_from("<I", data, offset)
+    offset += 4
+    return bytes(data[offset : offset + length]).decode(errors="replace"), offset + length
+
+
+class ChunkInfo:
+    """Where a chunk of messages is in a MCAP file, and what it holds.
+
+    Attributes:
+        start: log time of the first message of the chunk, in nanoseconds.
+        end: log time of the last message of the chunk, in nanoseconds.
+        offset: offset of the chunk record in the file.
+        length: length of the chunk record.
+        channels: ids of the channels with messages in the chunk, empty if unknown.
+        compression: compression of the chunk records, empty if none.
+        uncompressed_size: size of the chunk records, once uncompressed.
+    """
+
+    def __init__(
+        self,
+        start: int,
+        end: int,
+        offset: int,
+        length: int,
+        channels: Optional[Set[int]] = None,
+        compression: str = "",
+        uncompressed_size: int = 0,
+    ):
+        self.start = start
+        self.end = end
+        self.offset = offset
+        self.length = length
+        self.channels = channels if channels is not None else set()
+        self.compression = compression
+        self.uncompressed_size = uncompressed_size
+
+
+def _string_map(data, offset: int) -> Dict[str, str]:
+    (length,) = struct.unpack_from("<I", data, offset)
+    offset += 4
+    end = offset + length
+    values = {}
+    while offset < end:
+        key, offset = _string(data, offset)
+        values[key], offset = _string(data, offset)
+    return values
+
+
+def _pack_string(value: str) -> bytes:
+    encoded = value.encode()
+    return struct.pack("<I", len(encoded)) + encoded
+
+
+def _pack_map(entries: Union[bytes, bytearray]) -> bytes:
+    return struct.pack("<I", len(entries)) + entries
+
+
+def _pack_record(opcode: int, content: bytes) -> bytes:
+    return _RECORD_HEADER.pack(opcode, len(content)) + content
+
+
+def _schema(data, offset: int) -> Schema:
+    """Decode the schema record starting at `offset`, after its record header."""
+    (schema_id,) = struct.unpack_from("<H", data, offset)
+    name, offset = _string(data, offset + 2)
+    encoding, offset = _string(data, offset)
+    (length,) = struct.unpack_from("<I", data, offset)
+    return Schema(schema_id, name, encoding, bytes(data[offset + 4 : offset + 4 + length]))
+
+
+def _channel(data, offset: int, schemas: Dict[int, Schema]) -> Channel:
+    """Decode the channel record starting at `offset`, after its record header."""
+    channel_id, schema_id = struct.unpack_from("<HH", data, offset)
+    topic, offset = _string(data, offset + 4)
+    encoding, offset = _string(data, offset)
+    return Channel(channel_id, topic, schemas.get(schema_id), encoding, _string_map(data, offset))
+
+
+class McapStream(ScanConsumer):
+    """Parse the records of a MCAP file fed in order.
+
+    Args:
+        on_message: called with the channel, log time and data of every
+            message, unless it is only interested in some channels, as
+            returned by `wants`.
+        wants: whether messages of a channel are of interest, all by default.
+    """
+
+    # Records passed to `_record`, others larger than 64 KiB are skipped unread
+    parsed = (OP_SCHEMA, OP_CHANNEL, OP_MESSAGE, OP_CHUNK)
+
+    def __init__(
+        self,
+        on_message: Callable[[Channel, int, bytes], None],
+        wants: Optional[Callable[[Channel], bool]] = None,
+    ):
+        self.on_message = on_message
+        self.wants = wants or (lambda channel: True)
+        self.schemas: Dict[int, Schema] = {}
+        self.channels: Dict[int, Channel] = {}
+        self.skipped_chunks = 0
+        self.skipped_records = 0
+        self._wanted: Dict[int, bool] = {}
+        self._pending = bytearray()
+        self._skip = 0
+        self._started = False
+
+    def update(self, offset: int, chunk: memoryview) -> None:
+        """Parse the records completed by the chunk of the file."""
+        if self._skip:
+            skipped = min(self._skip, len(chunk))
+            self._skip -= skipped
+            chunk = chunk[skipped:]
+        self._pending += chunk
+        position = 0
+        if not self._started:
+            if len(self._pending) < len(MAGIC):
+                return
+            position = len(MAGIC)
+            self._started = True
+
+        pending = memoryview(self._pending)
+        error = None
+        try:
+            while len(pending) - position >= _RECORD_HEADER.size:
+                opcode, length = _RECORD_HEADER.unpack_from(pending, position)
+                start = position + _RECORD_HEADER.size
+                if length > MAX_RECORD_SIZE or (opcode not in self.parsed and length > 1 << 16):
+                    # Skip the record without buffering it
+                    if opcode in self.parsed:
+                        self.skipped_records += 1
+                    available = len(pending) - start
+                    if available < length:
+                        self._skip = length - available
+                        position = len(pending)
+                        break
+                    position = start + length
+                    continue
+                if len(pending) - start < length:
+                    break
+                self._record(opcode, pending[start : start + length])
+                position = start + length
+        except struct.error as e:
+            # Not raised from here, its traceback holds views of the buffer
+            error = str(e)
+        pending.release()
+        del self._pending[:position]
+        if error is not None:
+            raise CorruptFile(f"Invalid MCAP record: {error}")
+
+    def _record(self, opcode: int, content: memoryview) -> None:
+        if opcode == OP_MESSAGE:
+            channel_id, _, log_time, _ = struct.unpack_from("<HIQQ", content)
+            channel = self.channels.get(channel_id)
+            if channel is None:
+                return
+            channel.message_count += 1
+            if self._wanted.get(channel_id):
+                self.on_message(channel, log_time, bytes(content[22:]))
+        elif opcode == OP_CHUNK:
+            self._chunk(content)
+        elif opcode == OP_SCHEMA:
+            schema = _schema(content, 0)
+            self.schemas[schema.id] = schema
+        elif opcode == OP_CHANNEL:
+            channel = _channel(content, 0, self.schemas)
+            if channel.id not in self.channels:
+                self.channels[channel.id] = channel
+                self._wanted[channel.id] = self.wants(channel)
+
+    def _chunk(self, content: memoryview) -> None:
+        _, _, size, _ = struct.unpack_from("<QQQI", content)
+        compression, offset = _string(content, 28)
+        (length,) = struct.unpack_from("<Q", content, offset)
+        records = content[offset + 8 : offset + 8 + length]
+        if compression == "zstd" and _zstd_decompress is not None:
+            records = memoryview(_zstd_decompress(bytes(records), size))
+        elif compression == "lz4" and _lz4_decompress is not None:
+            records = memoryview(_lz4_decompress(bytes(records), size))
+        elif compression:
+            self.skipped_chunks += 1
+            return
+
+        position = 0
+        while position + _RECORD_HEADER.size <= len(records):
+            opcode, length = _RECORD_HEADER.unpack_from(records, position)
+            start = position + _RECORD_HEADER.size
+            self._record(opcode, records[start : start + length])
+            position = start + length
+
+
+class McapIndex:
+    """The schemas, channels and chunks of a MCAP file, read from a memory map.
+
+    Records are decoded in place in the map, so that only the pages holding
+    the summary are read from the storage, or the record headers of the data
+    section for a file without summary, e.g. a recording cut short. Chunks
+    are skipped over, never read, and memory stays flat however large the
+    file is.
+
+    Attributes:
+        schemas: schemas of the file, by id.
+        channels: channels of the file, by id.
+        chunks: chunks of the file, in order.
+        indexed: whether the chunks come from the summary of the file.
+
+    Raises:
+        CorruptFile: if the file is not a MCAP file.
+    """
+
+    def __init__(self, f):
+        self.schemas: Dict[int, Schema] = {}
+        self.channels: Dict[int, Channel] = {}
+        self.chunks: List[ChunkInfo] = []
+        self.indexed = False
+
+        size = os.fstat(f.fileno()).st_size
+        if size < len(MAGIC):
+            raise CorruptFile("Not a MCAP file")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mmap, "MADV_RANDOM"):
+                # No read-ahead of the chunks skipped over
+                mapped.madvise(mmap.MADV_RANDOM)
+            if mapped[: len(MAGIC)] != MAGIC:
+                raise CorruptFile("Not a MCAP file")
+            try:
+                data_end = self._read_summary(mapped, size)
+                if not self.indexed:
+                    self._read_records(mapped, len(MAGIC), data_end)
+            except struct.error as e:
+                raise CorruptFile(f"Invalid MCAP record: {e}")
+
+    def _read_summary(self, mapped: mmap.mmap, size: int) -> int:
+        """Read the summary, return where the data section ends."""
+        footer_offset = size - len(MAGIC) - _FOOTER.size
+        if footer_offset < len(MAGIC) or mapped[size - len(MAGIC) :] != MAGIC:
+            return size
+        opcode, _, summary_start, _, _ = _FOOTER.unpack_from(mapped, footer_offset)
+        if opcode != OP_FOOTER:
+            return size
+        if not len(MAGIC) <= summary_start <= footer_offset:
+            return footer_offset
+        self._read_records(mapped, summary_start, footer_offset)
+        self.indexed = bool(self.chunks)
+        return summary_start
+
+    def _read_records(self, mapped: mmap.mmap, position: int, end: int) -> None:
+        while position + _RECORD_HEADER.size <= end:
+            opcode, length = _RECORD_HEADER.unpack_from(mapped, position)
+            start = position + _RECORD_HEADER.size
+            if start + length > end or opcode == OP_DATA_END:
+                # Truncated, or the end of the data section
+                return
+            if opcode == OP_SCHEMA:
+                schema = _schema(mapped, start)
+                self.schemas[schema.id] = schema
+            elif opcode == OP_CHANNEL:
+                channel = _channel(mapped, start, self.schemas)
+                self.channels.setdefault(channel.id, channel)
+            elif opcode == OP_CHUNK:
+                chunk_start, chunk_end, size = struct.unpack_from("<QQQ", mapped, start)
+                compression, _ = _string(mapped, start + 28)
+                self.chunks.append(
+                    ChunkInfo(
+                        chunk_start,
+                        chunk_end,
+                        position,
+                        start + length - position,
+                        compression=compression,
+                        uncompressed_size=size,
+                    )
+                )
+            elif opcode == OP_MESSAGE_INDEX:
+                # Follows its chunk
+                if self.chunks:
+                    self.chunks[-1].channels.add(struct.unpack_from("<H", mapped, start)[0])
+            elif opcode == OP_CHUNK_INDEX:
+                chunk_start, chunk_end, offset, chunk_length, entries = struct.unpack_from(
+                    "<QQQQI", mapped, start
+                )
+                channels = {
+                    struct.unpack_from("<H", mapped, entry)[0]
+                    for entry in range(start + 36, start + 36 + entries, 10)
+                }
+                # After the length of the message indexes
+                compression, end_offset = _string(mapped, start + 36 + entries + 8)
+                (size,) = struct.unpack_from("<Q", mapped, end_offset + 8)
+                self.chunks.append(
+                    ChunkInfo(
+                        chunk_start, chunk_end, offset, chunk_length, channels, compression, size
+                    )
+                )
+            position = start + length
+
+
+def can_read_chunks(compression: str) -> bool:
+    """Whether the records of chunks compressed with `compression` can be read."""
+    if compression == "zstd":
+        return _zstd_decompress is not None
+    if compression == "lz4":
+        return _lz4_decompress is not None
+    return not compression
+
+
+def can_compress_chunks() -> bool:
+    """Whether `McapWriter` compresses the chunks it writes."""
+    return _zstd_compress is not None
+
+
+def footer_without_summary() -> bytes:
+    """Return the end of a MCAP file without summary, with a data CRC of 0, "not computed"."""
+    return (
+        _pack_record(OP_DATA_END, struct.pack("<I", 0))
+        + _FOOTER.pack(OP_FOOTER, _FOOTER.size - _RECORD_HEADER.size, 0, 0, 0)
+        + MAGIC
+    )
+
+
+class McapWriter:
+    """Write an indexed MCAP file, with the summary players need to seek in it.
+
+    Args:
+        f: file opened for writing.
+        profile: profile of the file, e.g. `ros2`.
+        chunk_size: size of the chunks of messages, before compression.
+        level: zstd compression level of the chunks.
+    """
+
+    def __init__(self, f, profile: str = "ros2", chunk_size: int = 1 << 20, level: int = 3):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.level = level
+        self.compression = "zstd" if _zstd_compress is not None else ""
+        self._position = 0
+        self._crc = 0
+        self._schemas: Dict[int, bytes] = {}
+        self._channels: Dict[int, bytes] = {}
+        self._channel_counts: Dict[int, int] = {}
+        self._chunk_indexes: List[bytes] = []
+        self._attachment_indexes: List[bytes] = []
+        self._metadata_indexes: List[bytes] = []
+        self._chunk = bytearray()
+        self._chunk_indexes_by_channel: Dict[int, bytearray] = {}
+        self._chunk_times: List[int] = []
+        self._times: List[int] = []
+        self._write(MAGIC)
+        self._write(_pack_record(OP_HEADER, _pack_string(profile) + _pack_string("bagstore")))
+
+    def _write(self, data: bytes) -> None:
+        self.f.write(data)
+        self._crc = zlib.crc32(data, self._crc)
+        self._position += len(data)
+
+    def add_schema(self, schema: Schema) -> None:
+        """Write a schema, once."""
+        if schema.id in self._schemas:
+            return
+        record = _pack_record(
+            OP_SCHEMA,
+            struct.pack("<H", schema.id)
+            + _pack_string(schema.name)
+            + _pack_string(schema.encoding)
+            + struct.pack("<I", len(schema.data))
+            + schema.data,
+        )
+        self._schemas[schema.id] = record
+        self._write(record)
+
+    def add_channel(self, channel: Channel) -> None:
+        """Write a channel and its schema, once."""
+        if channel.id in self._channels:
+            return
+        if channel.schema is not None:
+            self.add_schema(channel.schema)
+        metadata = b"".join(
+            _pack_string(key) + _pack_string(value) for key, value in channel.metadata.items()
+        )
+        record = _pack_record(
+            OP_CHANNEL,
+            struct.pack("<HH", channel.id, channel.schema.id if channel.schema else 0)
+            + _pack_string(channel.topic)
+            + _pack_string(channel.encoding)
+            + _pack_map(metadata),
+        )
+        self._channels[channel.id] = record
+        self._channel_counts[channel.id] = 0
+        self._write(record)
+
+    def write_message(
+        self,
+        channel: Channel,
+        log_time: int,
+        publish_time: int,
+        data,
+        sequence: Optional[int] = None,
+    ) -> None:
+        """Write a message of a channel, numbered in sequence unless given."""
+        self.add_channel(channel)
+        if sequence is None:
+            sequence = self._channel_counts[channel.id]
+        self._channel_counts[channel.id] += 1
+        index = self._chunk_indexes_by_channel.setdefault(channel.id, bytearray())
+        index += struct.pack("<QQ", log_time, len(self._chunk))
+        self._chunk += _RECORD_HEADER.pack(OP_MESSAGE, 22 + len(data))
+        self._chunk += struct.pack("<HIQQ", channel.id, sequence, log_time, publish_time)
+        self._chunk += data
+        self._chunk_times.append(log_time)
+        if len(self._chunk) >= self.chunk_size:
+            self._flush_chunk()
+
+    def write_record(self, opcode: int, content) -> None:
+        """Write a record outside of the chunks as is, indexed if an attachment or metadata."""
+        offset = self._position
+        self._write(_pack_record(opcode, bytes(content)))
+        length = self._position - offset
+        try:
+            if opcode == OP_ATTACHMENT:
+                log_time, create_time = struct.unpack_from("<QQ", content)
+                name, position = _string(content, 16)
+                media_type, position = _string(content, position)
+                (size,) = struct.unpack_from("<Q", content, position)
+                self._attachment_indexes.append(
+                    _pack_record(
+                        OP_ATTACHMENT_INDEX,
+                        struct.pack("<QQQQQ", offset, length, log_time, create_time, size)
+                        + _pack_string(name)
+                        + _pack_string(media_type),
+                    )
+                )
+            elif opcode == OP_METADATA:
+                name, _ = _string(content, 0)
+                self._metadata_indexes.append(
+                    _pack_record(
+                        OP_METADATA_INDEX, struct.pack("<QQ", offset, length) + _pack_string(name)
+                    )
+                )
+        except struct.error:
+            # Copied as is, but not indexed
+            logger.debug("Invalid MCAP record of opcode %#x", opcode)
+
+    def _flush_chunk(self) -> None:
+        if not self._chunk:
+            return
+        records = bytes(self._chunk)
+        compressed = _zstd_compress(records, self.level) if self.compression else records
+        start, end = min(self._chunk_times), max(self._chunk_times)
+        chunk_start = self._position
+        self._write(
+            _pack_record(
+                OP_CHUNK,
+                struct.pack("<QQQI", start, end, len(records), zlib.crc32(records))
+                + _pack_string(self.compression)
+                + struct.pack("<Q", len(compressed))
+                + compressed,
+            )
+        )
+        chunk_length = self._position - chunk_start
+
+        offsets = bytearray()
+        index_start = self._position
+        for channel_id, entries in sorted(self._chunk_indexes_by_channel.items()):
+            offsets += struct.pack("<HQ", channel_id, self._position)
+            self._write(
+                _pack_record(OP_MESSAGE_INDEX, struct.pack("<H", channel_id) + _pack_map(entries))
+            )
+        self._chunk_indexes.append(
+            _pack_record(
+                OP_CHUNK_INDEX,
+                struct.pack("<QQQQ", start, end, chunk_start, chunk_length)
+                + _pack_map(offsets)
+                + struct.pack("<Q", self._position - index_start)
+                + _pack_string(self.compression)
+                + struct.pack("<QQ", len(compressed), len(records)),
+            )
+        )
+        self._times += (start, end)
+        self._chunk = bytearray()
+        self._chunk_indexes_by_channel = {}
+        self._chunk_times = []
+
+    def finish(self) -> None:
+        """Write the last chunk, the summary and the footer."""
+        self._flush_chunk()
+        self._write(_pack_record(OP_DATA_END, struct.pack("<I", self._crc)))
+
+        summary_start = self._position
+        self._crc = 0
+        statistics = _pack_record(
+            OP_STATISTICS,
+            struct.pack(
+                "<QHIIIIQQ",
+                sum(self._channel_counts.values()),
+                len(self._schemas),
+                len(self._channels),
+                len(self._attachment_indexes),
+                len(self._metadata_indexes),
+                len(self._chunk_indexes),
+                min(self._times, default=0),
+                max(self._times, default=0),
+            )
+            + _pack_map(
+                b"".join(
+                    struct.pack("<HQ", *item) for item in sorted(self._channel_counts.items())
+                )
+            ),
+        )
+        groups = []
+        for opcode, records in (
+            (OP_SCHEMA, list(self._schemas.values())),
+            (OP_CHANNEL, list(self._channels.values())),
+            (OP_STATISTICS, [statistics]),
+            (OP_CHUNK_INDEX, self._chunk_indexes),
+            (OP_ATTACHMENT_INDEX, self._attachment_indexes),
+            (OP_METADATA_INDEX, self._metadata_indexes),
+        ):
+            if records:
+                group_start = self._position
+                self._write(b"".join(records))
+                groups.append((opcode, group_start, self._position - group_start))
+        summary_offset_start = self._position
+        for group in groups:
+            self._write(_pack_record(OP_SUMMARY_OFFSET, struct.pack("<BQQ", *group)))
+        footer = _RECORD_HEADER.pack(OP_FOOTER, 20) + struct.pack(
+            "<QQ", summary_start, summary_offset_start
+        )
+        self._write(footer + struct.pack("<I", zlib.crc32(footer, self._crc)))
+        self._write(MAGIC)
+
+
+class CdrReader:
+    """Read the fields of a CDR serialized ROS 2 message, in order."""
+
+    def __init__(self, data):
+        self.data = data
+        if bytes(data[:2]) not in (b"\x00\x01", b"\x00\x03"):
+            raise ValueError("Only little endian CDR is supported")
+        # Alignment is relative to the end of the encapsulation header
+        self.offset = 4
+
+    def _unpack(self, fmt: str, size: int):
+        self.offset += -(self.offset - 4) % size
+        values = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+
+    def uint8(self) -> int:
+        """Read a uint8."""
+        return self._unpack("<B", 1)[0]
+
+    def uint32(self) -> int:
+        """Read a uint32."""
+        return self._unpack("<I", 4)[0]
+
+    def float64(self, count: int = 1):
+        """Read float64 values, a tuple of `count` of them."""
+        return self._unpack(f"<{count}d", 8)
+
+    def string(self) -> str:
+        """Read a string."""
+        length = self.uint32()
+        value = bytes(self.data[self.offset : self.offset + length]).rstrip(b"\x00")
+        self.offset += length
+        return value.decode(errors="replace")
+
+    def bytes(self) -> memoryview:
+        """Read a sequence of uint8."""
+        length = self.uint32()
+        value = self.data[self.offset : self.offset + length]
+        self.offset += length
+        return value
+
+    def header(self) -> str:
+        """Read a std_msgs/msg/Header, return its frame id."""
+        self._unpack("<iI", 4)
+        return self.string()
+
+
+class CdrWriter:
+    """Write the fields of a CDR serialized ROS 2 message, in order.
+
+    Args:
+        prefix: serialized start of the message, including the encapsulation
+            header, e.g. copied from the message it is derived from.
+    """
+
+    def __init__(self, prefix: bytes = b"\x00\x01\x00\x00"):
+        self.data = bytearray(prefix)
+
+    def _pack(self, fmt: str, size: int, *values) -> "CdrWriter":
+        self.data += bytes(-(len(self.data) - 4) % size)
+        self.data += struct.pack(fmt, *values)
+        return self
+
+    def uint8(self, value: int) -> "CdrWriter":
+        """Write a uint8."""
+        return self._pack("<B", 1, value)
+
+    def uint32(self, value: int) -> "CdrWriter":
+        """Write a uint32."""
+        return self._pack("<I", 4, value)
+
+    def string(self, value: str) -> "CdrWriter":
+        """Write a string."""
+        encoded = value.encode() + b"\x00"
+        self.uint32(len(encoded))
+        self.data += encoded
+        return self
+
+    def bytes(self, value) -> "CdrWriter":
+        """Write a sequence of uint8."""
+        self.uint32(len(value))
+        self.data += value
+        return self
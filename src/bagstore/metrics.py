@@ -0,0 +1,69 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Metrics of the uploads and of the background work, for Prometheus.
+
+`MetricsServer` serves, at `GET /metrics` of its own port, the queue depth and
+the active uploads of the admission, over SSH and HTTP alike, the usage of the
+storage, the decisions of the resource scheduler and the progress of the time
+index catch-up. It runs along any other bagstore service, and is not reverse
+proxied by Caddy, so that the metrics are never published through the ingress.
+"""
+
+import logging
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Tuple
+
+from bagstore.admission import Admission
+from bagstore.catchup import progress_metrics, read_progress
+from bagstore.scheduler import decision_metrics, read_decision
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serve the metrics in the Prometheus text format."""
+
+    protocol_version = "HTTP/1.1"
+    server: "MetricsServer"  # pyright: ignore[reportIncompatibleVariableOverride]
+
+    def log_message(self, format, *args):
+        """Log requests through logging rather than stderr."""
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def do_GET(self):  # noqa: N802
+        """Return the metrics."""
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        content = self.server.metrics().encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """HTTP server of the metrics of the uploads and of the background work.
+
+    Args:
+        address: address to listen on.
+        admission: admission of the uploads, holding the storage root.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], admission: Admission):
+        self.admission = admission
+        super().__init__(address, MetricsRequestHandler)
+
+    def metrics(self) -> str:
+        """Return the metrics, in the Prometheus text format."""
+        root = self.admission.root
+        return (
+            self.admission.metrics()
+            + decision_metrics(read_decision(root))
+            + progress_metrics(read_progress(root))
+        )
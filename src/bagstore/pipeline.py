@@ -0,0 +1,527 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Single-pass post-upload processing of the completed bags.
+
+Indexing, checksumming, verification, previews, compression... each want to
+read every new bag, which would multiply the disk I/O if done separately. The
+pipeline reads every file of a completed bag once, into a bounded pool of
+reusable buffers, and feeds the buffers to the consumers the registered
+`Stage`s return for the file. Consumers run concurrently, each in its own
+thread, and the reader waits for a free buffer when the slowest one lags
+behind, so memory stays bounded to `workers * buffers * buffer_size`.
+
+Completed bags are queued as jobs in the bag index, so that the queue
+survives restarts. They are found under the directories uploads completed
+to, and by a full walk of the storage from time to time (see
+`bagstore.layout.UploadWatch`), and a bounded pool of workers processes them, highest
+priority first, at the pace the resource scheduler sets, if any (see
+`bagstore.scheduler`). Every processed file is recorded in the index with its
+SHA-256, which the pipeline computes for every file.
+
+The SHA-256 is also written next to the file, as `<name>.sha256`, where
+Caddy reads it as the ETag of the file. Its presence marks the file as
+final, served as immutable, so it is removed before an upload replaces the
+file, and whenever the pipeline finds the file changed. With `recompression`,
+the ETags of the MCAP files are left to the recompression, which may still
+rewrite them (see `bagstore.recompress`).
+"""
+
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Sequence
+
+from bagstore.admission import PRIORITIES, Admission, load_limits, upload_priority
+from bagstore.index import JOB_FAILED, STATUS_CORRUPT, STATUS_OK, BagIndex
+from bagstore.layout import (
+    BAG_METADATA_FILE,
+    UploadWatch,
+    is_bag_complete,
+    read_bag_metadata,
+)
+
+if TYPE_CHECKING:
+    from bagstore.scheduler import Throttle
+
+logger = logging.getLogger(__name__)
+
+DATA_FILE_SUFFIXES = (".mcap", ".db3")
+# Suffix of the ETag of a processed file, written next to it
+ETAG_SUFFIX = ".sha256"
+
+
+class CorruptFile(Exception):
+    """The content of a file is not valid."""
+
+
+class ScanConsumer:
+    """Consumer of the content of a file, streamed once from the disk."""
+
+    def update(self, offset: int, chunk: memoryview) -> None:
+        """Consume the chunk of the file read at `offset`."""
+
+    def finish(self) -> None:
+        """Check what was consumed once the whole file is read.
+
+        Raises:
+            CorruptFile: if the file is not valid.
+        """
+
+
+class Checksum(ScanConsumer):
+    """SHA-256 of the whole file."""
+
+    def __init__(self):
+        self.hash = hashlib.sha256()
+
+    def update(self, offset: int, chunk: memoryview) -> None:
+        """Hash the chunk."""
+        self.hash.update(chunk)
+
+    @property
+    def hexdigest(self) -> str:
+        """Return the checksum of the file."""
+        return self.hash.hexdigest()
+
+
+def write_etag(path: str, sha256: str) -> None:
+    """Write the ETag of a processed file next to it, for Caddy to serve.
+
+    It keeps the mtime of the file, not to make the bag look changed.
+    """
+    etag_path = path + ETAG_SUFFIX
+    stat = os.stat(path)
+    with open(etag_path + ".tmp", "w") as f:
+        f.write(f'"{sha256}"')
+    os.utime(etag_path + ".tmp", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(etag_path + ".tmp", etag_path)
+
+
+def remove_etag(path: str) -> None:
+    """Remove the ETag of a file, which is not final anymore."""
+    try:
+        os.remove(path + ETAG_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+
+def remove_stale_etags(path: str) -> int:
+    """Remove the ETags of the files under `path` that changed since they were written.
+
+    An ETag has the mtime of its file, see `write_etag`.
+
+    Returns:
+        the number of ETags removed.
+    """
+    removed = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        for name in filenames:
+            if not name.endswith(ETAG_SUFFIX):
+                continue
+            etag_path = os.path.join(dirpath, name)
+            try:
+                stale = os.stat(etag_path[: -len(ETAG_SUFFIX)]).st_mtime_ns != (
+                    os.stat(etag_path).st_mtime_ns
+                )
+            except FileNotFoundError:
+                stale = True
+            if stale:
+                remove_etag(etag_path[: -len(ETAG_SUFFIX)])
+                removed += 1
+    return removed
+
+
+class BagJob:
+    """A completed bag going through the pipeline.
+
+    Attributes:
+        bag: path of the bag directory, relative to the storage root.
+        bag_dir: absolute path of the bag directory.
+        checksums: SHA-256 of the processed files, by file name.
+        problems: why the bag is corrupt, if it is.
+        quarantined: whether a stage moved the bag away.
+    """
+
+    def __init__(self, root: str, bag: str):
+        self.bag = bag
+        self.bag_dir = os.path.join(root, bag)
+        self.checksums: Dict[str, str] = {}
+        self.problems: List[str] = []
+        self.quarantined = False
+
+
+class Stage:
+    """A processing stage, fed with the content of the files of every completed bag."""
+
+    name = ""
+
+    def consumers(self, job: BagJob, path: str, f, size: int) -> List[ScanConsumer]:
+        """Return the consumers of a file of the bag, opened as `f`.
+
+        Raises:
+            CorruptFile: if the file is known to be corrupt without reading it.
+        """
+        return []
+
+    def finish(self, job: BagJob) -> None:
+        """Complete the processing of the bag, once all its files are read."""
+
+    def refresh(self) -> None:
+        """Update what spans all the bags, once the queue is processed."""
+
+
+class _Buffer:
+    """A buffer of the pool, back to the pool once every consumer is done with it."""
+
+    def __init__(self, pool: "BufferPool", size: int):
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.offset = 0
+        self.length = 0
+        self._pool = pool
+        self._references = 0
+        self._lock = threading.Lock()
+
+    @property
+    def chunk(self) -> memoryview:
+        return self.view[: self.length]
+
+    def retain(self, count: int) -> None:
+        self._references = count
+
+    def release(self) -> None:
+        with self._lock:
+            self._references -= 1
+            if self._references > 0:
+                return
+        self._pool.put(self)
+
+
+class BufferPool:
+    """A fixed number of reusable read buffers."""
+
+    def __init__(self, count: int, size: int):
+        self._free: "queue.Queue[_Buffer]" = queue.Queue()
+        for _ in range(count):
+            self._free.put(_Buffer(self, size))
+
+    def get(self) -> _Buffer:
+        """Return a free buffer, waiting for one to be released if needed."""
+        return self._free.get()
+
+    def put(self, buffer: _Buffer) -> None:
+        """Give a buffer back to the pool."""
+        self._free.put(buffer)
+
+
+def read_buffers(f, pool: BufferPool) -> Iterator[_Buffer]:
+    """Yield the content of a file, in buffers of the pool."""
+    offset = 0
+    while True:
+        # Blocks while the consumers still hold every buffer: backpressure
+        buffer = pool.get()
+        read = f.readinto(buffer.data)
+        if not read:
+            pool.put(buffer)
+            return
+        buffer.offset = offset
+        buffer.length = read
+        offset += read
+        yield buffer
+
+
+class _ConsumerThread(threading.Thread):
+    def __init__(self, consumer: ScanConsumer):
+        super().__init__(daemon=True)
+        self.consumer = consumer
+        self.buffers: "queue.Queue[Optional[_Buffer]]" = queue.Queue()
+        self.error: Optional[BaseException] = None
+
+    def run(self) -> None:
+        while (buffer := self.buffers.get()) is not None:
+            try:
+                if self.error is None:
+                    self.consumer.update(buffer.offset, buffer.chunk)
+            except BaseException as e:  # noqa: B036
+                self.error = e
+            finally:
+                buffer.release()
+
+
+def scan_file(f, consumers: Sequence[ScanConsumer], pool: BufferPool) -> int:
+    """Stream a file once to all the consumers, concurrently.
+
+    Returns:
+        the number of bytes read.
+
+    Raises:
+        CorruptFile: if a consumer found the file is not valid.
+    """
+    threads = [_ConsumerThread(consumer) for consumer in consumers]
+    for thread in threads:
+        thread.start()
+    size = 0
+    try:
+        for buffer in read_buffers(f, pool):
+            buffer.retain(len(threads))
+            for thread in threads:
+                thread.buffers.put(buffer)
+            size += buffer.length
+    finally:
+        for thread in threads:
+            thread.buffers.put(None)
+        for thread in threads:
+            thread.join()
+
+    for thread in threads:
+        if thread.error is not None:
+            raise thread.error
+    for consumer in consumers:
+        consumer.finish()
+    return size
+
+
+def is_bag_file(name: str) -> bool:
+    """Whether the pipeline processes the file of a bag: its data and metadata."""
+    return name.endswith(DATA_FILE_SUFFIXES) or name == BAG_METADATA_FILE
+
+
+def iter_bags(root: str) -> Iterator[str]:
+    """Yield every bag directory on the storage, skipping hidden directories."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        if BAG_METADATA_FILE in filenames and dirpath != root:
+            dirnames[:] = []
+            yield dirpath
+
+
+def _modified_since(paths: List[str], when: float) -> bool:
+    """Whether any of the files was written after `when`, or is gone."""
+    for path in paths:
+        try:
+            # Not the mtime, that rsync sets to the one of the source
+            if os.stat(path).st_ctime > when:
+                return True
+        except OSError:
+            return True
+    return False
+
+
+class Pipeline:
+    """Process every completed bag once, through the registered stages.
+
+    Args:
+        root: storage root served by Caddy.
+        index: index of the files, also holding the job queue.
+        stages: stages to feed the files to, in order.
+        workers: number of bags processed at the same time.
+        buffers: number of read buffers of every worker.
+        buffer_size: size of the read buffers.
+        settle_seconds: how long a bag must be left untouched to be processed.
+        admission: admission of the uploads, to yield to high priority ones.
+        throttle: pace of the reads set by the resource scheduler, if any.
+        recompression: whether the recompression writes the ETags of the MCAP files, which
+            it only does when it can compress them.
+        uploads: uploads to find the completed bags from, between full walks.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        index: BagIndex,
+        stages: Sequence[Stage],
+        workers: int = 2,
+        buffers: int = 8,
+        buffer_size: int = 1 << 20,
+        settle_seconds: float = 60.0,
+        admission: Optional[Admission] = None,
+        throttle: Optional["Throttle"] = None,
+        recompression: bool = False,
+        uploads: Optional[UploadWatch] = None,
+    ):
+        self.root = root
+        self.index = index
+        self.stages = list(stages)
+        self.workers = workers
+        self.buffers = buffers
+        self.buffer_size = buffer_size
+        self.settle_seconds = settle_seconds
+        self.admission = admission
+        self.throttle = throttle
+        self.recompression = recompression
+        self.uploads = uploads
+        # Jobs interrupted by a restart are queued again
+        self.index.requeue_running_jobs()
+
+    def _relpath(self, path: str) -> str:
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def _is_final(self, path: str) -> bool:
+        """Whether a processed file will not be rewritten, so can have its ETag."""
+        # Imported here, bagstore.mcap builds on this module
+        from bagstore.mcap import can_compress_chunks
+
+        return not (self.recompression and path.endswith(".mcap") and can_compress_chunks())
+
+    def _pending_files(self, bag_dir: str) -> List[str]:
+        """Return the files of a bag that are not processed yet."""
+        pending = []
+        with os.scandir(bag_dir) as entries:
+            for entry in entries:
+                if not is_bag_file(entry.name) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                relpath = self._relpath(entry.path)
+                if not self.index.is_current(relpath, stat.st_size, stat.st_mtime):
+                    remove_etag(entry.path)
+                    pending.append(entry.path)
+        return sorted(pending)
+
+    def restore_etags(self) -> int:
+        """Write the missing ETags of the processed files, e.g. of those processed before them.
+
+        Returns:
+            the number of ETags written.
+        """
+        written = 0
+        for row in self.index.files(STATUS_OK):
+            path = os.path.join(self.root, row["path"])
+            try:
+                stat = os.stat(path)
+                if os.path.exists(path + ETAG_SUFFIX) or row["sha256"] is None:
+                    continue
+                if not self._is_final(path) and not self.index.is_recompressed(
+                    row["path"], stat.st_size, stat.st_mtime
+                ):
+                    continue
+                if (row["size"], row["mtime"]) == (stat.st_size, stat.st_mtime):
+                    write_etag(path, row["sha256"])
+                    written += 1
+            except OSError:
+                # Moved or deleted since it was processed
+                continue
+        return written
+
+    def discover(self, full: bool = True) -> int:
+        """Queue the completed bags with files not processed yet.
+
+        Args:
+            full: whether to walk the storage, rather than look at the uploads only.
+
+        Returns:
+            the number of bags queued.
+        """
+        limits = self.admission.limits if self.admission else load_limits(None)
+        now = time.time()
+        queued = 0
+        bag_dirs = self.uploads.bags() if self.uploads and not full else iter_bags(self.root)
+        for bag_dir in bag_dirs:
+            bag = self._relpath(bag_dir)
+            job = self.index.job(bag)
+            if job and job["state"] != JOB_FAILED:
+                if self.uploads:
+                    self.uploads.done(bag_dir)
+                continue
+            pending = self._pending_files(bag_dir)
+            # A failed bag is only processed again once a file of it is uploaded again
+            if not pending or (job and not _modified_since(pending, job["enqueued"])):
+                if self.uploads:
+                    self.uploads.done(bag_dir)
+                continue
+            if not is_bag_complete(bag_dir, self.settle_seconds, now):
+                continue
+            uid, _, path = bag.partition("/")
+            priority = upload_priority(limits, uid, path)
+            self.index.enqueue(bag, PRIORITIES.index(priority))
+            if self.uploads:
+                self.uploads.done(bag_dir)
+            queued += 1
+        return queued
+
+    def process(self, bag: str, pool: BufferPool) -> None:
+        """Feed the files of a bag to the stages, then let them finish it."""
+        job = BagJob(self.root, bag)
+        for path in self._pending_files(job.bag_dir):
+            name = os.path.basename(path)
+            relpath = self._relpath(path)
+            start = time.monotonic()
+            with open(path, "rb", buffering=0) as f:
+                stat = os.fstat(f.fileno())
+                checksum = Checksum()
+                try:
+                    consumers: List[ScanConsumer] = [checksum]
+                    if self.throttle:
+                        consumers.append(self.throttle)
+                    for stage in self.stages:
+                        consumers += stage.consumers(job, path, f, stat.st_size)
+                    size = scan_file(f, consumers, pool)
+                    if size != stat.st_size:
+                        raise CorruptFile(f"File changed while reading, {size} bytes read")
+                except CorruptFile as e:
+                    job.problems.append(f"{name}: {e}")
+                    self.index.record(
+                        relpath, bag, stat.st_size, stat.st_mtime, None, STATUS_CORRUPT, str(e)
+                    )
+                    continue
+            job.checksums[name] = checksum.hexdigest
+            self.index.record(
+                relpath, bag, stat.st_size, stat.st_mtime, checksum.hexdigest, STATUS_OK
+            )
+            if self._is_final(path):
+                write_etag(path, checksum.hexdigest)
+            logger.debug(
+                "Processed '%s' at %.1f MiB/s",
+                relpath,
+                stat.st_size / (1 << 20) / max(time.monotonic() - start, 1e-6),
+            )
+
+        metadata = read_bag_metadata(job.bag_dir)
+        end = None
+        if metadata["start"] is not None and metadata["duration"] is not None:
+            end = metadata["start"] + metadata["duration"]
+        self.index.record_bag(bag, metadata["start"], end)
+
+        for stage in self.stages:
+            stage.finish(job)
+
+    def _work(self) -> None:
+        pool = BufferPool(self.buffers, self.buffer_size)
+        while True:
+            if self.throttle:
+                self.throttle.wait()
+            # Background work yields the disk to high priority uploads
+            preempted = bool(self.admission and self.admission.preempted())
+            bag = self.index.claim_job(max_priority=0 if preempted else None)
+            if bag is None:
+                return
+            if not os.path.isdir(os.path.join(self.root, bag)):
+                # Moved or deleted since it was queued
+                self.index.complete_job(bag)
+                continue
+            try:
+                self.process(bag, pool)
+            except Exception:
+                logger.exception("Failed to process '%s'", bag)
+                self.index.fail_job(bag)
+            else:
+                self.index.complete_job(bag)
+
+    def run_once(self, full: bool = True) -> None:
+        """Queue the completed bags and process the queue with the worker pool.
+
+        Args:
+            full: whether to walk the storage, rather than look at the uploads only.
+        """
+        self.discover(full)
+        threads = [threading.Thread(target=self._work) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for stage in self.stages:
+            stage.refresh()
@@ -0,0 +1,250 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Downsampled companions of the bags, for a fast remote triage.
+
+Scrubbing through a bag of a couple of hours over a slow link takes ages.
+While the pipeline reads a MCAP bag, this stage writes a light copy of every
+file, `<bag>/preview/<file>.mcap`, next to the original:
+
+- the messages of every topic are decimated to a configurable rate, except
+  the topics that must stay whole, e.g. `/tf_static`.
+- raw images are downscaled. Compressed images are only decimated, as the
+  workload cannot decode them.
+- point clouds are voxel-downsampled, keeping one point per voxel.
+
+The preview has the same topics and timestamps as the original, so that
+Foxglove loads it in seconds, then the matching time range of the original
+when the full resolution is needed.
+"""
+
+import logging
+import os
+import struct
+import threading
+from typing import Dict, List
+
+from bagstore.mcap import CdrReader, CdrWriter, Channel, McapStream, McapWriter
+from bagstore.pipeline import BagJob, ScanConsumer, Stage
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_DIR = "preview"
+
+IMAGE_TYPE = "sensor_msgs/msg/Image"
+POINT_CLOUD_TYPE = "sensor_msgs/msg/PointCloud2"
+# Topics of which every message matters
+KEEP_TOPICS = ("/tf_static", "/robot_description")
+
+PREVIEW_IMAGE_WIDTH = 320
+VOXEL_SIZE = 0.2
+
+# Bytes per pixel of the raw image encodings that can be downscaled by sampling
+_PIXEL_SIZES = {
+    "rgb8": 3,
+    "bgr8": 3,
+    "rgba8": 4,
+    "bgra8": 4,
+    "mono8": 1,
+    "mono16": 2,
+    "8UC1": 1,
+    "8UC3": 3,
+    "16UC1": 2,
+    "32FC1": 4,
+}
+
+_FLOAT32 = 7
+# Farther points are bogus, and NaNs fail every comparison
+_MAX_COORDINATE = 1e6
+
+
+def downscale_image(data: bytes, width: int = PREVIEW_IMAGE_WIDTH) -> bytes:
+    """Return a sensor_msgs/msg/Image downscaled to at most `width` pixels wide."""
+    reader = CdrReader(data)
+    reader.header()
+    prefix = bytes(data[: reader.offset])
+    height, image_width = reader.uint32(), reader.uint32()
+    encoding = reader.string()
+    is_bigendian = reader.uint8()
+    step = reader.uint32()
+    pixels = reader.bytes()
+    size = _PIXEL_SIZES.get(encoding)
+    if size is None or image_width <= width:
+        return data
+
+    scale = -(-image_width // width)
+    out_width = len(range(0, image_width, scale))
+    out = bytearray()
+    for y in range(0, height, scale):
+        row = pixels[y * step : y * step + image_width * size]
+        if len(row) < image_width * size:
+            break
+        sampled = bytearray(out_width * size)
+        for byte in range(size):
+            sampled[byte::size] = row[byte :: scale * size]
+        out += sampled
+    return bytes(
+        CdrWriter(prefix)
+        .uint32(len(out) // (out_width * size))
+        .uint32(out_width)
+        .string(encoding)
+        .uint8(is_bigendian)
+        .uint32(out_width * size)
+        .bytes(out)
+        .data
+    )
+
+
+def downsample_point_cloud(data: bytes, voxel_size: float = VOXEL_SIZE) -> bytes:
+    """Return a sensor_msgs/msg/PointCloud2 keeping the first point of every voxel."""
+    reader = CdrReader(data)
+    reader.header()
+    height, width = reader.uint32(), reader.uint32()
+    size_offset = reader.offset - 8
+    offsets = {}
+    for _ in range(reader.uint32()):
+        name = reader.string()
+        offset = reader.uint32()
+        datatype = reader.uint8()
+        reader.uint32()
+        if name in ("x", "y", "z") and datatype == _FLOAT32:
+            offsets[name] = offset
+    is_bigendian = reader.uint8()
+    prefix = bytearray(data[: reader.offset])
+    point_step, row_step = reader.uint32(), reader.uint32()
+    points = reader.bytes()
+    is_dense = reader.uint8()
+    if len(offsets) < 3 or is_bigendian or not point_step:
+        return data
+
+    if row_step != width * point_step:
+        points = b"".join(
+            points[row * row_step : row * row_step + width * point_step] for row in range(height)
+        )
+    # Unpack x, y and z of every point at once, in the order of their offsets
+    fields = sorted(offsets, key=lambda name: offsets[name])
+    fmt, position = "<", 0
+    for name in fields:
+        fmt += f"{offsets[name] - position}xf"
+        position = offsets[name] + 4
+    fmt += f"{point_step - position}x"
+    order = [fields.index(name) for name in ("x", "y", "z")]
+
+    voxels: Dict[tuple, int] = {}
+    count = len(points) // point_step
+    for i, values in enumerate(struct.iter_unpack(fmt, points[: count * point_step])):
+        x, y, z = values[order[0]], values[order[1]], values[order[2]]
+        if not (
+            -_MAX_COORDINATE < x < _MAX_COORDINATE
+            and -_MAX_COORDINATE < y < _MAX_COORDINATE
+            and -_MAX_COORDINATE < z < _MAX_COORDINATE
+        ):
+            continue
+        voxels.setdefault((int(x // voxel_size), int(y // voxel_size), int(z // voxel_size)), i)
+    kept = b"".join(points[i * point_step : (i + 1) * point_step] for i in voxels.values())
+
+    struct.pack_into("<II", prefix, size_offset, 1, len(voxels))
+    return bytes(
+        CdrWriter(bytes(prefix))
+        .uint32(point_step)
+        .uint32(len(kept))
+        .bytes(kept)
+        .uint8(is_dense)
+        .data
+    )
+
+
+class PreviewBagWriter(McapStream):
+    """Write the preview of a MCAP file while it is read.
+
+    Args:
+        path: path of the preview to write.
+        rate: rate of the messages of every topic in the preview, in Hz.
+    """
+
+    def __init__(self, path: str, rate: float):
+        super().__init__(self._on_message)
+        self.path = path
+        self.period = int(1e9 / rate)
+        self._next: Dict[int, int] = {}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path + ".part", "wb")
+        self._writer = McapWriter(self._file)
+
+    def _on_message(self, channel: Channel, log_time: int, data: bytes) -> None:
+        if channel.topic not in KEEP_TOPICS:
+            if log_time < self._next.get(channel.id, 0):
+                return
+            self._next[channel.id] = log_time + self.period
+        if channel.encoding == "cdr":
+            try:
+                if channel.type == IMAGE_TYPE:
+                    data = downscale_image(data)
+                elif channel.type == POINT_CLOUD_TYPE:
+                    data = downsample_point_cloud(data)
+            except (ValueError, struct.error):
+                logger.debug("Cannot downsample a message of '%s'", channel.topic)
+        self._writer.write_message(channel, log_time, log_time, data)
+
+    def finish(self) -> None:
+        """Complete the preview, once the whole file is read."""
+        self._writer.finish()
+        self.close()
+        os.replace(self.path + ".part", self.path)
+        if self.skipped_chunks:
+            logger.warning(
+                "Preview '%s' misses %d chunks compressed without support",
+                self.path,
+                self.skipped_chunks,
+            )
+
+    @property
+    def closed(self) -> bool:
+        """Whether the preview is complete or abandoned."""
+        return self._file.closed
+
+    def close(self) -> None:
+        """Close the preview, complete or not."""
+        self._file.close()
+
+
+class PreviewBagStage(Stage):
+    """Write the downsampled previews of the MCAP files of the bags.
+
+    Args:
+        rate: rate of the messages of every topic in the previews, in Hz.
+    """
+
+    name = "preview-bags"
+
+    def __init__(self, rate: float = 2.0):
+        self.rate = rate
+        self._writers: Dict[int, List[PreviewBagWriter]] = {}
+        self._lock = threading.Lock()
+
+    def consumers(self, job: BagJob, path: str, f, size: int) -> List[ScanConsumer]:
+        """Return the writer of the preview of a MCAP file."""
+        if not path.endswith(".mcap"):
+            return []
+        preview_path = os.path.join(job.bag_dir, PREVIEW_DIR, os.path.basename(path))
+        writer = PreviewBagWriter(preview_path, self.rate)
+        with self._lock:
+            self._writers.setdefault(id(job), []).append(writer)
+        return [writer]
+
+    def finish(self, job: BagJob) -> None:
+        """Drop the previews left incomplete, e.g. of corrupt files."""
+        with self._lock:
+            writers = self._writers.pop(id(job), [])
+        for writer in writers:
+            if writer.closed:
+                continue
+            writer.close()
+            if job.quarantined:
+                # Moved away along with the bag
+                continue
+            try:
+                os.remove(writer.path + ".part")
+                os.rmdir(os.path.dirname(writer.path))
+            except OSError:
+                pass
@@ -0,0 +1,352 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Previews of the bags for the web listing.
+
+Finding the interesting bag should not mean downloading each of them in
+Foxglove. While the pipeline reads a bag, this stage extracts:
+
+- one frame per camera topic, from the middle of the bag. Raw images are
+  downscaled and encoded as PNG. Compressed images are kept as they are when
+  small enough, as the workload cannot decode them.
+- a coarse trajectory from the odometry, or from the `/tf` transforms of the
+  robot base, drawn as SVG.
+- the topics of the bag, with their type, message count and rate.
+
+Previews are written to `<root>/.bagstore/previews/<digest>/`, where the
+digest is derived from the content of the bag, so that Caddy serves them as
+immutable under `/_previews/`. `/_previews/index.html` lists the previews of
+every bag in one page.
+"""
+
+import hashlib
+import html
+import json
+import logging
+import os
+import shutil
+import struct
+import threading
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+from bagstore import STATE_DIR
+from bagstore.index import BagIndex
+from bagstore.layout import read_bag_metadata
+from bagstore.mcap import CdrReader, Channel, McapStream
+from bagstore.pipeline import BagJob, ScanConsumer, Stage
+
+logger = logging.getLogger(__name__)
+
+PREVIEWS_DIR = "previews"
+LISTING_FILE = "index.html"
+
+IMAGE_TYPES = ("sensor_msgs/msg/Image", "sensor_msgs/msg/CompressedImage")
+ODOMETRY_TYPE = "nav_msgs/msg/Odometry"
+TF_TYPE = "tf2_msgs/msg/TFMessage"
+BASE_FRAMES = ("base_link", "base_footprint")
+
+THUMBNAIL_WIDTH = 160
+MAX_COMPRESSED_THUMBNAIL = 256 << 10
+MAX_TRAJECTORY_POINTS = 500
+
+# Bytes per pixel, and offsets of the red, green and blue channels
+_RAW_ENCODINGS = {
+    "rgb8": (3, 0, 1, 2),
+    "rgba8": (4, 0, 1, 2),
+    "bgr8": (3, 2, 1, 0),
+    "bgra8": (4, 2, 1, 0),
+    "mono8": (1, 0, 0, 0),
+    "8UC1": (1, 0, 0, 0),
+    "8UC3": (3, 2, 1, 0),
+    "mono16": (2, 1, 1, 1),
+    "16UC1": (2, 1, 1, 1),
+}
+
+
+def encode_png(width: int, height: int, rgb: bytes) -> bytes:
+    """Encode 8-bit RGB pixels as PNG."""
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+        )
+
+    stride = width * 3
+    # Every row starts with its filter type, none
+    rows = b"".join(b"\x00" + rgb[y * stride : (y + 1) * stride] for y in range(height))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(rows, 9))
+        + chunk(b"IEND", b"")
+    )
+
+
+def thumbnail(data: bytes) -> Optional[Tuple[str, bytes]]:
+    """Return the extension and content of the thumbnail of a sensor_msgs/msg/Image."""
+    reader = CdrReader(data)
+    reader.header()
+    height, width = reader.uint32(), reader.uint32()
+    encoding = reader.string()
+    reader.uint8()
+    step = reader.uint32()
+    pixels = reader.bytes()
+    if encoding not in _RAW_ENCODINGS or not width or not height:
+        return None
+    size, red, green, blue = _RAW_ENCODINGS[encoding]
+
+    scale = max(1, -(-width // THUMBNAIL_WIDTH))
+    rgb = bytearray()
+    for y in range(0, height, scale):
+        row = pixels[y * step : y * step + width * size]
+        if len(row) < width * size:
+            break
+        for x in range(0, width * size, scale * size):
+            rgb += bytes((row[x + red], row[x + green], row[x + blue]))
+    out_width = len(range(0, width, scale))
+    out_height = len(rgb) // (out_width * 3)
+    if not out_height:
+        return None
+    return "png", encode_png(out_width, out_height, bytes(rgb))
+
+
+def compressed_thumbnail(data: bytes) -> Optional[Tuple[str, bytes]]:
+    """Return the extension and content of a small sensor_msgs/msg/CompressedImage."""
+    reader = CdrReader(data)
+    reader.header()
+    image_format = reader.string().lower()
+    image = reader.bytes()
+    extension = "png" if "png" in image_format else "jpg"
+    if ("jpeg" not in image_format and "png" not in image_format) or len(
+        image
+    ) > MAX_COMPRESSED_THUMBNAIL:
+        return None
+    return extension, bytes(image)
+
+
+def odometry_position(data: bytes) -> Tuple[float, float]:
+    """Return the x and y position of a nav_msgs/msg/Odometry."""
+    reader = CdrReader(data)
+    reader.header()
+    reader.string()
+    x, y, _ = reader.float64(3)
+    return x, y
+
+
+def base_position(data: bytes) -> Optional[Tuple[float, float]]:
+    """Return the x and y translation of the robot base in a tf2_msgs/msg/TFMessage."""
+    reader = CdrReader(data)
+    for _ in range(reader.uint32()):
+        reader.header()
+        child = reader.string()
+        x, y, _ = reader.float64(3)
+        reader.float64(4)
+        if child.lstrip("/") in BASE_FRAMES:
+            return x, y
+    return None
+
+
+def render_trajectory(points: List[Tuple[float, float]]) -> str:
+    """Draw a trajectory as SVG, north up."""
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    span = max(max(xs) - min(xs), max(ys) - min(ys), 1e-3)
+    margin = 8
+
+    def project(x: float, y: float) -> str:
+        px = margin + (x - min(xs)) / span * (200 - 2 * margin)
+        py = 200 - margin - (y - min(ys)) / span * (200 - 2 * margin)
+        return f"{px:.1f},{py:.1f}"
+
+    path = " ".join(project(x, y) for x, y in points)
+    start, end = project(*points[0]).split(","), project(*points[-1]).split(",")
+    return (
+        '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 200 200" width="200" height="200">'
+        '<rect width="200" height="200" fill="#fff"/>'
+        f'<polyline points="{path}" fill="none" stroke="#e95420" stroke-width="2"/>'
+        f'<circle cx="{start[0]}" cy="{start[1]}" r="4" fill="#0e8420"/>'
+        f'<circle cx="{end[0]}" cy="{end[1]}" r="4" fill="#c7162b"/>'
+        f'<text x="4" y="196" font-size="10" font-family="sans-serif">{span:.1f} m</text>'
+        "</svg>\n"
+    )
+
+
+class _BagPreview:
+    """What the stage collected about a bag while it was read."""
+
+    def __init__(self, metadata: dict):
+        middle = None
+        if metadata["start"] is not None and metadata["duration"] is not None:
+            middle = metadata["start"] + metadata["duration"] // 2
+        self.middle = middle
+        self.metadata = metadata
+        self.thumbnails: Dict[str, Tuple[str, bytes]] = {}
+        self.odometry: List[Tuple[float, float]] = []
+        self.tf: List[Tuple[float, float]] = []
+        self.topics: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+
+    def on_message(self, channel: Channel, log_time: int, data: bytes) -> None:
+        try:
+            if channel.type in IMAGE_TYPES:
+                if channel.topic in self.thumbnails:
+                    return
+                if self.middle is not None and log_time < self.middle:
+                    return
+                extract = thumbnail if channel.type == IMAGE_TYPES[0] else compressed_thumbnail
+                image = extract(data)
+                if image:
+                    self.thumbnails[channel.topic] = image
+            elif channel.type == ODOMETRY_TYPE:
+                self.odometry.append(odometry_position(data))
+            elif channel.type == TF_TYPE and channel.topic == "/tf":
+                position = base_position(data)
+                if position:
+                    self.tf.append(position)
+        except (ValueError, struct.error):
+            logger.debug("Cannot decode a message of '%s'", channel.topic)
+
+    @property
+    def trajectory(self) -> List[Tuple[float, float]]:
+        points = self.odometry or self.tf
+        stride = max(1, len(points) // MAX_TRAJECTORY_POINTS)
+        return points[::stride]
+
+
+def _wants(channel: Channel) -> bool:
+    return channel.encoding == "cdr" and channel.type in (*IMAGE_TYPES, ODOMETRY_TYPE, TF_TYPE)
+
+
+class _McapPreview(McapStream):
+    def __init__(self, preview: _BagPreview):
+        super().__init__(preview.on_message, _wants)
+        self.preview = preview
+
+    def finish(self) -> None:
+        with self.preview.lock:
+            for channel in self.channels.values():
+                topic = self.preview.topics.setdefault(
+                    channel.topic, {"type": channel.type, "count": 0}
+                )
+                topic["count"] += channel.message_count
+
+
+class PreviewStage(Stage):
+    """Extract the previews of the bags, and render the listing of all of them."""
+
+    name = "previews"
+
+    def __init__(self, root: str, index: BagIndex):
+        self.directory = os.path.join(root, STATE_DIR, PREVIEWS_DIR)
+        self.index = index
+        self._previews: Dict[int, _BagPreview] = {}
+        self._lock = threading.Lock()
+        self._listed: Optional[List[Tuple[str, str]]] = None
+
+    def _preview(self, job: BagJob) -> _BagPreview:
+        with self._lock:
+            if id(job) not in self._previews:
+                self._previews[id(job)] = _BagPreview(read_bag_metadata(job.bag_dir))
+            return self._previews[id(job)]
+
+    def consumers(self, job: BagJob, path: str, f, size: int) -> List[ScanConsumer]:
+        """Return the reader of the messages of a MCAP file."""
+        if not path.endswith(".mcap"):
+            return []
+        return [_McapPreview(self._preview(job))]
+
+    def finish(self, job: BagJob) -> None:
+        """Write the previews of the bag, and update the listing."""
+        with self._lock:
+            preview = self._previews.pop(id(job), None)
+        if job.quarantined:
+            return
+        preview = preview or _BagPreview(read_bag_metadata(job.bag_dir))
+        if preview.metadata["start"] is None and not job.checksums:
+            return
+
+        digest = hashlib.sha256(json.dumps(sorted(job.checksums.items())).encode()).hexdigest()[
+            :16
+        ]
+        directory = os.path.join(self.directory, digest)
+        os.makedirs(directory, exist_ok=True)
+
+        files = {}
+        for i, (topic, (extension, content)) in enumerate(sorted(preview.thumbnails.items())):
+            files[topic] = f"{digest}/frame-{i}.{extension}"
+            with open(os.path.join(self.directory, files[topic]), "wb") as f:
+                f.write(content)
+
+        trajectory = None
+        if len(preview.trajectory) > 1:
+            trajectory = f"{digest}/trajectory.svg"
+            with open(os.path.join(self.directory, trajectory), "w") as f:
+                f.write(render_trajectory(preview.trajectory))
+
+        # Counts read from the files, rosbag2 metadata otherwise, e.g. for SQLite bags
+        topics = preview.topics or preview.metadata["topics"]
+        duration = (preview.metadata["duration"] or 0) / 1e9
+        summary = {
+            "start": preview.metadata["start"],
+            "duration": duration,
+            "topics": {
+                name: dict(topic, rate=round(topic["count"] / duration, 2) if duration else None)
+                for name, topic in sorted(topics.items())
+            },
+            "frames": files,
+            "trajectory": trajectory,
+        }
+        with open(os.path.join(directory, "summary.json"), "w") as f:
+            json.dump(summary, f, indent=1)
+
+        replaced = self.index.record_preview(job.bag, digest, json.dumps(summary))
+        if replaced and replaced != digest:
+            shutil.rmtree(os.path.join(self.directory, replaced), ignore_errors=True)
+
+    def refresh(self) -> None:
+        """Render the listing again if bags were previewed or moved since."""
+        previews = list(self.index.previews())
+        if previews != self._listed:
+            self.render_listing(previews)
+            self._listed = previews
+
+    def render_listing(self, previews: List[Tuple[str, str]]) -> None:
+        """Render the page listing the previews of every bag."""
+        rows = []
+        for bag, summary_json in previews:
+            summary = json.loads(summary_json)
+            images = "".join(
+                f'<img src="{html.escape(path)}" alt="{html.escape(topic)}" '
+                f'title="{html.escape(topic)}" loading="lazy" height="90">'
+                for topic, path in summary["frames"].items()
+            )
+            if summary["trajectory"]:
+                images += (
+                    f'<img src="{html.escape(summary["trajectory"])}" alt="trajectory" '
+                    'loading="lazy" height="90">'
+                )
+            topics = "<br>".join(
+                f"{html.escape(name)} <small>{html.escape(topic['type'])}, "
+                f"{topic['count']} msgs"
+                + (f", {topic['rate']} Hz" if topic["rate"] else "")
+                + "</small>"
+                for name, topic in summary["topics"].items()
+            )
+            rows.append(
+                f'<tr><td><a href="../{html.escape(bag)}/">{html.escape(bag)}</a>'
+                f"<br><small>{summary['duration']:.0f} s</small></td>"
+                f"<td>{images}</td><td>{topics}</td></tr>"
+            )
+        page = (
+            '<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>Bags</title>'
+            "<style>body{font-family:sans-serif}td{vertical-align:top;padding:4px}"
+            "img{margin-right:4px}</style></head><body><table>\n"
+            + "\n".join(rows)
+            + "\n</table></body></html>\n"
+        )
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = os.path.join(self.directory, LISTING_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            f.write(page)
+        os.replace(tmp_path, os.path.join(self.directory, LISTING_FILE))
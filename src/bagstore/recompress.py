@@ -0,0 +1,361 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Background recompression of the MCAP files, to zstd in large chunks.
+
+Robots record MCAP without compression, or with lz4 in small chunks, to
+spare their CPU. The server has idle CPU and expensive storage, so the
+`Recompressor` rewrites those files with their messages in chunks of a few
+MiB compressed with zstd, which typically takes a fraction of the space.
+
+A file is only rewritten once the pipeline processed it, to a copy in the
+state directory, and every copy is checked before it replaces the original:
+
+- the new file must pass the MCAP checks of the `verify` stage.
+- its schemas, channels, messages with their sequence numbers and times,
+  attachments and metadata must be those of the original, compared by
+  digest.
+- the original must not have changed in the meantime.
+
+The new file then replaces the original with a rename, keeping its mtime,
+and the bag index follows: its checksum, and its chunks if it is in the time
+index. Files that would not shrink by `min_saving` are left as they are. The
+pipeline leaves the ETag of the MCAP files to the recompression, which writes
+it once it decided, so that no file is served as immutable before it is
+rewritten.
+
+This is low priority work: it runs in its own process, with a nice level,
+yields to high priority uploads, and is slowed down to use at most a CPU
+budget, measured from the CPU time of the process. The resource scheduler
+scales that budget down, or pauses the recompression, when the container is
+under pressure (see `bagstore.scheduler`).
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+from typing import List, Optional, Tuple
+
+from bagstore import STATE_DIR
+from bagstore.admission import Admission
+from bagstore.index import STATUS_OK, BagIndex
+from bagstore.mcap import (
+    OP_ATTACHMENT,
+    OP_HEADER,
+    OP_MESSAGE,
+    OP_METADATA,
+    McapIndex,
+    McapStream,
+    McapWriter,
+    can_compress_chunks,
+    can_read_chunks,
+)
+from bagstore.pipeline import (
+    BufferPool,
+    Checksum,
+    CorruptFile,
+    remove_etag,
+    scan_file,
+    write_etag,
+)
+from bagstore.scheduler import Throttle
+from bagstore.timeindex import chunk_rows
+from bagstore.verify import mcap_consumers
+
+logger = logging.getLogger(__name__)
+
+RECOMPRESS_DIR = "recompress"
+
+
+def needs_recompression(mcap: McapIndex, chunk_size: int) -> bool:
+    """Whether the chunks of a file are not zstd, or much smaller than `chunk_size`.
+
+    Files with chunks that cannot be read, e.g. lz4 without the `lz4`
+    package, or without chunks, are left as they are.
+    """
+    if not mcap.chunks or not all(can_read_chunks(c.compression) for c in mcap.chunks):
+        return False
+    if any(chunk.compression != "zstd" for chunk in mcap.chunks):
+        return True
+    average = sum(chunk.uncompressed_size for chunk in mcap.chunks) / len(mcap.chunks)
+    return average < chunk_size / 4
+
+
+class ContentDigest(McapStream):
+    """Digest of what a MCAP file holds, however it is chunked and compressed."""
+
+    parsed = McapStream.parsed + (OP_HEADER, OP_ATTACHMENT, OP_METADATA)
+
+    def __init__(self):
+        super().__init__(lambda channel, log_time, data: None, wants=lambda channel: False)
+        self.profile = ""
+        self.message_count = 0
+        self.unknown_channels = 0
+        self._messages = hashlib.sha256()
+        self._records = hashlib.sha256()
+
+    def _record(self, opcode: int, content: memoryview) -> None:
+        if opcode == OP_MESSAGE:
+            channel = self.channels.get(int.from_bytes(content[:2], "little"))
+            if channel is None:
+                self.unknown_channels += 1
+                return
+            self.message_count += 1
+            self._messages.update(len(content).to_bytes(8, "little"))
+            self._messages.update(content)
+            self.on_record(opcode, content, channel)
+        elif opcode in (OP_ATTACHMENT, OP_METADATA):
+            self._records.update(bytes([opcode]) + len(content).to_bytes(8, "little"))
+            self._records.update(content)
+            self.on_record(opcode, content, None)
+        elif opcode == OP_HEADER:
+            length = int.from_bytes(content[:4], "little")
+            self.profile = bytes(content[4 : 4 + length]).decode(errors="replace")
+            self.on_record(opcode, content, None)
+        else:
+            super()._record(opcode, content)
+
+    def on_record(self, opcode: int, content: memoryview, channel) -> None:
+        """Called with the messages, attachments and metadata records, and the header."""
+
+    @property
+    def digest(self) -> str:
+        """Return the digest of the channels, messages and other records."""
+        digest = hashlib.sha256(self.profile.encode())
+        for channel in sorted(self.channels.values(), key=lambda c: c.id):
+            schema = channel.schema
+            digest.update(
+                repr(
+                    (
+                        channel.id,
+                        channel.topic,
+                        channel.encoding,
+                        sorted(channel.metadata.items()),
+                        schema and (schema.id, schema.name, schema.encoding, schema.data),
+                    )
+                ).encode()
+            )
+        digest.update(self._messages.digest())
+        digest.update(self._records.digest())
+        return digest.hexdigest()
+
+    def finish(self) -> None:
+        """Check that every record was read.
+
+        Raises:
+            CorruptFile: if records or chunks were skipped.
+        """
+        if self.skipped_chunks or self.skipped_records or self.unknown_channels:
+            raise CorruptFile(
+                f"{self.skipped_chunks} chunks, {self.skipped_records} records and "
+                f"{self.unknown_channels} messages of unknown channels cannot be read"
+            )
+
+
+class _Rewriter(ContentDigest):
+    """Copy the content of a MCAP file read in order to a new MCAP file."""
+
+    def __init__(self, f, chunk_size: int, level: int):
+        super().__init__()
+        self.f = f
+        self.chunk_size = chunk_size
+        self.level = level
+        self.writer: Optional[McapWriter] = None
+        self.headerless = False
+
+    def on_record(self, opcode: int, content: memoryview, channel) -> None:
+        if opcode == OP_HEADER:
+            self.writer = McapWriter(self.f, self.profile, self.chunk_size, self.level)
+            return
+        if self.writer is None:
+            self.headerless = True
+        elif opcode == OP_MESSAGE:
+            sequence = int.from_bytes(content[2:6], "little")
+            log_time = int.from_bytes(content[6:14], "little")
+            publish_time = int.from_bytes(content[14:22], "little")
+            self.writer.write_message(channel, log_time, publish_time, content[22:], sequence)
+        else:
+            self.writer.write_record(opcode, content)
+
+    def finish(self) -> None:
+        """Complete the new file, once the original is read whole."""
+        super().finish()
+        if self.writer is None or self.headerless:
+            raise CorruptFile("Missing MCAP header")
+        # Channels without messages are kept too
+        for channel in self.channels.values():
+            self.writer.add_channel(channel)
+        self.writer.finish()
+
+
+class Recompressor:
+    """Rewrite the MCAP files of the processed bags to zstd, in large chunks.
+
+    Args:
+        root: storage root served by Caddy.
+        index: index of the files, recording their checksums and chunks.
+        chunk_size: size of the chunks of the rewritten files, before compression.
+        level: zstd compression level.
+        cpu_budget: CPUs the recompression may use, 0 for those of the container.
+        min_saving: fraction of the size a rewrite must save to replace a file.
+        admission: admission of the uploads, to yield to high priority ones.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        index: BagIndex,
+        chunk_size: int = 4 << 20,
+        level: int = 9,
+        cpu_budget: float = 0.5,
+        min_saving: float = 0.05,
+        admission: Optional[Admission] = None,
+    ):
+        self.root = root
+        self.index = index
+        self.chunk_size = chunk_size
+        self.level = level
+        self.budget = Throttle(root, cpu_budget)
+        self.min_saving = min_saving
+        self.admission = admission
+        self.staging = os.path.join(root, STATE_DIR, RECOMPRESS_DIR)
+        self._pool = BufferPool(8, 1 << 20)
+
+    def candidates(self) -> List[str]:
+        """Return the processed MCAP files not recompressed yet."""
+        candidates = []
+        for row in self.index.files(STATUS_OK):
+            if not row["path"].endswith(".mcap"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.root, row["path"]))
+            except OSError:
+                continue
+            if (row["size"], row["mtime"]) != (stat.st_size, stat.st_mtime):
+                # Changed since it was processed, the pipeline comes first
+                continue
+            if not self.index.is_recompressed(row["path"], stat.st_size, stat.st_mtime):
+                candidates.append(row["path"])
+        return candidates
+
+    def _rewrite(self, f) -> Tuple[str, str]:
+        """Write the recompressed copy of a file, return its path and checksum."""
+        os.makedirs(self.staging, exist_ok=True)
+        fd, new_path = tempfile.mkstemp(suffix=".mcap", dir=self.staging)
+        try:
+            with open(fd, "wb") as new:
+                rewriter = _Rewriter(new, self.chunk_size, self.level)
+                self.budget.start()
+                scan_file(f, [rewriter, self.budget], self._pool)
+                new.flush()
+                os.fsync(new.fileno())
+
+            with open(new_path, "rb", buffering=0) as new:
+                size = os.fstat(new.fileno()).st_size
+                check, checksum = ContentDigest(), Checksum()
+                consumers = [*mcap_consumers(new, size), check, checksum, self.budget]
+                scan_file(new, consumers, self._pool)
+            if check.digest != rewriter.digest:
+                raise CorruptFile("The recompressed file differs from the original")
+        except BaseException:
+            os.remove(new_path)
+            raise
+        return new_path, checksum.hexdigest
+
+    def _keep(self, path: str, stat: os.stat_result) -> None:
+        """Record that a file is left as it is, and make it final."""
+        self.index.record_recompression(path, stat.st_size, stat.st_mtime, 0)
+        checksum = self.index.checksum(path)
+        if checksum:
+            write_etag(os.path.join(self.root, path), checksum)
+
+    def recompress(self, path: str) -> int:
+        """Recompress a file given relative to the storage root.
+
+        Returns:
+            the number of bytes saved.
+
+        Raises:
+            CorruptFile: if the file cannot be rewritten as is.
+        """
+        full_path = os.path.join(self.root, path)
+        with open(full_path, "rb", buffering=0) as f:
+            stat = os.fstat(f.fileno())
+            if not needs_recompression(McapIndex(f), self.chunk_size):
+                self._keep(path, stat)
+                return 0
+            new_path, checksum = self._rewrite(f)
+
+        try:
+            saved = stat.st_size - os.path.getsize(new_path)
+            current = os.stat(full_path)
+            changed = (current.st_ino, current.st_size, current.st_mtime_ns) != (
+                stat.st_ino,
+                stat.st_size,
+                stat.st_mtime_ns,
+            )
+            if changed or saved < stat.st_size * self.min_saving:
+                if not changed:
+                    self._keep(path, stat)
+                return 0
+
+            os.chown(new_path, stat.st_uid, stat.st_gid)
+            os.chmod(new_path, stat.st_mode & 0o7777)
+            os.utime(new_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            remove_etag(full_path)
+            os.replace(new_path, full_path)
+        finally:
+            if os.path.exists(new_path):
+                os.remove(new_path)
+        dir_fd = os.open(os.path.dirname(full_path), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+        stat = os.stat(full_path)
+        bag = os.path.dirname(path)
+        self.index.record(path, bag, stat.st_size, stat.st_mtime, checksum, STATUS_OK)
+        write_etag(full_path, checksum)
+        if self.index.has_chunks(path):
+            with open(full_path, "rb") as f:
+                self.index.record_chunks(path, bag.split("/", 1)[0], chunk_rows(McapIndex(f)))
+        self.index.record_recompression(path, stat.st_size, stat.st_mtime, saved)
+        return saved
+
+    def run_once(self) -> Tuple[int, int]:
+        """Recompress the files not recompressed yet.
+
+        Returns:
+            the number of files rewritten, and the bytes saved.
+        """
+        if not can_compress_chunks():
+            # The pipeline leaves their ETags to the recompression, keep them as they are
+            logger.warning("No zstd module in the workload, cannot recompress")
+            for path in self.candidates():
+                try:
+                    self._keep(path, os.stat(os.path.join(self.root, path)))
+                except OSError:
+                    continue
+            return 0, 0
+        # Left behind by an interrupted run
+        if os.path.isdir(self.staging):
+            for name in os.listdir(self.staging):
+                os.remove(os.path.join(self.staging, name))
+        rewritten = saved = 0
+        for path in self.candidates():
+            if self.admission and self.admission.preempted():
+                logger.info("Recompression yields to high priority uploads")
+                break
+            try:
+                file_saved = self.recompress(path)
+            except (CorruptFile, OSError) as e:
+                logger.warning("Cannot recompress '%s': %s", path, e)
+                continue
+            if file_saved:
+                rewritten += 1
+                saved += file_saved
+                logger.debug("Recompressed '%s', %d bytes saved", path, file_saved)
+        logger.info("Recompressed %d files, %.1f MiB saved", rewritten, saved / (1 << 20))
+        return rewritten, saved
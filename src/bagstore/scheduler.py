@@ -0,0 +1,419 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Share of the container resources given to the background workers.
+
+Caddy and sshd share the container, and its CPU and memory limits, with
+the background workers: the pipeline, the time index catch-up and the
+recompression. However nice they are, the workers compete for the disk and
+the memory, and may stall downloads and uploads.
+
+The `ResourceScheduler` runs as its own service and samples, every few
+seconds:
+
+- the CPU and memory limits and usage of the container, from its cgroup.
+- the pressure stall information (PSI) of the CPU, memory and I/O.
+- the latency of a request to Caddy, compared with its recent best.
+- the throughput of every HTTP upload stream, compared with its recent best.
+
+It then sets the share of the background workers, from 0 (paused) to 1,
+halving it whenever a signal degrades and raising it back slowly once they
+all recovered. The decision is written to `.bagstore/scheduler.json`, which
+the workers read through a `Throttle`: they pace their reads to use at most
+their share of the CPUs and of their read rate, and wait while paused. A decision older than a
+minute, e.g. of a stopped scheduler, is ignored.
+
+The decisions are served as metrics with those of the uploads, see
+`bagstore.metrics`, and of the time index, e.g. `bagstore_scheduler_level` and
+`bagstore_scheduler_throttled{reason="io-pressure"}`.
+"""
+
+import collections
+import http.client
+import json
+import logging
+import os
+import threading
+import time
+from typing import Deque, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from bagstore import STATE_DIR
+from bagstore.cgroup import (
+    CGROUP_ROOT,
+    cpu_limit,
+    cpu_usage,
+    memory_limit,
+    memory_usage,
+    pressure,
+)
+from bagstore.pipeline import ScanConsumer
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_FILE = "scheduler.json"
+# Decisions older than this are not followed
+STALE_SECONDS = 60.0
+
+REASONS = (
+    "cpu-pressure",
+    "io-pressure",
+    "memory-pressure",
+    "memory-usage",
+    "latency",
+    "upload-throughput",
+)
+
+# Share given back every sample once the signals recovered
+_RECOVERY_STEP = 0.1
+# Below this share, the workers are paused
+_MIN_LEVEL = 1 / 16
+# Samples the best latency and throughput are taken from
+_HISTORY = 60
+# Read rate of a worker at its full share, until it is measured
+_IO_RATE = 64 << 20
+
+
+def decision_path(root: str) -> str:
+    """Return the path of the decision of the scheduler."""
+    return os.path.join(root, STATE_DIR, SCHEDULER_FILE)
+
+
+def read_decision(root: str) -> Optional[dict]:
+    """Return the last decision of the scheduler, None if there is none."""
+    try:
+        with open(decision_path(root)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def decision_metrics(decision: Optional[dict]) -> str:
+    """Return a decision of the scheduler in the Prometheus text format."""
+    if decision is None:
+        return ""
+    signals = decision["signals"]
+    lines = [
+        "# HELP bagstore_scheduler_level Share of the resources given to background workers.",
+        "# TYPE bagstore_scheduler_level gauge",
+        f"bagstore_scheduler_level {decision['level']}",
+        "# HELP bagstore_scheduler_throttled Whether a signal throttles background workers.",
+        "# TYPE bagstore_scheduler_throttled gauge",
+    ]
+    for reason in REASONS:
+        lines.append(
+            f'bagstore_scheduler_throttled{{reason="{reason}"}} {int(reason in decision["reasons"])}'
+        )
+    for metric, signal, description in [
+        ("bagstore_container_cpu_limit", "cpu_limit", "CPUs the container may use."),
+        ("bagstore_container_cpu_usage", "cpu_usage", "CPUs the container used."),
+        ("bagstore_container_memory_limit_bytes", "memory_limit", "Memory limit."),
+        ("bagstore_container_memory_used_bytes", "memory_usage", "Memory used."),
+        ("bagstore_foreground_latency_seconds", "latency", "Latency of a request to Caddy."),
+        (
+            "bagstore_upload_stream_throughput_bytes",
+            "upload_throughput",
+            "Bytes per second received by every HTTP upload stream.",
+        ),
+    ]:
+        if signals.get(signal) is not None:
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {signals[signal]}")
+    lines.append("# HELP bagstore_container_pressure_ratio Share of time stalled on a resource.")
+    lines.append("# TYPE bagstore_container_pressure_ratio gauge")
+    for resource in ("cpu", "memory", "io"):
+        value = signals.get(f"{resource}_pressure")
+        if value is not None:
+            lines.append(f'bagstore_container_pressure_ratio{{resource="{resource}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def _probe(url: str, timeout: float) -> Optional[float]:
+    """Return the time to get the response of a HEAD request, None if Caddy is down."""
+    parsed = urlparse(url)
+    connection = http.client.HTTPConnection(parsed.netloc, timeout=timeout)
+    start = time.monotonic()
+    try:
+        connection.request("HEAD", parsed.path or "/")
+        connection.getresponse().read()
+    except TimeoutError:
+        return timeout
+    except OSError:
+        return None
+    finally:
+        connection.close()
+    return time.monotonic() - start
+
+
+def _upload_totals(url: str, timeout: float) -> Optional[Tuple[int, int]]:
+    """Return the bytes received by the upload server so far, and its active streams."""
+    parsed = urlparse(url)
+    connection = http.client.HTTPConnection(parsed.netloc, timeout=timeout)
+    try:
+        connection.request("GET", parsed.path)
+        response = connection.getresponse()
+        content = response.read().decode()
+    except OSError:
+        return None
+    finally:
+        connection.close()
+    values = {}
+    for line in content.splitlines():
+        name, _, value = line.partition(" ")
+        if name in ("bagstore_upload_received_bytes_total", "bagstore_upload_streams"):
+            values[name] = int(float(value))
+    if len(values) < 2:
+        return None
+    return values["bagstore_upload_received_bytes_total"], values["bagstore_upload_streams"]
+
+
+class ResourceScheduler:
+    """Set the share of the resources of the background workers, from the container state.
+
+    Args:
+        root: storage root, holding the state directory.
+        cgroup: root of the cgroup of the container.
+        probe_url: URL of Caddy to time requests to, None not to.
+        upload_metrics_url: metrics of the upload server, None without HTTP uploads.
+        cpu_pressure: CPU pressure above which the workers are throttled.
+        io_pressure: I/O pressure above which the workers are throttled.
+        memory_pressure: memory pressure above which the workers are throttled.
+        memory_usage: share of the memory limit above which the workers are throttled.
+        latency: latency of Caddy below which the workers are never throttled.
+        latency_factor: how many times its best latency Caddy may take.
+        upload_drop: share of its best throughput an upload stream may drop to.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        cgroup: str = CGROUP_ROOT,
+        probe_url: Optional[str] = None,
+        upload_metrics_url: Optional[str] = None,
+        cpu_pressure: float = 0.4,
+        io_pressure: float = 0.2,
+        memory_pressure: float = 0.1,
+        memory_usage: float = 0.9,
+        latency: float = 0.25,
+        latency_factor: float = 4.0,
+        upload_drop: float = 0.5,
+    ):
+        self.root = root
+        self.cgroup = cgroup
+        self.probe_url = probe_url
+        self.upload_metrics_url = upload_metrics_url
+        self.thresholds = {
+            "cpu-pressure": cpu_pressure,
+            "io-pressure": io_pressure,
+            "memory-pressure": memory_pressure,
+            "memory-usage": memory_usage,
+        }
+        self.latency = latency
+        self.latency_factor = latency_factor
+        self.upload_drop = upload_drop
+        self.level = 1.0
+        self._latencies: Deque[float] = collections.deque(maxlen=_HISTORY)
+        self._throughputs: Deque[float] = collections.deque(maxlen=_HISTORY)
+        self._cpu: Optional[Tuple[float, float]] = None
+        self._uploads: Optional[Tuple[float, int]] = None
+
+    def sample(self) -> Dict[str, Optional[float]]:
+        """Return the current state of the container and of the foreground services."""
+        now = time.monotonic()
+        limit = memory_limit(self.cgroup)
+        used = memory_usage(self.cgroup)
+        signals: Dict[str, Optional[float]] = {
+            "cpu_limit": round(cpu_limit(self.cgroup), 2),
+            "cpu_usage": None,
+            "memory_limit": limit,
+            "memory_usage": used,
+            "memory_ratio": round(used / limit, 3) if limit and used is not None else None,
+            "latency": None,
+            "upload_throughput": None,
+            "upload_streams": None,
+        }
+        for resource in ("cpu", "memory", "io"):
+            signals[f"{resource}_pressure"] = pressure(resource, self.cgroup)
+
+        usage = cpu_usage(self.cgroup)
+        if usage is not None:
+            if self._cpu is not None:
+                signals["cpu_usage"] = round((usage - self._cpu[1]) / (now - self._cpu[0]), 2)
+            self._cpu = (now, usage)
+
+        latency = _probe(self.probe_url, timeout=2.0) if self.probe_url else None
+        if latency is not None:
+            signals["latency"] = round(latency, 4)
+
+        totals = _upload_totals(self.upload_metrics_url, 2.0) if self.upload_metrics_url else None
+        if totals is not None:
+            received, streams = totals
+            signals["upload_streams"] = streams
+            if self._uploads is not None and streams:
+                rate = (received - self._uploads[1]) / (now - self._uploads[0]) / streams
+                signals["upload_throughput"] = round(rate, 1)
+            self._uploads = (now, received)
+        return signals
+
+    def reasons(self, signals: Dict[str, Optional[float]]) -> List[str]:
+        """Return why the background workers should be throttled, if they should."""
+        reasons = []
+        for reason, signal in (
+            ("cpu-pressure", "cpu_pressure"),
+            ("io-pressure", "io_pressure"),
+            ("memory-pressure", "memory_pressure"),
+            ("memory-usage", "memory_ratio"),
+        ):
+            value = signals[signal]
+            if value is not None and value > self.thresholds[reason]:
+                reasons.append(reason)
+
+        latency = signals["latency"]
+        if latency is not None:
+            best = min(self._latencies, default=latency)
+            if latency > max(self.latency, best * self.latency_factor):
+                reasons.append("latency")
+            self._latencies.append(latency)
+
+        throughput = signals["upload_throughput"]
+        if throughput is not None:
+            best = max(self._throughputs, default=throughput)
+            if throughput < best * self.upload_drop:
+                reasons.append("upload-throughput")
+            self._throughputs.append(throughput)
+        return reasons
+
+    def update(self) -> dict:
+        """Sample the signals and write the new decision, return it."""
+        signals = self.sample()
+        reasons = self.reasons(signals)
+        if reasons:
+            self.level /= 2
+            if self.level < _MIN_LEVEL:
+                self.level = 0.0
+        else:
+            self.level = min(1.0, self.level + _RECOVERY_STEP)
+        self.level = round(self.level, 4)
+        decision = {
+            "level": self.level,
+            "reasons": reasons,
+            "signals": signals,
+            "updated": time.time(),
+        }
+
+        path = decision_path(self.root)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(decision, f)
+        os.replace(path + ".tmp", path)
+        if reasons:
+            logger.info("Background workers throttled to %.0f%%: %s", self.level * 100, reasons)
+        return decision
+
+
+class Throttle(ScanConsumer):
+    """Slow a background worker down to the share of the resources it is given.
+
+    As a consumer of the reads of files, it paces them so that the process
+    uses at most its share of `cpus`, measured from its CPU time, and of its
+    read rate, so that I/O-bound workers slow down too. It waits while the
+    workers are paused. A single throttle may pace the threads of a process,
+    and at most a second of idle time is credited to it.
+
+    The read rate of the worker at its full share is measured every second
+    it is not throttled, unless `io_rate` is given.
+
+    Args:
+        root: storage root, holding the decision of the scheduler.
+        cpus: CPUs the worker may use at most, those of the container if 0.
+        io_rate: bytes/s the worker may read at most, measured if 0.
+    """
+
+    def __init__(self, root: str, cpus: float = 0.0, io_rate: float = 0.0):
+        self.path = decision_path(root)
+        self.cpus = cpus
+        self.io_rate = io_rate
+        self._cpu_limit = cpu_limit()
+        self._measured_rate = float(_IO_RATE)
+        self._level = 1.0
+        self._read = 0.0
+        self._lock = threading.Lock()
+        self.start()
+
+    def start(self) -> None:
+        """Start measuring afresh, e.g. after a pause."""
+        with self._lock:
+            self._cpu = time.process_time()
+            self._wall = time.monotonic()
+            self._ahead = 0.0
+            self._io_ahead = 0.0
+            self._window = (self._wall, 0)
+
+    @property
+    def level(self) -> float:
+        """Return the share of the resources of the background workers, read every second."""
+        now = time.monotonic()
+        if now - self._read < 1.0:
+            return self._level
+        self._read = now
+        try:
+            with open(self.path) as f:
+                decision = json.load(f)
+            fresh = time.time() - decision["updated"] < STALE_SECONDS
+            self._level = float(decision["level"]) if fresh else 1.0
+        except (OSError, ValueError, KeyError, TypeError):
+            self._level = 1.0
+        return self._level
+
+    def wait(self) -> None:
+        """Wait while the background workers are paused."""
+        if self.level > 0:
+            return
+        logger.debug("Background work paused by the scheduler")
+        while self.level == 0:
+            time.sleep(1.0)
+        self.start()
+
+    def update(self, offset: int, chunk: memoryview) -> None:
+        """Wait until the CPU time and the bytes read so far are within the share of the worker."""
+        self.wait()
+        level = self.level
+        with self._lock:
+            cpu, wall = time.process_time(), time.monotonic()
+            if level < 1 or self.cpus:
+                cpus = (self.cpus or self._cpu_limit) * level
+                self._ahead += (cpu - self._cpu) / cpus - (wall - self._wall)
+                self._ahead = max(self._ahead, -1.0)
+            if level < 1 or self.io_rate:
+                rate = (self.io_rate or self._measured_rate) * level
+                self._io_ahead += len(chunk) / rate - (wall - self._wall)
+                self._io_ahead = max(self._io_ahead, -1.0)
+                self._window = (wall, 0)
+            else:
+                self._measure(wall, len(chunk))
+            self._cpu, self._wall = cpu, wall
+            ahead = max(self._ahead, self._io_ahead)
+        if ahead > 0:
+            time.sleep(ahead)
+
+    def _measure(self, wall: float, size: int) -> None:
+        """Measure the read rate of the worker at its full share, over a second or more."""
+        if wall - self._wall > 1.0:
+            # Idle in between, e.g. waiting for the next bag
+            self._window = (wall, 0)
+            return
+        start, read = self._window
+        read += size
+        if wall - start >= 1.0:
+            self._measured_rate = read / (wall - start)
+            self._window = (wall, 0)
+        else:
+            self._window = (start, read)
+
+    def rest(self, busy: float) -> None:
+        """Rest after `busy` seconds of work, so that the work takes its share of the time."""
+        self.wait()
+        level = self.level
+        if level < 1:
+            time.sleep(busy * (1 / level - 1))
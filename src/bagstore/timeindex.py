@@ -0,0 +1,236 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Store-wide time index of the MCAP chunks, and its HTTP lookup.
+
+Finding the data a robot recorded at a given time used to mean reading the
+summary of every bag of the robot. When the pipeline processes a MCAP file,
+this stage records in the bag index where each of its chunks is, with its
+time range and topics, from the chunk indexes of the summary or, for files
+without one, from the chunk records. They are read from a memory map of the
+file with `McapIndex`, so that the stage only pages in the summary, or the
+record headers, of files of any size.
+
+`ChunkQueryServer` answers lookups over HTTP, e.g.
+`GET /_index/chunks?uid=robot-7&topic=/camera/*&start=2023-07-22T14:02:00Z&end=2023-07-22T14:05:00Z`
+returns the files and byte ranges to fetch with `Range` requests:
+
+    {"chunks": [{"url": "/robot-7/2023/07/22/bag/rosbag_0.mcap",
+                 "offset": 1234, "length": 56789,
+                 "start": 1690034520000000000, "end": 1690034521000000000,
+                 "topics": ["/camera/image_raw"]}]}
+
+Times are nanoseconds since the epoch, or ISO 8601 dates, UTC when no time
+zone is given. A topic ending with `*` matches the topics starting with it.
+
+`GET /_index/extract/<path>?start=...&end=...` returns the chunks of a single
+file of the time range as a MCAP file, see `bagstore.extract`, and
+`GET /_index/metrics` the metrics of the server, e.g. the progress of the
+catch-up of a backlog, see `bagstore.catchup`. Caddy does not proxy the latter,
+they are served with the others by `bagstore.metrics`.
+"""
+
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+from bagstore.extract import (
+    ExtractError,
+    extract_parts,
+    parts_length,
+    send_parts,
+    storage_file,
+)
+from bagstore.index import BagIndex
+from bagstore.mcap import McapIndex
+from bagstore.pipeline import BagJob, ScanConsumer, Stage
+
+logger = logging.getLogger(__name__)
+
+MAX_CHUNKS = 10000
+
+
+def chunk_rows(mcap: McapIndex) -> List[Tuple[str, int, int, int, int]]:
+    """Return the topic, start, end, offset and length of every chunk of every topic."""
+    rows = []
+    for chunk in mcap.chunks:
+        # Chunks of unknown content could hold any topic
+        channels = chunk.channels or mcap.channels.keys()
+        for channel_id in sorted(channels):
+            channel = mcap.channels.get(channel_id)
+            if channel is not None:
+                rows.append((channel.topic, chunk.start, chunk.end, chunk.offset, chunk.length))
+    return rows
+
+
+class _ChunkRecorder(ScanConsumer):
+    """Record the chunks of a file in the time index, once it is read without error."""
+
+    def __init__(self, index: BagIndex, path: str, uid: str, rows: list):
+        self.index = index
+        self.path = path
+        self.uid = uid
+        self.rows = rows
+
+    def finish(self) -> None:
+        self.index.record_chunks(self.path, self.uid, self.rows)
+
+
+class TimeIndexStage(Stage):
+    """Record the chunks of the MCAP files in the time index."""
+
+    name = "time-index"
+
+    def __init__(self, index: BagIndex):
+        self.index = index
+
+    def consumers(self, job: BagJob, path: str, f, size: int) -> List[ScanConsumer]:
+        """Return the recorder of the chunks of a MCAP file, read from its index."""
+        if not path.endswith(".mcap"):
+            return []
+        uid = job.bag.split("/", 1)[0]
+        rows = chunk_rows(McapIndex(f))
+        return [_ChunkRecorder(self.index, f"{job.bag}/{os.path.basename(path)}", uid, rows)]
+
+
+def parse_time(value: str) -> int:
+    """Return a time given in nanoseconds or as an ISO 8601 date, in nanoseconds.
+
+    Raises:
+        ValueError: if the time is neither.
+    """
+    if value.isdigit():
+        return int(value)
+    date = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp()) * 10**9 + date.microsecond * 1000
+
+
+def group_chunks(rows) -> List[dict]:
+    """Merge the rows of the topics of every chunk into one entry."""
+    chunks: Dict[Tuple[str, int], dict] = {}
+    for row in rows:
+        key = (row["path"], row["chunk_offset"])
+        if key not in chunks:
+            chunks[key] = {
+                "url": "/" + quote(row["path"]),
+                "offset": row["chunk_offset"],
+                "length": row["chunk_length"],
+                "start": row["start_time"],
+                "end": row["end_time"],
+                "topics": [],
+            }
+        chunks[key]["topics"].append(row["topic"])
+    return list(chunks.values())
+
+
+class ChunkQueryRequestHandler(BaseHTTPRequestHandler):
+    """Answer the lookups of a `ChunkQueryServer`."""
+
+    protocol_version = "HTTP/1.1"
+    server: "ChunkQueryServer"  # pyright: ignore[reportIncompatibleVariableOverride]
+
+    def log_message(self, format, *args):
+        """Log requests through logging rather than stderr."""
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def _reply(self, status: HTTPStatus, body: dict) -> None:
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):  # noqa: N802
+        """Return the chunks matching the query, or extract them from a file."""
+        url = urlparse(self.path)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        extract_prefix = f"{self.server.base_path}/extract/"
+        if url.path == f"{self.server.base_path}/metrics":
+            self._metrics()
+            return
+        try:
+            start = parse_time(query["start"])
+            end = parse_time(query["end"])
+            if url.path == f"{self.server.base_path}/chunks":
+                self._chunks(query["uid"], start, end, query.get("topic"))
+            elif url.path.startswith(extract_prefix):
+                path = unquote(url.path[len(extract_prefix) :])
+                self._extract(path, start, end, query.get("topic"))
+            else:
+                self._reply(HTTPStatus.NOT_FOUND, {"error": "Not found"})
+        except KeyError as e:
+            self._reply(HTTPStatus.BAD_REQUEST, {"error": f"Missing {e.args[0]}"})
+        except ValueError as e:
+            self._reply(HTTPStatus.BAD_REQUEST, {"error": f"Invalid time: {e}"})
+
+    def _metrics(self) -> None:
+        content = self.server.metrics().encode() if self.server.metrics else b""
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _chunks(self, uid: str, start: int, end: int, topic: Optional[str]) -> None:
+        rows = self.server.index.find_chunks(uid, start, end, topic)
+        chunks = group_chunks(rows)
+        self._reply(
+            HTTPStatus.OK,
+            {"chunks": chunks[:MAX_CHUNKS], "truncated": len(chunks) > MAX_CHUNKS},
+        )
+
+    def _extract(self, path: str, start: int, end: int, topic: Optional[str]) -> None:
+        try:
+            file_path = storage_file(self.server.index.root, path)
+            f = open(file_path, "rb")
+        except (ExtractError, OSError):
+            self._reply(HTTPStatus.NOT_FOUND, {"error": "Not found"})
+            return
+        with f:
+            try:
+                parts = extract_parts(f, start, end, topic)
+            except ExtractError as e:
+                self._reply(HTTPStatus.UNPROCESSABLE_ENTITY, {"error": str(e)})
+                return
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header(
+                "Content-Disposition", f'attachment; filename="{os.path.basename(file_path)}"'
+            )
+            self.send_header("Content-Length", str(parts_length(parts)))
+            self.end_headers()
+            send_parts(self.connection, f, parts)
+
+
+class ChunkQueryServer(ThreadingHTTPServer):
+    """HTTP server of the lookups in the time index.
+
+    Args:
+        address: address to listen on.
+        index: index holding the chunks.
+        base_path: path the server is reverse proxied at.
+        metrics: returns the metrics to serve, in the Prometheus text format.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: Tuple[str, int],
+        index: BagIndex,
+        base_path: str = "/_index",
+        metrics: Optional[Callable[[], str]] = None,
+    ):
+        self.index = index
+        self.base_path = base_path.rstrip("/")
+        self.metrics = metrics
+        super().__init__(address, ChunkQueryRequestHandler)
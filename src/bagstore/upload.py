@@ -0,0 +1,836 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Resumable HTTP uploads, following the tus 1.0.0 protocol.
+
+This is an alternative to rsync over SSH for devices that cannot reach the
+SSH port. It implements the tus core protocol with the creation and
+termination extensions, and is served behind Caddy under `/upload/`.
+
+Devices authenticate with the same SSH keys they use for rsync. They sign
+every request with `ssh-keygen -Y sign -n ros2bag-upload`, the message
+`ros2bag-upload <uid> <created> <nonce> <method> <resource>`, and send the
+signature along with it::
+
+    Authorization: Signature uid="<uid>",created="<unix time>",nonce="<nonce>",
+        signature="<base64>"
+
+where the nonce is a random string of the device, different for every
+request, the signature is the base64 of the armored signature file, and the
+resource is the filename of the upload to create (`POST`), the upload id
+(`HEAD`, `PATCH` and `DELETE`) or `stats`. A signature is only accepted once,
+within `max_age` seconds of its creation, so a captured header cannot be
+replayed, nor used for another request.
+
+Data is written straight to the storage and made durable by batches of
+`fsync_bytes`. Once complete, a file is renamed to `/<uid>/<filename>`, the
+same way rsync finalizes its temporary files, so that HTTP uploads go
+through the same post-upload processing as rsync ones.
+
+On links with a high latency, a single TCP stream cannot fill the bandwidth.
+A device can then split a large file in segments it sends in parallel, with
+the non-standard `segments` extension::
+
+    POST /upload/            Upload-Length: <length>, Upload-Segments: <n>
+    <- 201 Created           Location: <url>, Upload-Segment-Size: <size>
+    PATCH <url>              Upload-Segment: <i>, Upload-Offset: <i * size + sent>
+    HEAD <url>               -> Upload-Segment-Offsets: <offset of each segment>
+
+Each segment is a plain tus upload of the `[i * size, (i + 1) * size)` range,
+written in place in a preallocated file. `GET /upload/stats` reports the
+aggregate throughput of every device across its streams, and
+`GET /upload/metrics` the bytes received so far, which the resource
+scheduler watches. Caddy does not proxy the latter, see `bagstore.metrics`.
+
+Files written a bit at a time, while many uploads are in progress, end up
+fragmented all over a busy volume, and every later download of them is slow.
+With `preallocate`, the whole file is reserved with `fallocate` when the
+upload is created, as its length is known, so that the filesystem allocates
+it contiguously. In any case data is written by large buffers, aligned in the
+file, rather than by the pieces the network delivers.
+"""
+
+import base64
+import binascii
+import errno
+import json
+import logging
+import os
+import re
+import secrets
+import subprocess
+import tempfile
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from bagstore import SIGNATURE_NAMESPACE, STATE_DIR
+from bagstore.admission import (
+    Admission,
+    AdmissionTimeout,
+    StorageFull,
+    TokenBucket,
+    upload_priority,
+)
+from bagstore.index import BagIndex
+from bagstore.layout import record_upload
+from bagstore.pipeline import remove_etag
+from bagstore.scheduler import decision_metrics, read_decision
+
+logger = logging.getLogger(__name__)
+
+TUS_VERSION = "1.0.0"
+TUS_EXTENSIONS = "creation,termination,segments"
+MAX_SEGMENTS = 64
+UPLOADS_DIR = "uploads"
+
+_CHUNK_SIZE = 1 << 20
+# Data is written by buffers of this size, aligned on it in the file
+_WRITE_SIZE = 4 << 20
+_AUTHORIZATION_RE = re.compile(r'(\w+)="([^"]*)"')
+_UID_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]*")
+_NONCE_RE = re.compile(r"[A-Za-z0-9_-]{8,64}")
+
+
+class UploadError(Exception):
+    """Raised when a request cannot be served, with the HTTP status to answer."""
+
+    def __init__(self, status: HTTPStatus, message: str, headers: Optional[Dict[str, str]] = None):
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+        super().__init__(message)
+
+
+def signed_message(uid: str, created: int, nonce: str, method: str, resource: str) -> bytes:
+    """Return the message a device signs to authenticate a request to a resource."""
+    return f"{SIGNATURE_NAMESPACE} {uid} {created} {nonce} {method} {resource}".encode()
+
+
+class DeviceAuthenticator:
+    """Authenticate the requests of devices, signed with their SSH keys.
+
+    Args:
+        allowed_signers: `ssh-keygen` allowed signers file of the devices.
+        max_age: how long, in seconds, a signature may be used after its creation.
+    """
+
+    def __init__(self, allowed_signers: str, max_age: float = 300):
+        self.allowed_signers = allowed_signers
+        self.max_age = max_age
+        # Nonces of the signatures already used, until they expire
+        self._used: Dict[Tuple[str, str, str], float] = {}
+        self._lock = threading.Lock()
+
+    def authenticate(self, authorization: Optional[str], method: str, resource: str) -> str:
+        """Return the uid of the device which signed the request, from its authorization header.
+
+        Raises:
+            UploadError: if the header is missing, expired, already used or not
+                signed by the device for this request.
+        """
+        if not authorization or not authorization.startswith("Signature "):
+            raise UploadError(HTTPStatus.UNAUTHORIZED, "Missing signature")
+
+        params = dict(_AUTHORIZATION_RE.findall(authorization))
+        try:
+            uid, created, nonce = params["uid"], params["created"], params["nonce"]
+            signature = params["signature"]
+            age = time.time() - int(created)
+        except (KeyError, ValueError):
+            raise UploadError(HTTPStatus.UNAUTHORIZED, "Malformed signature")
+        if not _UID_RE.fullmatch(uid):
+            raise UploadError(HTTPStatus.UNAUTHORIZED, "Invalid uid")
+        if not _NONCE_RE.fullmatch(nonce):
+            raise UploadError(HTTPStatus.UNAUTHORIZED, "Invalid nonce")
+        if not -60 <= age <= self.max_age:
+            raise UploadError(HTTPStatus.UNAUTHORIZED, "Expired signature")
+
+        key = (uid, created, nonce)
+        with self._lock:
+            now = time.time()
+            self._used = {k: v for k, v in self._used.items() if v > now}
+            if key in self._used:
+                raise UploadError(HTTPStatus.UNAUTHORIZED, "Signature already used")
+            # Reserved while verified, so that concurrent replays are rejected too
+            self._used[key] = int(created) + self.max_age
+
+        message = signed_message(uid, int(created), nonce, method, resource)
+        try:
+            self._verify(uid, signature, message)
+        except UploadError:
+            with self._lock:
+                self._used.pop(key, None)
+            raise
+        return uid
+
+    def _verify(self, uid: str, signature: str, message: bytes) -> None:
+        try:
+            armored = base64.b64decode(signature, validate=True)
+        except binascii.Error:
+            raise UploadError(HTTPStatus.UNAUTHORIZED, "Malformed signature")
+
+        with tempfile.NamedTemporaryFile(suffix=".sig") as signature_file:
+            signature_file.write(armored)
+            signature_file.flush()
+            try:
+                result = subprocess.run(
+                    [
+                        "ssh-keygen",
+                        "-Y",
+                        "verify",
+                        "-f",
+                        self.allowed_signers,
+                        "-I",
+                        uid,
+                        "-n",
+                        SIGNATURE_NAMESPACE,
+                        "-s",
+                        signature_file.name,
+                    ],
+                    input=message,
+                    capture_output=True,
+                )
+            except OSError as e:
+                logger.error("Cannot verify signatures: %s", e)
+                raise UploadError(HTTPStatus.SERVICE_UNAVAILABLE, "Cannot verify signatures")
+
+        if result.returncode != 0:
+            logger.info("Rejected signature of '%s': %s", uid, result.stderr.decode().strip())
+            raise UploadError(HTTPStatus.UNAUTHORIZED, "Invalid signature")
+
+
+class Upload:
+    """An upload in progress, made of one or more segments.
+
+    A plain tus upload has a single segment, appended to in order. A segmented
+    upload splits the file in `segments` ranges of `segment_size` bytes that
+    are sent concurrently, each one in order.
+
+    `offsets` is where the next chunk of each segment is expected, `synced` is
+    how far each segment is known to be on disk. Only the latter is
+    persisted, so that an upload resumes from durable data after a restart.
+    """
+
+    def __init__(
+        self,
+        upload_id: str,
+        uid: str,
+        path: str,
+        length: int,
+        segments: int = 1,
+        synced: Optional[List[int]] = None,
+        preallocated: bool = False,
+    ):
+        self.id = upload_id
+        self.uid = uid
+        self.path = path
+        self.length = length
+        self.segment_size = -(-length // segments)
+        self.starts = [min(i * self.segment_size, length) for i in range(segments)]
+        self.synced = list(synced or self.starts)
+        self.offsets = list(self.synced)
+        # Segments are written in place, wherever they are in the file
+        self.preallocated = preallocated or segments > 1
+        self.locks = [threading.Lock() for _ in range(segments)]
+        self.sync_lock = threading.Lock()
+        self.unsynced = 0
+        self.finished = False
+
+    @property
+    def segmented(self) -> bool:
+        """Whether the upload is made of several segments."""
+        return len(self.starts) > 1
+
+    def segment_end(self, segment: int) -> int:
+        """Return the offset right after the segment."""
+        return self.starts[segment + 1] if segment + 1 < len(self.starts) else self.length
+
+    @property
+    def offset(self) -> int:
+        """Return how much of the upload is received, from its start, without gaps."""
+        for segment, offset in enumerate(self.offsets):
+            if offset < self.segment_end(segment):
+                return offset
+        return self.length
+
+    @property
+    def complete(self) -> bool:
+        """Whether all the segments are received."""
+        return all(o == self.segment_end(s) for s, o in enumerate(self.offsets))
+
+    def to_dict(self) -> dict:
+        """Return the persisted state of the upload."""
+        return {
+            "uid": self.uid,
+            "path": self.path,
+            "length": self.length,
+            "segments": len(self.starts),
+            "synced": self.synced,
+            "preallocated": self.preallocated,
+        }
+
+
+class ThroughputMeter:
+    """Aggregate upload throughput per device, across its concurrent streams.
+
+    The time of a device is only counted while at least one of its streams is
+    receiving data, so that N parallel streams add up to the bandwidth the
+    device actually gets. The bytes received by all the devices are also
+    counted as they are written, for the resource scheduler.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._devices: Dict[str, Dict[str, float]] = {}
+        self.received = 0
+
+    def start(self, uid: str) -> None:
+        """Record that a stream of the device started receiving."""
+        with self._lock:
+            device = self._devices.setdefault(
+                uid, {"bytes": 0, "seconds": 0.0, "active": 0, "since": 0.0}
+            )
+            if not device["active"]:
+                device["since"] = time.monotonic()
+            device["active"] += 1
+
+    def stop(self, uid: str, received: int) -> None:
+        """Record that a stream of the device received `received` bytes and stopped."""
+        with self._lock:
+            device = self._devices[uid]
+            device["bytes"] += received
+            device["active"] -= 1
+            if not device["active"]:
+                device["seconds"] += time.monotonic() - device["since"]
+
+    def add(self, received: int) -> None:
+        """Count bytes written by a stream."""
+        with self._lock:
+            self.received += received
+
+    def metrics(self) -> str:
+        """Return the bytes received and the active streams in the Prometheus text format."""
+        with self._lock:
+            streams = sum(int(device["active"]) for device in self._devices.values())
+            received = self.received
+        return (
+            "# HELP bagstore_upload_received_bytes_total Bytes received by HTTP uploads.\n"
+            "# TYPE bagstore_upload_received_bytes_total counter\n"
+            f"bagstore_upload_received_bytes_total {received}\n"
+            "# HELP bagstore_upload_streams HTTP upload streams receiving data.\n"
+            "# TYPE bagstore_upload_streams gauge\n"
+            f"bagstore_upload_streams {streams}\n"
+        )
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Return the bytes, busy seconds and throughput in bytes/s of every device."""
+        now = time.monotonic()
+        stats = {}
+        with self._lock:
+            for uid, device in self._devices.items():
+                seconds = device["seconds"]
+                if device["active"]:
+                    seconds += now - device["since"]
+                stats[uid] = {
+                    "bytes": device["bytes"],
+                    "seconds": round(seconds, 3),
+                    "throughput": round(device["bytes"] / seconds, 1) if seconds else 0.0,
+                    "streams": device["active"],
+                }
+        return stats
+
+
+def _parse_metadata(header: str) -> Dict[str, str]:
+    """Parse the tus `Upload-Metadata` header."""
+    metadata = {}
+    for pair in filter(None, (p.strip() for p in header.split(","))):
+        key, _, value = pair.partition(" ")
+        try:
+            metadata[key] = base64.b64decode(value, validate=True).decode()
+        except (binascii.Error, UnicodeDecodeError):
+            raise UploadError(HTTPStatus.BAD_REQUEST, f"Malformed metadata '{key}'")
+    return metadata
+
+
+def _preallocate(fd: int, length: int) -> None:
+    """Reserve the space of the whole file, falling back to a sparse file.
+
+    Raises:
+        OSError: if there is no space left for the file.
+    """
+    try:
+        os.posix_fallocate(fd, 0, length)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise
+        os.ftruncate(fd, length)
+    except AttributeError:
+        os.ftruncate(fd, length)
+
+
+def _relative_path(filename: str) -> str:
+    """Return a safe path relative to the device directory."""
+    path = os.path.normpath(filename.lstrip("/"))
+    parts = path.split(os.sep)
+    if not filename or path == "." or any(p in ("", "..") or p.startswith(".") for p in parts):
+        raise UploadError(HTTPStatus.BAD_REQUEST, f"Invalid filename '{filename}'")
+    return path
+
+
+class UploadStore:
+    """Uploads staged on the storage until they are complete.
+
+    Args:
+        root: storage root served over HTTP.
+        fsync_bytes: how much data is written between two fsyncs.
+        preallocate: whether to reserve the whole file of every upload up front.
+        index: bag index to record the completed uploads in, for the background workers.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        fsync_bytes: int = 64 << 20,
+        preallocate: bool = False,
+        index: Optional[BagIndex] = None,
+    ):
+        self.root = root
+        self.fsync_bytes = fsync_bytes
+        self.preallocate = preallocate
+        self.index = index
+        self.staging = os.path.join(root, STATE_DIR, UPLOADS_DIR)
+        os.makedirs(self.staging, exist_ok=True)
+        self._uploads: Dict[str, Upload] = {}
+        self._lock = threading.Lock()
+        self.throughput = ThroughputMeter()
+
+    def _data_path(self, upload_id: str) -> str:
+        return os.path.join(self.staging, f"{upload_id}.part")
+
+    def _info_path(self, upload_id: str) -> str:
+        return os.path.join(self.staging, f"{upload_id}.json")
+
+    def _save(self, upload: Upload) -> None:
+        tmp_path = self._info_path(upload.id) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(upload.to_dict(), f)
+        os.replace(tmp_path, self._info_path(upload.id))
+
+    def create(self, uid: str, filename: str, length: int, segments: int = 1) -> Upload:
+        """Start a new upload of `length` bytes to `/<uid>/<filename>`.
+
+        The file of a segmented upload is preallocated, so that its segments
+        are written in place, wherever they are in the file.
+        """
+        if not 1 <= segments <= min(MAX_SEGMENTS, max(length, 1)):
+            raise UploadError(HTTPStatus.BAD_REQUEST, "Invalid Upload-Segments")
+
+        upload = Upload(
+            secrets.token_hex(16),
+            uid,
+            _relative_path(filename),
+            length,
+            segments,
+            preallocated=self.preallocate and length > 0,
+        )
+        with open(self._data_path(upload.id), "wb") as f:
+            try:
+                if upload.preallocated:
+                    _preallocate(f.fileno(), length)
+            except OSError as e:
+                os.remove(f.name)
+                raise UploadError(HTTPStatus.INSUFFICIENT_STORAGE, e.strerror or str(e))
+        self._save(upload)
+        with self._lock:
+            self._uploads[upload.id] = upload
+        logger.info(
+            "Created upload %s of '%s' by '%s' in %d segment(s)",
+            upload.id,
+            upload.path,
+            uid,
+            segments,
+        )
+        if length == 0:
+            self._finish(upload)
+        return upload
+
+    def get(self, upload_id: str) -> Upload:
+        """Return an upload, reloading it from the storage after a restart."""
+        with self._lock:
+            if upload_id in self._uploads:
+                return self._uploads[upload_id]
+            if not re.fullmatch(r"[0-9a-f]{32}", upload_id):
+                raise UploadError(HTTPStatus.NOT_FOUND, "No such upload")
+            try:
+                with open(self._info_path(upload_id)) as f:
+                    upload = Upload(upload_id, **json.load(f))
+            except FileNotFoundError:
+                raise UploadError(HTTPStatus.NOT_FOUND, "No such upload")
+            if not upload.preallocated:
+                # Drop whatever was written but not synced before the restart
+                os.truncate(self._data_path(upload_id), upload.synced[0])
+            self._uploads[upload_id] = upload
+            return upload
+
+    def write(
+        self,
+        upload: Upload,
+        segment: int,
+        offset: int,
+        stream,
+        length: int,
+        bucket: Optional[TokenBucket] = None,
+    ) -> int:
+        """Write `length` bytes read from `stream` to a segment, from `offset`.
+
+        `bucket` limits the rate the request body is read at, if given.
+
+        Returns:
+            the new offset of the segment.
+        """
+        if not 0 <= segment < len(upload.starts):
+            raise UploadError(HTTPStatus.BAD_REQUEST, "Invalid Upload-Segment")
+        if not upload.locks[segment].acquire(blocking=False):
+            raise UploadError(HTTPStatus.CONFLICT, "Upload in progress")
+
+        self.throughput.start(upload.uid)
+        received = 0
+        try:
+            if offset != upload.offsets[segment]:
+                raise UploadError(
+                    HTTPStatus.CONFLICT, f"Expected offset {upload.offsets[segment]}"
+                )
+            if offset + length > upload.segment_end(segment):
+                raise UploadError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Segment length exceeded")
+
+            fd = os.open(self._data_path(upload.id), os.O_WRONLY)
+            try:
+                if not upload.preallocated:
+                    os.ftruncate(fd, offset)
+                received = self._receive(upload, segment, fd, stream, length, bucket)
+            finally:
+                os.close(fd)
+        finally:
+            self.throughput.stop(upload.uid, received)
+            upload.locks[segment].release()
+
+        with upload.sync_lock:
+            finish = upload.complete and not upload.finished
+            upload.finished |= finish
+        if finish:
+            self._finish(upload)
+        return upload.offsets[segment]
+
+    def _receive(
+        self,
+        upload: Upload,
+        segment: int,
+        fd: int,
+        stream,
+        length: int,
+        bucket: Optional[TokenBucket],
+    ) -> int:
+        """Copy the request body to its place in the file, return how much was received.
+
+        The body is read by pieces of `_CHUNK_SIZE` bytes, or less when rate
+        limited, and written once a buffer reaches the next multiple of
+        `_WRITE_SIZE` bytes in the file.
+        """
+        size = _CHUNK_SIZE if bucket is None else max(4096, int(bucket.rate) >> 3)
+        buffer = bytearray(min(_WRITE_SIZE, max(length, 1)))
+        view = memoryview(buffer)
+        received = buffered = 0
+        while received < length:
+            full = min(len(buffer), _WRITE_SIZE - upload.offsets[segment] % _WRITE_SIZE)
+            end = buffered + min(size, full - buffered, length - received)
+            read = stream.readinto(view[buffered:end])
+            if not read:
+                break
+            if bucket is not None:
+                bucket.throttle(read)
+            buffered += read
+            received += read
+            if buffered == full:
+                self._write(upload, segment, fd, view[:buffered])
+                buffered = 0
+
+        if buffered:
+            # The end of the body, or what was received of an interrupted one
+            self._write(upload, segment, fd, view[:buffered])
+        if upload.complete:
+            self._sync(upload, fd)
+        return received
+
+    def _write(self, upload: Upload, segment: int, fd: int, data: memoryview) -> None:
+        written = 0
+        while written < len(data):
+            written += os.pwrite(fd, data[written:], upload.offsets[segment] + written)
+        upload.offsets[segment] += written
+        self.throughput.add(written)
+
+        with upload.sync_lock:
+            upload.unsynced += written
+            sync = upload.unsynced >= self.fsync_bytes
+        if sync:
+            self._sync(upload, fd)
+
+    def _sync(self, upload: Upload, fd: int) -> None:
+        # Whatever was written before the snapshot is made durable by the fsync
+        with upload.sync_lock:
+            offsets = list(upload.offsets)
+            upload.unsynced = 0
+        os.fsync(fd)
+        with upload.sync_lock:
+            upload.synced = [max(a, b) for a, b in zip(upload.synced, offsets)]
+            self._save(upload)
+
+    def _finish(self, upload: Upload) -> None:
+        destination = os.path.join(self.root, upload.uid, upload.path)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        # The file replaced is not final anymore
+        remove_etag(destination)
+        os.replace(self._data_path(upload.id), destination)
+        os.remove(self._info_path(upload.id))
+        if self.index:
+            record_upload(self.root, self.index, destination)
+        with self._lock:
+            self._uploads.pop(upload.id, None)
+        stats = self.throughput.stats().get(upload.uid, {})
+        logger.info(
+            "Completed upload %s to '%s', device throughput %.1f MiB/s",
+            upload.id,
+            destination,
+            stats.get("throughput", 0) / (1 << 20),
+        )
+
+    def delete(self, upload: Upload) -> None:
+        """Abort an upload and drop its data."""
+        acquired = []
+        try:
+            for lock in upload.locks:
+                if not lock.acquire(blocking=False):
+                    raise UploadError(HTTPStatus.CONFLICT, "Upload in progress")
+                acquired.append(lock)
+            self._delete(upload)
+        finally:
+            for lock in acquired:
+                lock.release()
+
+    def _delete(self, upload: Upload) -> None:
+        with self._lock:
+            self._uploads.pop(upload.id, None)
+        for path in (self._data_path(upload.id), self._info_path(upload.id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class UploadRequestHandler(BaseHTTPRequestHandler):
+    """Serve the tus protocol for an `UploadServer`."""
+
+    protocol_version = "HTTP/1.1"
+    server: "UploadServer"  # pyright: ignore[reportIncompatibleVariableOverride]
+
+    def log_message(self, format, *args):
+        """Log requests through logging rather than stderr."""
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def _reply(
+        self, status: HTTPStatus, headers: Optional[Dict[str, str]] = None, body: bytes = b""
+    ) -> None:
+        self.send_response(status)
+        self.send_header("Tus-Resumable", TUS_VERSION)
+        self.send_header("Cache-Control", "no-store")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method) -> None:
+        try:
+            if self.command != "OPTIONS" and self.headers.get("Tus-Resumable") != TUS_VERSION:
+                raise UploadError(HTTPStatus.PRECONDITION_FAILED, "Unsupported tus version")
+            method()
+        except UploadError as e:
+            self.close_connection = self.command == "PATCH"
+            self.send_response(e.status, e.message)
+            self.send_header("Tus-Resumable", TUS_VERSION)
+            self.send_header("Tus-Version", TUS_VERSION)
+            for name, value in e.headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def _authenticate(self, resource: str) -> str:
+        """Return the uid of the device which signed the request for `resource`."""
+        return self.server.authenticator.authenticate(
+            self.headers.get("Authorization"), self.command, resource
+        )
+
+    def _upload(self) -> Upload:
+        """Return the upload addressed by the request, owned by the device."""
+        prefix = f"{self.server.base_path}/"
+        if not self.path.startswith(prefix):
+            raise UploadError(HTTPStatus.NOT_FOUND, "No such upload")
+        upload_id = self.path[len(prefix) :]
+        uid = self._authenticate(upload_id)
+        upload = self.server.store.get(upload_id)
+        if upload.uid != uid:
+            raise UploadError(HTTPStatus.NOT_FOUND, "No such upload")
+        return upload
+
+    def _int_header(self, name: str, default: Optional[int] = None) -> int:
+        if default is not None and name not in self.headers:
+            return default
+        try:
+            value = int(self.headers[name])
+        except (KeyError, TypeError, ValueError):
+            raise UploadError(HTTPStatus.BAD_REQUEST, f"Invalid {name}")
+        if value < 0:
+            raise UploadError(HTTPStatus.BAD_REQUEST, f"Invalid {name}")
+        return value
+
+    def do_OPTIONS(self):  # noqa: N802
+        """Advertise the protocol capabilities."""
+        self._handle(
+            lambda: self._reply(
+                HTTPStatus.NO_CONTENT,
+                {"Tus-Version": TUS_VERSION, "Tus-Extension": TUS_EXTENSIONS},
+            )
+        )
+
+    def do_POST(self):  # noqa: N802
+        """Create an upload."""
+        self._handle(self._create)
+
+    def _create(self) -> None:
+        if self.path.rstrip("/") != self.server.base_path:
+            raise UploadError(HTTPStatus.NOT_FOUND, "Not found")
+        metadata = _parse_metadata(self.headers.get("Upload-Metadata", ""))
+        uid = self._authenticate(metadata.get("filename", ""))
+        length = self._int_header("Upload-Length")
+        if "filename" not in metadata:
+            raise UploadError(HTTPStatus.BAD_REQUEST, "Missing filename metadata")
+
+        segments = self._int_header("Upload-Segments", default=1)
+        if self.server.admission:
+            try:
+                self.server.admission.check_storage(length)
+            except StorageFull as e:
+                raise UploadError(HTTPStatus.INSUFFICIENT_STORAGE, str(e))
+
+        upload = self.server.store.create(uid, metadata["filename"], length, segments)
+        prefix = self.headers.get("X-Forwarded-Prefix", "").rstrip("/")
+        self._reply(
+            HTTPStatus.CREATED,
+            {
+                "Location": f"{prefix}{self.server.base_path}/{upload.id}",
+                "Upload-Segment-Size": str(upload.segment_size),
+            },
+        )
+
+    def do_GET(self):  # noqa: N802
+        """Return the upload throughput of the devices, or the admission metrics."""
+        if self.path == f"{self.server.base_path}/metrics":
+            self._handle(self._metrics)
+        else:
+            self._handle(self._stats)
+
+    def _stats(self) -> None:
+        self._authenticate("stats")
+        if self.path != f"{self.server.base_path}/stats":
+            raise UploadError(HTTPStatus.NOT_FOUND, "Not found")
+        body = json.dumps(self.server.store.throughput.stats()).encode()
+        self._reply(HTTPStatus.OK, {"Content-Type": "application/json"}, body)
+
+    def _metrics(self) -> None:
+        admission = self.server.admission
+        store = self.server.store
+        metrics = admission.metrics() if admission else ""
+        metrics += store.throughput.metrics() + decision_metrics(read_decision(store.root))
+        body = metrics.encode()
+        self._reply(HTTPStatus.OK, {"Content-Type": "text/plain; version=0.0.4"}, body)
+
+    def do_HEAD(self):  # noqa: N802
+        """Return the offset to resume an upload from."""
+        self._handle(self._head)
+
+    def _head(self) -> None:
+        upload = self._upload()
+        headers = {"Upload-Offset": str(upload.offset), "Upload-Length": str(upload.length)}
+        if upload.segmented:
+            headers["Upload-Segment-Size"] = str(upload.segment_size)
+            headers["Upload-Segment-Offsets"] = ",".join(map(str, upload.offsets))
+        self._reply(HTTPStatus.OK, headers)
+
+    def do_PATCH(self):  # noqa: N802
+        """Append a chunk to an upload."""
+        self._handle(self._patch)
+
+    def _patch(self) -> None:
+        upload = self._upload()
+        if self.headers.get("Content-Type") != "application/offset+octet-stream":
+            raise UploadError(HTTPStatus.UNSUPPORTED_MEDIA_TYPE, "Unsupported content type")
+        offset = self._int_header("Upload-Offset")
+        length = self._int_header("Content-Length")
+        segment = self._int_header("Upload-Segment", default=0)
+
+        admission = self.server.admission
+        if admission is None:
+            new_offset = self.server.store.write(upload, segment, offset, self.rfile, length)
+        else:
+            priority = upload_priority(admission.limits, upload.uid, upload.path)
+            try:
+                with admission.admit(
+                    upload.uid, timeout=self.server.admission_timeout, priority=priority
+                ):
+                    bucket = admission.bucket(upload.uid, priority)
+                    new_offset = self.server.store.write(
+                        upload, segment, offset, self.rfile, length, bucket
+                    )
+            except AdmissionTimeout:
+                # tus clients retry, the device keeps its place in the fleet
+                raise UploadError(
+                    HTTPStatus.SERVICE_UNAVAILABLE,
+                    "Too many uploads in progress",
+                    {"Retry-After": str(int(self.server.admission_timeout))},
+                )
+        self._reply(HTTPStatus.NO_CONTENT, {"Upload-Offset": str(new_offset)})
+
+    def do_DELETE(self):  # noqa: N802
+        """Abort an upload."""
+        self._handle(self._delete)
+
+    def _delete(self) -> None:
+        upload = self._upload()
+        self.server.store.delete(upload)
+        self._reply(HTTPStatus.NO_CONTENT)
+
+
+class UploadServer(ThreadingHTTPServer):
+    """HTTP server of the resumable uploads."""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: Tuple[str, int],
+        store: UploadStore,
+        authenticator: DeviceAuthenticator,
+        base_path: str = "/upload",
+        admission: Optional[Admission] = None,
+        admission_timeout: float = 60,
+    ):
+        self.store = store
+        self.authenticator = authenticator
+        self.base_path = base_path.rstrip("/")
+        self.admission = admission
+        self.admission_timeout = admission_timeout
+
+        super().__init__(address, UploadRequestHandler)
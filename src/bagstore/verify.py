@@ -0,0 +1,210 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Post-upload integrity verification.
+
+Interrupted transfers can leave truncated bags behind, which only fail once
+someone opens them. Every completed bag is therefore read once: the files it
+lists in its `metadata.yaml` must exist, and each data file is validated in
+the single streamed pass of the pipeline:
+
+- MCAP files must start and end with the magic, end with a valid footer, and
+  match the CRCs of their data and summary sections, when recorded.
+- SQLite files must have a consistent header and size, and pass SQLite's own
+  `quick_check`, which then reads the pages from the page cache.
+
+This is a stage of the post-upload pipeline, which records the checksums and
+results in the bag index. Corrupt bags are moved to the quarantine directory,
+hidden from the HTTP listing.
+"""
+
+import logging
+import os
+import re
+import sqlite3
+import struct
+import zlib
+from typing import List
+from urllib.parse import quote
+
+from bagstore import STATE_DIR
+from bagstore.layout import BAG_METADATA_FILE
+from bagstore.pipeline import BagJob, CorruptFile, ScanConsumer, Stage
+
+logger = logging.getLogger(__name__)
+
+QUARANTINE_DIR = "quarantine"
+
+MCAP_MAGIC = b"\x89MCAP0\r\n"
+_MCAP_FOOTER = struct.Struct("<BQQQI")
+_MCAP_DATA_END = struct.Struct("<BQI")
+_MCAP_OP_FOOTER = 0x02
+_MCAP_OP_DATA_END = 0x0F
+
+SQLITE_MAGIC = b"SQLite format 3\x00"
+
+_RELATIVE_FILE_PATHS_RE = re.compile(r"relative_file_paths:\s*\n((?:\s*-\s*.+\n?)+)")
+
+
+class RangeCrc(ScanConsumer):
+    """CRC32 of the `[start, end)` range of the file, checked against `expected`."""
+
+    def __init__(self, start: int, end: int, expected: int, name: str):
+        self.start = start
+        self.end = end
+        self.expected = expected
+        self.name = name
+        self.crc = 0
+
+    def update(self, offset: int, chunk: memoryview) -> None:
+        """Add the part of the chunk within the range to the CRC."""
+        begin = max(self.start - offset, 0)
+        end = min(self.end - offset, len(chunk))
+        if begin < end:
+            self.crc = zlib.crc32(chunk[begin:end], self.crc)
+
+    def finish(self) -> None:
+        """Compare the CRC with the recorded one."""
+        if self.crc != self.expected:
+            raise CorruptFile(f"{self.name} CRC mismatch")
+
+
+def mcap_consumers(f, size: int) -> List[ScanConsumer]:
+    """Check the MCAP structure readable from the end of the file.
+
+    Only the few bytes of the footer and data end records are read here, the
+    CRCs are returned as consumers of the streamed pass.
+
+    Raises:
+        CorruptFile: if the file is not a complete MCAP file.
+    """
+    footer_offset = size - len(MCAP_MAGIC) - _MCAP_FOOTER.size
+    if footer_offset < len(MCAP_MAGIC) + _MCAP_DATA_END.size:
+        raise CorruptFile("Truncated MCAP file")
+    if os.pread(f.fileno(), len(MCAP_MAGIC), 0) != MCAP_MAGIC:
+        raise CorruptFile("Missing MCAP header magic")
+    tail = os.pread(f.fileno(), _MCAP_FOOTER.size + len(MCAP_MAGIC), footer_offset)
+    if tail[_MCAP_FOOTER.size :] != MCAP_MAGIC:
+        raise CorruptFile("Missing MCAP trailing magic, the file is truncated")
+    opcode, length, summary_start, _, summary_crc = _MCAP_FOOTER.unpack(tail[: _MCAP_FOOTER.size])
+    if opcode != _MCAP_OP_FOOTER or length != _MCAP_FOOTER.size - 9:
+        raise CorruptFile("Invalid MCAP footer")
+    if summary_start > footer_offset:
+        raise CorruptFile("MCAP summary starts past the footer")
+
+    consumers: List[ScanConsumer] = []
+    if summary_crc:
+        # From the summary, if any, up to summary_offset_start in the footer
+        end = footer_offset + _MCAP_FOOTER.size - 4
+        consumers.append(
+            RangeCrc(summary_start or footer_offset, end, summary_crc, "MCAP summary")
+        )
+
+    data_end_offset = (summary_start or footer_offset) - _MCAP_DATA_END.size
+    opcode, length, data_crc = _MCAP_DATA_END.unpack(
+        os.pread(f.fileno(), _MCAP_DATA_END.size, data_end_offset)
+    )
+    if opcode != _MCAP_OP_DATA_END or length != 4:
+        raise CorruptFile("Missing MCAP data end record")
+    if data_crc:
+        # The leading magic is part of the data section CRC
+        consumers.append(RangeCrc(0, data_end_offset, data_crc, "MCAP data"))
+    return consumers
+
+
+def check_sqlite(f, path: str, size: int) -> None:
+    """Check a rosbag2 SQLite file.
+
+    Raises:
+        CorruptFile: if the file is not a complete SQLite database.
+    """
+    header = os.pread(f.fileno(), 100, 0)
+    if len(header) < 100 or not header.startswith(SQLITE_MAGIC):
+        raise CorruptFile("Missing SQLite header")
+    page_size = struct.unpack(">H", header[16:18])[0]
+    page_size = 65536 if page_size == 1 else page_size
+    change_counter, page_count = struct.unpack(">II", header[24:32])
+    # The page count is only valid when written by a recent SQLite
+    valid_for = struct.unpack(">I", header[92:96])[0]
+    if change_counter == valid_for and page_count * page_size != size:
+        raise CorruptFile(f"SQLite file of {size} bytes for {page_count} pages")
+
+    try:
+        db = sqlite3.connect(f"file:{quote(path)}?mode=ro&immutable=1", uri=True)
+        try:
+            result = db.execute("PRAGMA quick_check").fetchone()[0]
+        finally:
+            db.close()
+    except sqlite3.DatabaseError as e:
+        raise CorruptFile(f"SQLite error: {e}")
+    if result != "ok":
+        raise CorruptFile(f"SQLite quick_check: {result}")
+
+
+def listed_files(bag_dir: str) -> List[str]:
+    """Return the files listed in the `metadata.yaml` of a bag."""
+    try:
+        with open(os.path.join(bag_dir, BAG_METADATA_FILE)) as f:
+            match = _RELATIVE_FILE_PATHS_RE.search(f.read())
+    except OSError:
+        return []
+    if not match:
+        return []
+    return [
+        line.strip().lstrip("-").strip().strip("'\"")
+        for line in match.group(1).splitlines()
+        if line.strip()
+    ]
+
+
+class SqliteCheck(ScanConsumer):
+    """Integrity check of a SQLite file, once it is read."""
+
+    def __init__(self, f, path: str, size: int):
+        self.f = f
+        self.path = path
+        self.size = size
+
+    def finish(self) -> None:
+        """Check the file, its pages are in the page cache by now."""
+        check_sqlite(self.f, self.path, self.size)
+
+
+class VerifyStage(Stage):
+    """Validate the files of the bags, and quarantine the corrupt bags."""
+
+    name = "verify"
+
+    def __init__(self, root: str):
+        self.quarantine = os.path.join(root, STATE_DIR, QUARANTINE_DIR)
+
+    def consumers(self, job: BagJob, path: str, f, size: int) -> List[ScanConsumer]:
+        """Return the checks of a MCAP or SQLite file."""
+        if path.endswith(".mcap"):
+            return mcap_consumers(f, size)
+        if path.endswith(".db3"):
+            return [SqliteCheck(f, path, size)]
+        return []
+
+    def finish(self, job: BagJob) -> None:
+        """Quarantine the bag if any file is corrupt or missing."""
+        problems = job.problems + [
+            f"{name}: listed in {BAG_METADATA_FILE} but missing"
+            for name in listed_files(job.bag_dir)
+            if not os.path.isfile(os.path.join(job.bag_dir, name))
+        ]
+        if not problems:
+            return
+
+        destination = os.path.join(self.quarantine, job.bag)
+        suffix = 1
+        while os.path.exists(destination):
+            destination = os.path.join(self.quarantine, f"{job.bag}-{suffix}")
+            suffix += 1
+        # Not os.renames, that would remove the upload directory left empty
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.rename(job.bag_dir, destination)
+        with open(os.path.join(destination, "QUARANTINED"), "w") as f:
+            f.write("\n".join(problems) + "\n")
+        job.quarantined = True
+        logger.warning("Quarantined corrupt bag '%s': %s", job.bag, "; ".join(problems))
@@ -17,69 +17,139 @@
 
 """A kubernetes charm for storing robotics bag files."""
 
+import hashlib
 import json
 import logging
+import os
 import socket
+import time
+from functools import cached_property
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Optional
 from urllib.parse import urlparse
 
-from charms.blackbox_exporter_k8s.v0.blackbox_probes import BlackboxProbesProvider
-from charms.catalogue_k8s.v0.catalogue import CatalogueConsumer, CatalogueItem
-from charms.traefik_k8s.v1.ingress_per_unit import (
-    IngressPerUnitReadyForUnitEvent,
-    IngressPerUnitRequirer,
-)
-from charms.traefik_k8s.v2.ingress import (
-    IngressPerAppReadyEvent,
-    IngressPerAppRequirer,
-)
 from ops.charm import (
+    ActionEvent,
     CharmBase,
+    PebbleReadyEvent,
 )
+from ops.framework import StoredState
 from ops.main import main
-from ops.model import ActiveStatus, MaintenanceStatus, ModelError, OpenedPort, WaitingStatus
-from ops.pebble import ExecError, Layer
-
-from auth_devices_keys import AuthDevicesKeysConsumer
+from ops.model import (
+    ActiveStatus,
+    BlockedStatus,
+    MaintenanceStatus,
+    ModelError,
+    OpenedPort,
+    StatusBase,
+    WaitingStatus,
+)
+from ops.pebble import ExecError, Layer, PathError
+
+from auth_devices_keys import DATA_KEY, MANIFEST_KEY, AuthDevicesKeysConsumer
+from bagstore import SIGNATURE_NAMESPACE
+
+# The charm libraries are imported only by the hooks that need them, as some
+# of them (e.g. pydantic-based ones) are costly to import on every dispatch.
+if TYPE_CHECKING:
+    from charms.blackbox_exporter_k8s.v0.blackbox_probes import BlackboxProbesProvider
+    from charms.catalogue_k8s.v0.catalogue import CatalogueConsumer
+    from charms.traefik_k8s.v1.ingress_per_unit import (
+        IngressPerUnitReadyForUnitEvent,
+        IngressPerUnitRequirer,
+    )
+    from charms.traefik_k8s.v2.ingress import (
+        IngressPerAppReadyEvent,
+        IngressPerAppRequirer,
+    )
 
 # Log messages can be retrieved using juju debug-log
 logger = logging.getLogger(__name__)
 
 VALID_LOG_LEVELS = ["info", "debug", "warning", "error", "critical"]
+VALID_STORAGE_LAYOUTS = ["flat", "partitioned"]
+
+STORAGE_PATH = "/var/lib/caddy-fileserver"
+PREVIEWS_PATH = "/_previews"
+CADDYFILE_PATH = "/srv/Caddyfile"
+# The Caddyfile of the image, while the charm renders its own
+CADDYFILE_IMAGE_PATH = "/srv/Caddyfile.image"
+CADDY_SNIPPETS_PATH = "/srv/bagstore"
+# Digest of the configuration last applied to the workload container
+FINGERPRINT_PATH = "/srv/.charm-fingerprint"
+
+# The workload helpers are shipped with the charm and pushed to the workload
+BAGSTORE_SRC_PATH = Path(__file__).parent / "bagstore"
+BAGSTORE_PATH = "/opt/ros2bag-fileserver"
+LAYOUT_SERVICE = "bagstore-layout"
+UPLOAD_SERVICE = "bagstore-upload"
+PIPELINE_SERVICE = "bagstore-pipeline"
+INDEX_SERVICE = "bagstore-index"
+CATCH_UP_SERVICE = "bagstore-catch-up"
+RECOMPRESS_SERVICE = "bagstore-recompress"
+SCHEDULER_SERVICE = "bagstore-scheduler"
+METRICS_SERVICE = "bagstore-metrics"
+BAGSTORE_SERVICES = [
+    LAYOUT_SERVICE,
+    UPLOAD_SERVICE,
+    PIPELINE_SERVICE,
+    INDEX_SERVICE,
+    CATCH_UP_SERVICE,
+    RECOMPRESS_SERVICE,
+    SCHEDULER_SERVICE,
+    METRICS_SERVICE,
+]
+UPLOAD_ADDRESS = "127.0.0.1:8081"
+INDEX_ADDRESS = "127.0.0.1:8082"
+LAYOUT_ADDRESS = "127.0.0.1:8083"
+# Scraped on the unit address, the ingress only routes to Caddy
+METRICS_ADDRESS = "0.0.0.0:8084"
+# Concurrency and rate limits of the uploads, see bagstore.admission
+ADMISSION_LIMITS_PATH = "/srv/bagstore-limits.json"
+# Progress of the time index catch-up, see bagstore.catchup
+CATCH_UP_PROGRESS_PATH = f"{STORAGE_PATH}/.bagstore/catch-up.json"
+# Storage usage shown in the unit status, below the high-water mark
+STORAGE_WARNING_PERCENT = 90
+
+AUTHORIZED_KEYS_PATH = "/root/.ssh/authorized_keys"
+ALLOWED_SIGNERS_PATH = "/root/.ssh/allowed_signers"
+
+
+def _format_duration(seconds: float) -> str:
+    """Return a duration as hours and minutes, e.g. `1h20m`."""
+    minutes = max(1, round(seconds / 60))
+    return f"{minutes // 60}h{minutes % 60:02d}m" if minutes >= 60 else f"{minutes}m"
 
 
 class Ros2bagFileserverCharm(CharmBase):
     """Charm to run a ROS 2 bag fileserver on Kubernetes."""
 
+    _stored = StoredState()
+
     def __init__(self, *args):
         super().__init__(*args)
         self.name = "ros2bag-fileserver"
+        self._stored.set_default(
+            workload_fingerprint="", running_status=["active", ""], catch_up_message=""
+        )
 
         self.container = self.unit.get_container(self.name)
-        self.caddyfile_config = ""
-        self._ssh_port = int(self.config["ssh-port"])
         self.set_ports()
 
-        self.ingress_http = IngressPerAppRequirer(
-            self,
-            relation_name="ingress-http",
-            strip_prefix=True,
-            port=80,
-        )
+        self.ingress_http: Optional["IngressPerAppRequirer"] = None
+        if self._is_related("ingress-http"):
+            self._setup_ingress_http()
 
-        self.ingress_tcp = IngressPerUnitRequirer(
-            self,
-            relation_name="ingress-tcp",
-            port=self._ssh_port,
-            mode="tcp",
-        )
-
-        self.framework.observe(self.ingress_tcp.on.ready_for_unit, self._on_ingress_ready_tcp)
-        self.framework.observe(self.ingress_http.on.ready, self._on_ingress_ready_http)
+        self.ingress_tcp: Optional["IngressPerUnitRequirer"] = None
+        if self._is_related("ingress-tcp"):
+            self._setup_ingress_tcp()
 
         self.framework.observe(self.on.install, self._on_install)
         self.framework.observe(
             self.on.ros2bag_fileserver_pebble_ready, self._update_layer_and_restart
         )
+        self.framework.observe(self.on.config_changed, self._update_layer_and_restart)
+        self.framework.observe(self.on.update_status, self._on_update_status)
 
         # -- device_keys relation observations
         self.auth_devices_keys_consumer = AuthDevicesKeysConsumer(
@@ -91,14 +161,64 @@ class Ros2bagFileserverCharm(CharmBase):
             self._on_auth_devices_keys_changed,
         )
 
+        # -- store inspection, answered from the bag index
+        self.framework.observe(self.on.list_bags_action, self._on_list_bags_action)
+        self.framework.observe(self.on.find_bags_action, self._on_find_bags_action)
+        self.framework.observe(self.on.store_stats_action, self._on_store_stats_action)
+
+        self.catalog: Optional["CatalogueConsumer"] = None
+        if self._is_related("catalogue"):
+            self._setup_catalogue()
+
+        self.blackbox_probes_provider: Optional["BlackboxProbesProvider"] = None
+        if self._is_related("blackbox-probes"):
+            self._setup_blackbox_probes()
+
+    def _is_related(self, relation_name: str) -> bool:
+        """Whether the relation exists, or the hook being dispatched is about it."""
+        if os.environ.get("JUJU_RELATION") == relation_name:
+            return True
+        return bool(self.model.relations[relation_name])
+
+    def _setup_ingress_http(self) -> None:
+        from charms.traefik_k8s.v2.ingress import IngressPerAppRequirer
+
+        self.ingress_http = IngressPerAppRequirer(
+            self,
+            relation_name="ingress-http",
+            host=self._hostname,
+            strip_prefix=True,
+            port=80,
+            scheme=lambda: self._upstream_scheme,
+        )
+        self.framework.observe(self.ingress_http.on.ready, self._on_ingress_ready_http)
+
+    def _setup_ingress_tcp(self) -> None:
+        from charms.traefik_k8s.v1.ingress_per_unit import IngressPerUnitRequirer
+
+        self.ingress_tcp = IngressPerUnitRequirer(
+            self,
+            relation_name="ingress-tcp",
+            host=self._hostname,
+            port=self._ssh_port,
+            mode="tcp",
+        )
+        self.framework.observe(self.ingress_tcp.on.ready_for_unit, self._on_ingress_ready_tcp)
+
+    def _setup_catalogue(self) -> None:
+        from charms.catalogue_k8s.v0.catalogue import CatalogueConsumer, CatalogueItem
+
+        refresh_event = [
+            self.on.ros2bag_fileserver_pebble_ready,
+            self.on["ingress-http"].relation_broken,
+            self.on.config_changed,
+        ]
+        if self.ingress_http:
+            refresh_event.append(self.ingress_http.on.ready)
+
         self.catalog = CatalogueConsumer(
             charm=self,
-            refresh_event=[
-                self.on.ros2bag_fileserver_pebble_ready,
-                self.ingress_http.on.ready,
-                self.on["ingress-http"].relation_broken,
-                self.on.config_changed,
-            ],
+            refresh_event=refresh_event,
             item=CatalogueItem(
                 name="ros2bag fileserver",
                 icon="graph-line-variant",
@@ -107,15 +227,18 @@ class Ros2bagFileserverCharm(CharmBase):
             ),
         )
 
+    def _setup_blackbox_probes(self) -> None:
+        from charms.blackbox_exporter_k8s.v0.blackbox_probes import BlackboxProbesProvider
+
+        refresh_event = [self.on.update_status, self.on.config_changed]
+        if self.ingress_http:
+            refresh_event.append(self.ingress_http.on.ready)
+
         self.blackbox_probes_provider = BlackboxProbesProvider(
             charm=self,
             probes=self.self_probe,
             relation_name="blackbox-probes",
-            refresh_event=[
-                self.on.update_status,
-                self.ingress_http.on.ready,
-                self.on.config_changed,
-            ],
+            refresh_event=refresh_event,
         )
 
     def _on_auth_devices_keys_changed(self, event) -> None:
@@ -126,34 +249,148 @@ class Ros2bagFileserverCharm(CharmBase):
             event.defer()
             return
 
-        if not self.auth_devices_keys_consumer.relation_data:
+        relation_data = self.auth_devices_keys_consumer.relation_data
+        if not relation_data:
             return
 
-        if not self.auth_devices_keys_consumer.relation_data["auth_devices_keys"]:
+        if not (relation_data.get(DATA_KEY) or relation_data.get(MANIFEST_KEY)):
             logger.error("No data in the relation")
             return
 
-        auth_devices_keys = self.auth_devices_keys_consumer.relation_data[  # pyright: ignore
-            "auth_devices_keys"
-        ]
+        if self._ssh_gated:
+            # The forced command of the keys runs the admission gate
+            self._push_bagstore()
+            self._push_if_changed(ADMISSION_LIMITS_PATH, self._admission_limits)
+        self._push_auth_devices_keys()
 
-        auth_devices_keys_list = json.loads(auth_devices_keys)
-
-        public_ssh_keys = [entry["public_ssh_key"] + "\n" for entry in auth_devices_keys_list]
-
-        string_of_keys = "".join(public_ssh_keys)
+    def _push_auth_devices_keys(self) -> None:
+        """Push the authorized_keys of the devices and the allowed signers of their uploads."""
+        self.container.push(
+            AUTHORIZED_KEYS_PATH,
+            self._authorized_keys,
+            permissions=0o600,
+            make_dirs=True,
+        )
+        # The same keys authenticate the signed HTTP upload requests
+        allowed_signers = [
+            f'{entry["uid"]} namespaces="{SIGNATURE_NAMESPACE}" {entry["public_ssh_key"]}\n'
+            for entry in self._auth_devices_keys
+        ]
         self.container.push(
-            "/root/.ssh/authorized_keys",
-            string_of_keys,
+            ALLOWED_SIGNERS_PATH,
+            "".join(allowed_signers),
             permissions=0o600,
             make_dirs=True,
         )
 
-    def _on_ingress_ready_tcp(self, event: IngressPerUnitReadyForUnitEvent):
+    def _on_list_bags_action(self, event: ActionEvent) -> None:
+        self._inspect(event, "list-bags")
+
+    def _on_find_bags_action(self, event: ActionEvent) -> None:
+        self._inspect(event, "find-bags")
+
+    def _on_store_stats_action(self, event: ActionEvent) -> None:
+        self._inspect(event, "store-stats")
+
+    def _inspect(self, event: ActionEvent, query: str) -> None:
+        """Answer an inspection action from the bag index, rather than walking the storage."""
+        if not self.container.can_connect():
+            event.fail("Cannot connect to the workload container")
+            return
+
+        command = ["python3", "-m", "bagstore", "--root", STORAGE_PATH, "inspect", query]
+        for name in ("uid", "topic", "since", "until", "cursor", "limit"):
+            if event.params.get(name) is not None:
+                command += [f"--{name}", str(event.params[name])]
+        self._push_bagstore()
+        try:
+            stdout, _ = self.container.exec(
+                command, environment={"PYTHONPATH": BAGSTORE_PATH}
+            ).wait_output()
+        except ExecError as e:
+            event.fail(f"Cannot query the bag index: {e.stderr or e}")
+            return
+
+        answer = json.loads(stdout)
+        if query == "store-stats":
+            event.set_results({name: str(value) for name, value in answer.items()})
+            return
+        event.log(f"{len(answer['bags'])} bags")
+        results = {"bags": json.dumps(answer["bags"])}
+        if answer["next-cursor"]:
+            results["next-cursor"] = answer["next-cursor"]
+        event.set_results(results)
+
+    @property
+    def _auth_devices_keys(self) -> List[dict]:
+        """Return the devices and their keys shared through the auth-devices-keys relation."""
+        return self.auth_devices_keys_consumer.auth_devices_keys
+
+    @property
+    def _admission_limits(self) -> str:
+        """Return the admission limits of the uploads, as read by the workload helpers."""
+        rate_limits = {
+            entry["uid"]: int(entry["upload_rate_limit"])
+            for entry in self._auth_devices_keys
+            if "upload_rate_limit" in entry
+        }
+        priorities = {
+            entry["uid"]: entry["upload_priority"]
+            for entry in self._auth_devices_keys
+            if "upload_priority" in entry
+        }
+        limits = {
+            "max_concurrent": int(self.config["upload-max-concurrent"]),
+            "max_per_device": int(self.config["upload-max-per-device"]),
+            "rate_limit": int(self.config["upload-rate-limit"]),
+            "rate_limits": rate_limits,
+            "priorities": priorities,
+            "high_water": int(self.config["storage-high-water"]),
+        }
+        return json.dumps(limits, sort_keys=True)
+
+    @property
+    def _admission_enabled(self) -> bool:
+        limits = json.loads(self._admission_limits)
+        return any(limits.values())
+
+    @property
+    def _ssh_gated(self) -> bool:
+        """Whether the rsync uploads run through the `ssh-gate` helper."""
+        # The gate also records the uploads for the background workers, and drops
+        # the ETags of the processed files rsync replaces
+        return (
+            self._admission_enabled
+            or bool(self.config["upload-preallocate"])
+            or bool(self._pipeline_stages)
+            or self._storage_layout == "partitioned"
+        )
+
+    @property
+    def _authorized_keys(self) -> str:
+        """Return the authorized_keys of the devices, gating their rsync uploads if limited."""
+        gated = self._ssh_gated
+        preallocate = " --preallocate" if self.config["upload-preallocate"] else ""
+        lines = []
+        for entry in self._auth_devices_keys:
+            if gated:
+                command = " ".join(
+                    [
+                        f"env PYTHONPATH={BAGSTORE_PATH} python3 -m bagstore",
+                        f"--root {STORAGE_PATH} ssh-gate",
+                        f"--uid {entry['uid']} --limits {ADMISSION_LIMITS_PATH}{preallocate}",
+                    ]
+                )
+                lines.append(f'command="{command}" {entry["public_ssh_key"]}\n')
+            else:
+                lines.append(entry["public_ssh_key"] + "\n")
+        return "".join(lines)
+
+    def _on_ingress_ready_tcp(self, event: "IngressPerUnitReadyForUnitEvent"):
         logger.info("Ingress for unit ready on '%s'", event.url)
         self._update_layer_and_restart(event)
 
-    def _on_ingress_ready_http(self, event: IngressPerAppReadyEvent):
+    def _on_ingress_ready_http(self, event: "IngressPerAppReadyEvent"):
         logger.info("Ingress for unit ready on '%s'", event.url)
         if not self.unit.is_leader():
             return
@@ -163,34 +400,220 @@ class Ros2bagFileserverCharm(CharmBase):
         """Handler for the "install" event during which we will update the K8s service."""
         self.set_ports()
 
-    def _update_layer_and_restart(self, _) -> None:
+    def _update_layer_and_restart(self, event) -> None:
         """Define and start a workload using the Pebble API."""
         self.unit.status = MaintenanceStatus("Assembling pod spec")
 
-        self.ingress_tcp.provide_ingress_requirements(
-            scheme=urlparse(self.internal_url).scheme, port=self._ssh_port
-        )
-        self.ingress_http.provide_ingress_requirements(
-            scheme=urlparse(self.internal_url).scheme, port=80
-        )
+        scheme = urlparse(self.internal_url).scheme
+        if self.ingress_tcp:
+            self.ingress_tcp.provide_ingress_requirements(
+                scheme=scheme, host=self._hostname, port=self._ssh_port
+            )
+        if self.ingress_http:
+            self.ingress_http.provide_ingress_requirements(
+                scheme=self._upstream_scheme, host=self._hostname, port=80
+            )
+
+        if self._storage_layout not in VALID_STORAGE_LAYOUTS:
+            self.unit.status = BlockedStatus(
+                f"Invalid storage-layout '{self._storage_layout}', "
+                f"expected one of {VALID_STORAGE_LAYOUTS}"
+            )
+            return
+
+        fingerprint = self._workload_fingerprint
+        # A restarted workload container fires pebble-ready and must always be
+        # checked, other events can trust the fingerprint of the last update.
+        if (
+            not isinstance(event, PebbleReadyEvent)
+            and self._stored.workload_fingerprint == fingerprint  # type: ignore
+        ):
+            logger.debug("Workload is up to date, skipping update")
+            # The last status of the running unit, without any I/O: update-status refreshes it
+            name, message = self._stored.running_status  # type: ignore
+            self.unit.status = StatusBase.from_name(name, message)
+            return
 
         if self.container.can_connect():
-            new_layer = self._pebble_layer.to_dict()
+            if self._read_fingerprint_marker() != fingerprint:
+                self._configure_workload()
+                self.container.push(FINGERPRINT_PATH, fingerprint, make_dirs=True)
+            self._stored.workload_fingerprint = fingerprint
+            self._set_running_status()
+        else:
+            self.unit.status = WaitingStatus("Waiting for Pebble in workload container")
+
+    def _on_update_status(self, _) -> None:
+        status = self.unit.status
+        # Other problems are resolved by the events that caused them
+        if isinstance(status, ActiveStatus) or (
+            isinstance(status, BlockedStatus) and status.message.startswith("Storage")
+        ):
+            self._stored.catch_up_message = self._catch_up_message()
+            self._set_running_status()
 
-            self._set_ssh_server_port("/etc/ssh/sshd_config")
+    @property
+    def _storage_usage(self) -> Optional[int]:
+        """Return the percentage of the storage in use, None if it is not attached."""
+        storages = self.model.storages["database"]
+        if not storages:
+            return None
+        stat = os.statvfs(storages[0].location)
+        if not stat.f_blocks:
+            return None
+        return 100 - stat.f_bavail * 100 // stat.f_blocks
+
+    def _storage_status(self):
+        """Return the status of a running unit, given the usage of its storage."""
+        usage = self._storage_usage
+        high_water = int(self.config["storage-high-water"])
+        if usage is None:
+            return ActiveStatus()
+        if high_water and usage >= high_water:
+            return BlockedStatus(f"Storage {usage}% full, new uploads are refused")
+        if usage >= STORAGE_WARNING_PERCENT:
+            return ActiveStatus(f"Storage {usage}% full")
+        return ActiveStatus()
+
+    def _catch_up_message(self) -> str:
+        """Return the progress of the time index catch-up, empty once it is done."""
+        if not self.config["time-index"] or not self.container.can_connect():
+            return ""
+        try:
+            progress = json.loads(self.container.pull(CATCH_UP_PROGRESS_PATH).read())
+        except (PathError, ValueError):
+            return ""
+        if progress["done"] >= progress["total"]:
+            return ""
+        message = f"Indexing backlog: {progress['done']}/{progress['total']} bags"
+        if progress["eta"] is not None:
+            message += f", ETA {_format_duration(progress['eta'])}"
+        return message
+
+    def _set_running_status(self) -> None:
+        """Set the status of a running unit, with the last progress of its background work."""
+        status = self._storage_status()
+        message = self._stored.catch_up_message  # type: ignore
+        if message:
+            if status.message:
+                message = f"{status.message}; {message}"
+            status = type(status)(message)
+        self.unit.status = status
+        self._stored.running_status = [status.name, status.message]
+
+    def _configure_workload(self) -> None:
+        """Push the workload configuration and update its Pebble plan."""
+        new_layer = self._pebble_layer.to_dict()
+        new_services = new_layer["services"]  # pyright: ignore
+
+        self._set_ssh_server_port("/etc/ssh/sshd_config")
+        # The workload helpers are only pushed to deployments using them
+        bagstore_changed = False
+        if self._ssh_gated or set(BAGSTORE_SERVICES) & new_services.keys():
+            bagstore_changed = self._push_bagstore()
+            # Read by the upload helpers on the fly, there is nothing to restart
+            self._push_if_changed(ADMISSION_LIMITS_PATH, self._admission_limits)
+        caddyfile_changed = self._push_caddyfile()
+        if self._auth_devices_keys:
+            self._push_auth_devices_keys()
+
+        # Get the current pebble layer config
+        services = self.container.get_plan().to_dict().get("services", {})
+        current = {name: services[name] for name in new_services if name in services}
+
+        # Pebble cannot drop a service from the plan, disable it instead
+        disabled = [
+            name
+            for name in BAGSTORE_SERVICES
+            if name in services
+            and name not in new_services
+            and services[name].get("startup") != "disabled"
+        ]
+        for name in disabled:
+            new_services[name] = {"override": "merge", "startup": "disabled"}
+
+        if current != new_services or disabled:
+            self.container.add_layer(self.name, Layer(new_layer), combine=True)
+
+            logger.info("Added updated layer 'ros2bag fileserver' to Pebble plan")
+
+        restart = [
+            name
+            for name, service in new_services.items()
+            if name not in disabled
+            and (
+                current.get(name) != service
+                or (name == self.name and caddyfile_changed)
+                or (name in BAGSTORE_SERVICES and bagstore_changed)
+            )
+        ]
+        if restart:
+            self.container.restart(*restart)
+            logger.info(f"Restarted services {restart}")
+        if disabled:
+            self.container.stop(*disabled)
+
+    def _read_fingerprint_marker(self) -> Optional[str]:
+        """Return the fingerprint of the configuration applied to the workload, if any."""
+        try:
+            return self.container.pull(FINGERPRINT_PATH).read()
+        except PathError:
+            return None
 
-            # Get the current pebble layer config
-            services = self.container.get_plan().to_dict().get("services", {})
-            if services != new_layer["services"]:  # pyright: ignore
-                self.container.add_layer(self.name, self._pebble_layer, combine=True)
+    @property
+    def _workload_fingerprint(self) -> str:
+        """Digest of everything the charm configures in the workload."""
+        digest = hashlib.sha256()
+        digest.update(json.dumps(self._pebble_layer.to_dict(), sort_keys=True).encode())
+        digest.update(self.caddyfile_config.encode())
+        digest.update(str(self._ssh_port).encode())
+        digest.update(self._admission_limits.encode())
+        for source in sorted(BAGSTORE_SRC_PATH.glob("*.py")):
+            digest.update(source.read_bytes())
+        return digest.hexdigest()
+
+    def _push_if_changed(self, path: str, content: str) -> bool:
+        """Push a file to the workload, return whether its content changed."""
+        if self.container.exists(path) and self.container.pull(path).read() == content:
+            return False
+        self.container.push(path, content, make_dirs=True)
+        return True
 
-                logger.info("Added updated layer 'ros2bag fileserver' to Pebble plan")
+    @property
+    def _custom_caddyfile(self) -> bool:
+        """Whether a feature needs the Caddyfile rendered by the charm, not the image's one."""
+        return bool(
+            self._storage_layout == "partitioned"
+            or self.config["http-upload"]
+            or self.config["time-index"]
+            or self.config["previews"]
+            or self.config["enable-h2c"]
+            or self._pipeline_stages
+        )
 
-                self.container.restart(self.name)
-                logger.info(f"Restarted '{self.name}' service")
-            self.unit.status = ActiveStatus()
-        else:
-            self.unit.status = WaitingStatus("Waiting for Pebble in workload container")
+    def _push_caddyfile(self) -> bool:
+        """Push the Caddyfile features need, or restore the image's one, return if it changed."""
+        if not self._custom_caddyfile:
+            if not self.container.exists(CADDYFILE_IMAGE_PATH):
+                return False
+            return self._push_if_changed(
+                CADDYFILE_PATH, self.container.pull(CADDYFILE_IMAGE_PATH).read()
+            )
+        if self.container.exists(CADDYFILE_PATH) and not self.container.exists(
+            CADDYFILE_IMAGE_PATH
+        ):
+            # Kept to go back to once the features are disabled
+            self.container.push(CADDYFILE_IMAGE_PATH, self.container.pull(CADDYFILE_PATH).read())
+        return self._push_if_changed(CADDYFILE_PATH, self.caddyfile_config)
+
+    def _push_bagstore(self) -> bool:
+        """Push the workload helpers that the Pebble services run, return whether they changed."""
+        changed = False
+        for source in sorted(BAGSTORE_SRC_PATH.glob("*.py")):
+            changed |= self._push_if_changed(
+                f"{BAGSTORE_PATH}/bagstore/{source.name}", source.read_text()
+            )
+        return changed
 
     def set_ports(self):
         """Open necessary (and close no longer needed) workload ports."""
@@ -223,14 +646,39 @@ class Ros2bagFileserverCharm(CharmBase):
         except ExecError as e:
             logger.error(f"Error: {e}")
 
+    @property
+    def _ssh_port(self) -> int:
+        return int(self.config["ssh-port"])
+
+    @property
+    def _storage_layout(self) -> str:
+        return str(self.config["storage-layout"])
+
     @property
     def _scheme(self) -> str:
         return "http"
 
     @property
+    def _upstream_scheme(self) -> str:
+        """Return the scheme the ingress uses to reach the workload."""
+        return "h2c" if self.config["enable-h2c"] else self._scheme
+
+    @cached_property
+    def _hostname(self) -> str:
+        """Return the workload's FQDN, resolved only once per hook dispatch.
+
+        Resolving the FQDN is a blocking DNS lookup, which can be slow on
+        some clusters.
+        """
+        start = time.monotonic()
+        hostname = socket.getfqdn()
+        logger.debug("Resolved FQDN '%s' in %.3fs", hostname, time.monotonic() - start)
+        return hostname
+
+    @cached_property
     def internal_url(self) -> str:
         """Return workload's internal URL. Used for ingress."""
-        return f"{self._scheme}://{socket.getfqdn()}:{80}"
+        return f"{self._scheme}://{self._hostname}:{80}"
 
     @property
     def external_url(self) -> str:
@@ -244,7 +692,7 @@ class Ros2bagFileserverCharm(CharmBase):
         routable from the outside, e.g., when deploying on MicroK8s on Linux.
         """
         try:
-            if ingress_url := self.ingress_http.url:
+            if self.ingress_http and (ingress_url := self.ingress_http.url):
                 return ingress_url
         except ModelError as e:
             logger.error("Failed obtaining external url: %s. Shutting down?", e)
@@ -262,23 +710,230 @@ class Ros2bagFileserverCharm(CharmBase):
         }
         return [probe]
 
+    @property
+    def caddyfile_config(self) -> str:
+        """Return the Caddyfile serving the storage."""
+        imports = ""
+        if self._storage_layout == "partitioned":
+            # Redirects from where bags were uploaded to their partition
+            imports = f"\timport {CADDY_SNIPPETS_PATH}/*.caddy\n"
+
+        upload = ""
+        if self.config["http-upload"]:
+            # The metrics of the upload server are only for the scheduler
+            upload = (
+                "\t@upload {\n"
+                "\t\tpath /upload/*\n"
+                "\t\tnot path /upload/metrics\n"
+                "\t}\n"
+                f"\treverse_proxy @upload {UPLOAD_ADDRESS}\n"
+            )
+
+        time_index = ""
+        if self.config["time-index"]:
+            # Its metrics are served with the others, see bagstore.metrics
+            time_index = (
+                "\t@index {\n"
+                "\t\tpath /_index/*\n"
+                "\t\tnot path /_index/metrics\n"
+                "\t}\n"
+                f"\treverse_proxy @index {INDEX_ADDRESS}\n"
+            )
+
+        previews = ""
+        if self.config["previews"]:
+            # Previews are content-addressed, only the listing changes
+            previews = (
+                f"\thandle_path {PREVIEWS_PATH}/* {{\n"
+                f"\t\troot * {STORAGE_PATH}/.bagstore/previews\n"
+                "\t\t@listing path / /index.html\n"
+                "\t\t@preview not path / /index.html\n"
+                "\t\theader @listing Cache-Control no-cache\n"
+                '\t\theader @preview Cache-Control "public, max-age=31536000, immutable"\n'
+                "\t\tfile_server\n"
+                "\t}\n"
+            )
+
+        caching = '\theader @listing Cache-Control "public, max-age=10"\n'
+        hide = ".bagstore"
+        etags = ""
+        if self._pipeline_stages:
+            # Processed files have an ETag from their SHA-256 and never change, see
+            # bagstore.pipeline. Files still uploading or processing are revalidated.
+            caching = (
+                "\t@final file {path}.sha256\n"
+                "\t@pending {\n"
+                "\t\tnot path */\n"
+                f"\t\tnot path {PREVIEWS_PATH}/*\n"
+                "\t\tnot file {path}.sha256\n"
+                "\t}\n"
+                '\theader @final Cache-Control "public, max-age=31536000, immutable"\n'
+                f"{caching}"
+                "\theader @pending Cache-Control no-cache\n"
+            )
+            hide += " *.sha256 *.sha256.tmp"
+            # Needs Caddy 2.8
+            etags = "\t\tetag_file_extensions .sha256\n"
+
+        global_options = ""
+        if self.config["enable-h2c"]:
+            # Multiplex the many parallel range requests coming from the ingress
+            global_options = "{\n\tservers :80 {\n\t\tprotocols h1 h2c\n\t}\n}\n\n"
+
+        return (
+            f"{global_options}"
+            ":80 {\n"
+            f"\troot * {STORAGE_PATH}\n"
+            "\theader Access-Control-Allow-Origin *\n"
+            f"{imports}"
+            f"{upload}"
+            f"{time_index}"
+            f"{previews}"
+            # Listings change with every upload
+            "\t@listing path */\n"
+            f"{caching}"
+            "\tfile_server browse {\n"
+            f"\t\thide {hide}\n"
+            f"{etags}"
+            "\t}\n"
+            "}\n"
+        )
+
+    @property
+    def _pipeline_stages(self) -> List[str]:
+        """Return the options enabling the post-upload pipeline stages."""
+        stages = []
+        if self.config["verify-uploads"]:
+            stages.append("--verify")
+        if self.config["previews"]:
+            stages.append("--previews")
+        if self.config["time-index"]:
+            stages.append("--time-index")
+        if float(self.config["preview-bag-rate"]) > 0:
+            stages += ["--preview-bags", "--preview-rate", str(self.config["preview-bag-rate"])]
+        return stages
+
+    def _bagstore_service(self, summary: str, *args: str) -> dict:
+        """Return the Pebble service running a workload helper command."""
+        return {
+            "override": "replace",
+            "summary": summary,
+            "command": " ".join(["python3", "-m", "bagstore", "--root", STORAGE_PATH, *args]),
+            "startup": "enabled",
+            "environment": {"PYTHONPATH": BAGSTORE_PATH},
+        }
+
     @property
     def _pebble_layer(self):
         """Return a dictionary representing a Pebble layer."""
-        command = " ".join(["caddy", "run", "--config", "/srv/Caddyfile"])
+        command = " ".join(["caddy", "run", "--config", CADDYFILE_PATH])
+
+        services = {
+            self.name: {
+                "override": "replace",
+                "summary": "ros2bag-fileserver-k8s service",
+                "command": command,
+                "startup": "enabled",
+            }
+        }
+
+        if self._storage_layout == "partitioned":
+            services[LAYOUT_SERVICE] = self._bagstore_service(
+                "move completed bags to time partitions",
+                "partition",
+                "--snippet",
+                f"{CADDY_SNIPPETS_PATH}/redirects.caddy",
+                "--caddyfile",
+                CADDYFILE_PATH,
+                "--listen",
+                LAYOUT_ADDRESS,
+                # Only the uploads are looked at, the storage is walked hourly
+                "--interval",
+                "10",
+                "--limits",
+                ADMISSION_LIMITS_PATH,
+            )
+
+        if self._pipeline_stages:
+            options = [
+                *self._pipeline_stages,
+                "--interval",
+                "10",
+                "--limits",
+                ADMISSION_LIMITS_PATH,
+            ]
+            if self.config["recompress-bags"]:
+                # The MCAP files are final once the recompression is done with them
+                options.append("--recompression")
+            services[PIPELINE_SERVICE] = self._bagstore_service(
+                "post-upload processing of completed bags", "process", *options
+            )
+
+        if self.config["http-upload"]:
+            options = [
+                "--allowed-signers",
+                ALLOWED_SIGNERS_PATH,
+                "--limits",
+                ADMISSION_LIMITS_PATH,
+            ]
+            if self.config["upload-preallocate"]:
+                options.append("--preallocate")
+            services[UPLOAD_SERVICE] = self._bagstore_service(
+                "resumable HTTP uploads", "upload", "--listen", UPLOAD_ADDRESS, *options
+            )
+
+        if self.config["time-index"]:
+            services[INDEX_SERVICE] = self._bagstore_service(
+                "time index lookups", "serve-index", "--listen", INDEX_ADDRESS
+            )
+            # Runs once, to index the bags the pipeline processed without it
+            services[CATCH_UP_SERVICE] = {
+                **self._bagstore_service("time index catch-up of the stored bags", "catch-up"),
+                "on-success": "ignore",
+            }
+
+        if self.config["recompress-bags"]:
+            # Exits once the files are kept as they are when the workload has no zstd
+            services[RECOMPRESS_SERVICE] = {
+                **self._bagstore_service(
+                    "recompression of the MCAP files",
+                    "recompress",
+                    "--cpu-budget",
+                    str(self.config["recompress-cpu-budget"]),
+                    "--nice",
+                    str(self.config["recompress-nice"]),
+                    "--interval",
+                    "3600",
+                    "--limits",
+                    ADMISSION_LIMITS_PATH,
+                ),
+                "on-success": "ignore",
+            }
+
+        # Throttles the background workers when serving suffers, see bagstore.scheduler
+        if {PIPELINE_SERVICE, CATCH_UP_SERVICE, RECOMPRESS_SERVICE} & services.keys():
+            options = ["--probe-url", "http://127.0.0.1:80/"]
+            if UPLOAD_SERVICE in services:
+                options += ["--upload-metrics", f"http://{UPLOAD_ADDRESS}/upload/metrics"]
+            services[SCHEDULER_SERVICE] = self._bagstore_service(
+                "resource scheduling of the background workers", "schedule", *options
+            )
+
+        if self._ssh_gated or set(BAGSTORE_SERVICES) & services.keys():
+            services[METRICS_SERVICE] = self._bagstore_service(
+                "metrics of the uploads and of the background work",
+                "serve-metrics",
+                "--listen",
+                METRICS_ADDRESS,
+                "--limits",
+                ADMISSION_LIMITS_PATH,
+            )
 
         pebble_layer = Layer(
-            {
+            {  # pyright: ignore
                 "summary": "ros2bag fileserver k8s layer",
                 "description": "ros2bag fileserver k8s layer",
-                "services": {
-                    self.name: {
-                        "override": "replace",
-                        "summary": "ros2bag-fileserver-k8s service",
-                        "command": command,
-                        "startup": "enabled",
-                    }
-                },
+                "services": services,
             }
         )
 
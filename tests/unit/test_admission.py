@@ -0,0 +1,170 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from bagstore.admission import (
+    Admission,
+    AdmissionTimeout,
+    StorageFull,
+    TokenBucket,
+    run_ssh_command,
+    upload_priority,
+)
+
+
+class TestAdmission(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        self.limits_path = os.path.join(self.root, "limits.json")
+        self.admission = Admission(self.root, self.limits_path)
+        patcher = patch("bagstore.admission._POLL_SECONDS", 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def set_limits(self, **limits):
+        with open(self.limits_path, "w") as f:
+            json.dump(limits, f)
+        # Make sure the change is noticed within the mtime granularity
+        os.utime(self.limits_path, ns=(time.time_ns(), time.time_ns() + 1))
+
+    def test_uploads_are_unlimited_by_default(self):
+        with self.admission.admit("robot-1") as fds:
+            with self.admission.admit("robot-1", timeout=0):
+                self.assertEqual(fds, [])
+
+    def test_uploads_wait_for_a_slot(self):
+        self.set_limits(max_concurrent=2, max_per_device=1)
+
+        with self.admission.admit("robot-1"):
+            # The device slot is taken, but robot-2 still has a global slot
+            with self.assertRaises(AdmissionTimeout):
+                with self.admission.admit("robot-1", timeout=0.05):
+                    pass
+            with self.admission.admit("robot-2", timeout=0.05):
+                self.assertEqual(self.admission.count("active"), 2)
+                with self.assertRaises(AdmissionTimeout):
+                    with self.admission.admit("robot-3", timeout=0.05):
+                        pass
+        with self.admission.admit("robot-3", timeout=0.05):
+            pass
+
+        self.assertIn(
+            'bagstore_upload_queue_depth{priority="normal"} 0\n', self.admission.metrics()
+        )
+        self.assertIn('bagstore_upload_active{priority="normal"} 0\n', self.admission.metrics())
+
+    def test_high_priority_uploads_go_first(self):
+        self.set_limits(max_concurrent=1, priorities={"robot-9": "low"})
+        self.assertEqual(
+            upload_priority(self.admission.limits, "robot-1", "incident/a.mcap"), "high"
+        )
+        self.assertEqual(upload_priority(self.admission.limits, "robot-9", "a.mcap"), "low")
+        self.assertFalse(self.admission.preempted())
+
+        # An incident upload of another process waits for the slot
+        with self.admission._marker("waiting", "high"):
+            self.assertTrue(self.admission.preempted())
+            with self.assertRaises(AdmissionTimeout):
+                with self.admission.admit("robot-2", timeout=0.05):
+                    pass
+            with self.admission.admit("robot-3", timeout=0.05, priority="high"):
+                self.assertEqual(self.admission.count("active", "high"), 1)
+
+    def test_stale_markers_are_not_counted(self):
+        # A pid that cannot exist
+        open(os.path.join(self.admission.directory, "waiting", "4194305-dead"), "w").close()
+        self.assertEqual(self.admission.count("waiting"), 0)
+        self.assertEqual(os.listdir(os.path.join(self.admission.directory, "waiting")), [])
+
+    def test_device_rate_limits(self):
+        self.set_limits(rate_limit=64, rate_limits={"robot-2": 128})
+        self.assertEqual(self.admission.bucket("robot-1").rate, 64 << 10)
+        self.assertEqual(self.admission.bucket("robot-2").rate, 128 << 10)
+        self.assertIs(self.admission.bucket("robot-1"), self.admission.bucket("robot-1"))
+
+    @patch("bagstore.admission.time.sleep")
+    def test_device_rate_is_shared_by_processes(self, sleep):
+        self.set_limits(rate_limit=64)
+        # As an rsync of another process would
+        other = Admission(self.root, self.limits_path)
+        self.admission.bucket("robot-1").throttle(64 << 10)
+        sleep.assert_not_called()
+        other.bucket("robot-1").throttle(64 << 10)
+        self.assertAlmostEqual(sleep.call_args.args[0], 1.0, delta=0.1)
+        # Other devices have their own rate
+        sleep.reset_mock()
+        other.bucket("robot-2").throttle(64 << 10)
+        sleep.assert_not_called()
+
+    def test_uploads_are_refused_above_high_water(self):
+        self.admission.check_storage(1 << 50)
+        self.set_limits(high_water=90)
+        with patch("bagstore.admission.storage_usage", return_value=(85, 100)):
+            self.admission.check_storage(4)
+            with self.assertRaisesRegex(StorageFull, "85% full"):
+                self.admission.check_storage(5)
+            self.assertIn("bagstore_storage_high_water_ratio 0.9\n", self.admission.metrics())
+
+        with patch("bagstore.admission.storage_usage", return_value=(95, 100)):
+            command = "rsync --server -logDtpre.iLsfxCIvu . robot-1/bag"
+            self.assertEqual(run_ssh_command(self.admission, "robot-1", command), 1)
+
+    def test_rsync_preallocates_files(self):
+        command = "rsync --server -logDtpre.iLsfxCIvu . robot-1/bag"
+        with patch("bagstore.admission.subprocess.call", return_value=0) as call:
+            self.assertEqual(
+                run_ssh_command(self.admission, "robot-1", command, preallocate=True), 0
+            )
+        self.assertEqual(
+            call.call_args.args[0],
+            ["rsync", "--server", "--preallocate", "-logDtpre.iLsfxCIvu", ".", "robot-1/bag"],
+        )
+
+    def test_rsync_written_directories_are_reported(self):
+        destination = os.path.join(self.root, "robot-1")
+        os.makedirs(os.path.join(destination, "old/bag"))
+        names = ["new/bag/metadata.yaml", "new/bag/rosbag_0.mcap", "other/notes.txt"]
+
+        def rsync(argv):
+            log_path = argv[2].split("=", 1)[1]
+            self.assertEqual(argv[3:5], ["--log-file-format=%n", "-logDtpre.iLsfxCIvu"])
+            with open(log_path, "a") as f:
+                for name in ["./", "new/", "new/bag/"] + names:
+                    f.write(f"2024/01/01 12:00:00 [4242] {name}\n")
+                    if not name.endswith("/"):
+                        os.makedirs(
+                            os.path.dirname(os.path.join(destination, name)), exist_ok=True
+                        )
+                        with open(os.path.join(destination, name), "w"):
+                            pass
+                f.write(
+                    "2024/01/01 12:00:01 [4242] sent 1 bytes  received 2 bytes  total size 3\n"
+                )
+            return 23
+
+        command = f"rsync --server -logDtpre.iLsfxCIvu . {destination}"
+        uploaded = []
+        with patch("bagstore.admission.subprocess.call", side_effect=rsync):
+            status = run_ssh_command(self.admission, "robot-1", command, uploaded=uploaded.append)
+        self.assertEqual(status, 23)
+        self.assertEqual(
+            uploaded, [os.path.join(destination, "new/bag"), os.path.join(destination, "other")]
+        )
+        self.assertEqual(
+            [name for name in os.listdir(self.admission.directory) if name.endswith(".log")], []
+        )
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(1000, burst=100)
+        start = time.monotonic()
+        for _ in range(3):
+            bucket.throttle(100)
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
@@ -3,12 +3,18 @@
 
 import json
 import unittest
+from unittest.mock import patch
 
 from ops.charm import CharmBase
 from ops.framework import StoredState
 from ops.testing import Harness
 
-from auth_devices_keys import AuthDevicesKeysConsumer
+import auth_devices_keys
+from auth_devices_keys import (
+    AuthDevicesKeysConsumer,
+    AuthDevicesKeysProvider,
+    encode_auth_devices_keys,
+)
 
 if "unittest.util" in __import__("sys").modules:
     # Show full diff in self.assertEqual.
@@ -37,7 +43,9 @@ class ConsumerCharm(CharmBase):
         super().__init__(*args)
         self._stored.set_default(auth_devices_keys_events=0)
 
-        self.auth_devices_keys_consumer = AuthDevicesKeysConsumer(self)
+        self.auth_devices_keys_consumer = AuthDevicesKeysConsumer(
+            self, relation_name="auth-devices-keys"
+        )
         self.framework.observe(
             self.auth_devices_keys_consumer.on.auth_devices_keys_changed,
             self.auth_devices_keys_events,
@@ -47,6 +55,31 @@ class ConsumerCharm(CharmBase):
         self._stored.auth_devices_keys_events += 1
 
 
+FLEET = [
+    {"uid": f"robot-{i:03d}", "public_ssh_key": f"ssh-ed25519 AAAAC3NzaC1lZDI1NTE5{i:03d}"}
+    for i in range(100)
+]
+
+PROVIDER_META = """
+name: provider
+provides:
+  auth-devices-keys:
+    interface: auth_devices_keys
+"""
+
+
+class ProviderCharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.devices = []
+        self.provider = AuthDevicesKeysProvider(
+            self, relation_name="auth-devices-keys", compact=True, shards=4
+        )
+
+    def _get_auth_devices_keys_from_db(self):
+        return self.devices
+
+
 class TestAuthDevicesKeysConsumer(unittest.TestCase):
     def setUp(self):
         meta = open("charmcraft.yaml")
@@ -79,3 +112,59 @@ class TestAuthDevicesKeysConsumer(unittest.TestCase):
             rel_data["auth-devices-keys"],
             SOURCE_DATA_ASSERTION,
         )
+
+    def test_compact_shards(self):
+        rel_id = self.harness.add_relation("auth-devices-keys", "provider")
+        self.harness.add_relation_unit(rel_id, "provider/0")
+        self.harness.update_relation_data(rel_id, "provider", encode_auth_devices_keys(FLEET, 8))
+        consumer = self.harness.charm.auth_devices_keys_consumer
+        self.assertEqual(self.harness.charm._stored.auth_devices_keys_events, 1)
+        self.assertEqual(sorted(consumer.auth_devices_keys, key=lambda e: e["uid"]), FLEET)
+
+        # A new key of one device only changes its shard
+        fleet = [dict(entry) for entry in FLEET]
+        fleet[42]["public_ssh_key"] = "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5new"
+        with patch.object(
+            auth_devices_keys, "_decode_shard", wraps=auth_devices_keys._decode_shard
+        ) as decode:
+            self.harness.update_relation_data(
+                rel_id, "provider", encode_auth_devices_keys(fleet, 8)
+            )
+        self.assertEqual(decode.call_count, 1)
+        self.assertEqual(self.harness.charm._stored.auth_devices_keys_events, 2)
+        self.assertIn(fleet[42], consumer.auth_devices_keys)
+        self.assertEqual(len(consumer.auth_devices_keys), 100)
+
+    def test_corrupt_shard_keeps_previous_keys(self):
+        rel_id = self.harness.add_relation("auth-devices-keys", "provider")
+        self.harness.add_relation_unit(rel_id, "provider/0")
+        data = encode_auth_devices_keys(FLEET, 2)
+        self.harness.update_relation_data(rel_id, "provider", data)
+
+        data = encode_auth_devices_keys(FLEET[:10], 2)
+        data["auth_devices_keys_shard_1"] = data["auth_devices_keys_shard_0"]
+        with self.assertLogs("auth_devices_keys", "ERROR"):
+            self.harness.update_relation_data(rel_id, "provider", data)
+        self.assertEqual(self.harness.charm._stored.auth_devices_keys_events, 1)
+        consumer = self.harness.charm.auth_devices_keys_consumer
+        self.assertEqual(len(consumer.auth_devices_keys), 100)
+
+
+class TestAuthDevicesKeysProvider(unittest.TestCase):
+    def setUp(self):
+        self.harness = Harness(ProviderCharm, meta=PROVIDER_META)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.set_leader(True)
+        self.harness.begin()
+
+    def test_compact_encoding(self):
+        rel_id = self.harness.add_relation("auth-devices-keys", "consumer")
+        self.harness.update_relation_data(rel_id, "provider", {"auth_devices_keys": "[]"})
+        self.harness.charm.provider.update_all_auth_devices_keys_from_db(FLEET)
+
+        data = self.harness.get_relation_data(rel_id, "provider")
+        self.assertEqual(data, encode_auth_devices_keys(FLEET, 4))
+        manifest = json.loads(data["auth_devices_keys_manifest"])
+        self.assertEqual(manifest["version"], 1)
+        self.assertEqual(len(manifest["shards"]), 4)
+        self.assertLess(len(data["auth_devices_keys_shard_0"]), len(json.dumps(FLEET)) / 4)
@@ -0,0 +1,92 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from bagstore.cgroup import (
+    cpu_count,
+    cpu_limit,
+    cpu_usage,
+    memory_limit,
+    memory_usage,
+    pressure,
+)
+
+
+class TestCgroup(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        patcher = patch("bagstore.cgroup.available_cpus", return_value=16)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, path, content):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def test_cgroup_v2_quota(self):
+        self.write("cpu.max", "250000 100000\n")
+        self.assertEqual(cpu_limit(self.root), 2.5)
+        self.assertEqual(cpu_count(self.root), 3)
+
+        self.write("cpu.max", "max 100000\n")
+        self.assertEqual(cpu_count(self.root), 16)
+
+    def test_cgroup_v1_quota(self):
+        self.write("cpu/cpu.cfs_quota_us", "50000\n")
+        self.write("cpu/cpu.cfs_period_us", "100000\n")
+        self.assertEqual(cpu_limit(self.root), 0.5)
+        self.assertEqual(cpu_count(self.root), 1)
+
+        self.write("cpu/cpu.cfs_quota_us", "-1\n")
+        self.assertEqual(cpu_count(self.root), 16)
+
+    def test_no_cgroup(self):
+        self.assertEqual(cpu_count(self.root), 16)
+        # A quota above the CPUs of the node
+        self.write("cpu.max", "3200000 100000\n")
+        self.assertEqual(cpu_count(self.root), 16)
+
+    def test_memory_and_cpu_usage(self):
+        self.assertIsNone(memory_limit(self.root))
+        self.assertIsNone(cpu_usage(self.root))
+
+        self.write("memory.max", "1073741824\n")
+        self.write("memory.current", "536870912\n")
+        self.write("cpu.stat", "usage_usec 2500000\nuser_usec 2000000\n")
+        self.assertEqual(memory_limit(self.root), 1 << 30)
+        self.assertEqual(memory_usage(self.root), 1 << 29)
+        self.assertEqual(cpu_usage(self.root), 2.5)
+
+        self.write("memory.max", "max\n")
+        self.assertIsNone(memory_limit(self.root))
+
+    def test_cgroup_v1_memory(self):
+        self.write("memory/memory.limit_in_bytes", "9223372036854771712\n")
+        self.write("memory/memory.usage_in_bytes", "4096\n")
+        self.write("cpuacct/cpuacct.usage", "1500000000\n")
+        self.assertIsNone(memory_limit(self.root))
+        self.assertEqual(memory_usage(self.root), 4096)
+        self.assertEqual(cpu_usage(self.root), 1.5)
+
+    def test_pressure(self):
+        node = os.path.join(self.root, "proc")
+        self.assertIsNone(pressure("io", self.root, node))
+
+        self.write("proc/io", "some avg10=12.50 avg60=3.00 avg300=1.00 total=100\n")
+        self.assertEqual(pressure("io", self.root, node), 0.125)
+
+        # The pressure of the cgroup comes first
+        self.write(
+            "io.pressure",
+            "some avg10=40.00 avg60=3.00 avg300=1.00 total=100\n"
+            "full avg10=20.00 avg60=1.00 avg300=0.50 total=50\n",
+        )
+        self.assertEqual(pressure("io", self.root, node), 0.4)
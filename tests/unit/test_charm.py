@@ -4,12 +4,18 @@
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
 import json
+import os
+import shutil
+import subprocess
+import tempfile
 import unittest
 from unittest.mock import patch
 
 import ops
 import ops.testing
+from ops.model import ActiveStatus, BlockedStatus
 
+from auth_devices_keys import encode_auth_devices_keys
 from charm import Ros2bagFileserverCharm
 
 ops.testing.SIMULATE_CAN_CONNECT = True
@@ -25,6 +31,37 @@ AUTH_DEVICES_KEYS_DATA = [
     },
 ]
 
+IMMUTABLE = "public, max-age=31536000, immutable"
+IMAGE_CADDYFILE = ":80 {\n\troot * /var/lib/caddy-fileserver\n\tfile_server browse\n}\n"
+
+
+def caddy_adapt(caddyfile):
+    """Return the JSON configuration Caddy reads from a Caddyfile, None without Caddy."""
+    if not shutil.which("caddy"):
+        return None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "Caddyfile")
+        with open(path, "w") as f:
+            f.write(caddyfile)
+        adapted = subprocess.run(
+            ["caddy", "adapt", "--adapter", "caddyfile", "--config", path],
+            capture_output=True,
+            check=True,
+        )
+    return json.loads(adapted.stdout)
+
+
+def routes(config):
+    """Yield the routes of a Caddy JSON configuration, nested ones included."""
+    if isinstance(config, dict):
+        if "handle" in config:
+            yield config
+        for value in config.values():
+            yield from routes(value)
+    elif isinstance(config, list):
+        for value in config:
+            yield from routes(value)
+
 
 class TestCharm(unittest.TestCase):
     def setUp(self):
@@ -120,3 +157,477 @@ class TestCharm(unittest.TestCase):
         )
 
         self.assertEqual(expected_authorized_keys, actual_authorized_keys)
+
+    def test_compact_auth_devices_keys_rel_data(self):
+        rel_id = self.harness.add_relation("auth-devices-keys", "cos-registration-server")
+        self.harness.add_relation_unit(rel_id, "cos-registration-server/0")
+        self.harness.begin_with_initial_hooks()
+
+        self.harness.update_relation_data(
+            rel_id,
+            "cos-registration-server",
+            encode_auth_devices_keys(AUTH_DEVICES_KEYS_DATA, shards=2),
+        )
+
+        authorized_keys = (
+            self.harness.model.unit.get_container(self.name)
+            .pull("/root/.ssh/authorized_keys")
+            .read()
+        )
+        self.assertEqual(
+            sorted(authorized_keys.splitlines()),
+            ["ssh-rsa AAAAB3NzaC1yc2EAAAmVDT4Njl", "ssh-rsa public-key-ash"],
+        )
+
+    def test_malformed_auth_devices_keys_are_rejected(self):
+        rel_id = self.harness.add_relation("auth-devices-keys", "cos-registration-server")
+        self.harness.add_relation_unit(rel_id, "cos-registration-server/0")
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+        encoded = encode_auth_devices_keys(AUTH_DEVICES_KEYS_DATA)
+        self.harness.update_relation_data(rel_id, "cos-registration-server", encoded)
+
+        # Valid JSON, but not a manifest
+        malformed = dict(encoded)
+        malformed["auth_devices_keys_manifest"] = json.dumps(["not", "a", "manifest"])
+        self.harness.update_relation_data(rel_id, "cos-registration-server", malformed)
+        self.assertEqual(
+            self.harness.charm.auth_devices_keys_consumer.auth_devices_keys,
+            AUTH_DEVICES_KEYS_DATA,
+        )
+
+    def test_auth_devices_keys_read_between_relation_changes(self):
+        rel_id = self.harness.add_relation("auth-devices-keys", "cos-registration-server")
+        self.harness.add_relation_unit(rel_id, "cos-registration-server/0")
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+        self.harness.update_relation_data(
+            rel_id, "cos-registration-server", encode_auth_devices_keys(AUTH_DEVICES_KEYS_DATA)
+        )
+
+        # The provider data changes before the relation changed event runs
+        new_device = {"uid": "rob-cos-demo-robot-3", "public_ssh_key": "ssh-ed25519 new-key"}
+        self.harness.disable_hooks()
+        self.harness.update_relation_data(
+            rel_id,
+            "cos-registration-server",
+            encode_auth_devices_keys(AUTH_DEVICES_KEYS_DATA + [new_device]),
+        )
+        self.harness.enable_hooks()
+        self.harness.charm.on.update_status.emit()
+        self.harness.charm.on.config_changed.emit()
+        relation = self.harness.model.get_relation("auth-devices-keys", rel_id)
+        self.harness.charm.on["auth-devices-keys"].relation_changed.emit(
+            relation, app=relation.app
+        )
+
+        container = self.harness.model.unit.get_container(self.name)
+        self.assertIn("ssh-ed25519 new-key", container.pull("/root/.ssh/authorized_keys").read())
+        self.assertIn(
+            'rob-cos-demo-robot-3 namespaces="ros2bag-upload" ssh-ed25519 new-key',
+            container.pull("/root/.ssh/allowed_signers").read(),
+        )
+
+    def test_partitioned_storage_layout(self):
+        self.harness.update_config({"storage-layout": "partitioned"})
+        self.harness.begin()
+        self.harness.set_can_connect(self.name, True)
+        container = self.harness.model.unit.get_container(self.name)
+        container.push("/srv/Caddyfile", IMAGE_CADDYFILE, make_dirs=True)
+        self.harness.container_pebble_ready(self.name)
+
+        plan = self.harness.get_container_pebble_plan(self.name).to_dict()
+        self.assertIn("--listen 127.0.0.1:8083", plan["services"]["bagstore-layout"]["command"])
+        self.assertTrue(container.get_service("bagstore-layout").is_running())
+        self.assertTrue(container.exists("/opt/ros2bag-fileserver/bagstore/layout.py"))
+        self.assertIn("import /srv/bagstore/*.caddy", container.pull("/srv/Caddyfile").read())
+
+        self.harness.update_config({"storage-layout": "flat"})
+        self.harness.container_pebble_ready(self.name)
+
+        plan = self.harness.get_container_pebble_plan(self.name).to_dict()
+        self.assertEqual(plan["services"]["bagstore-layout"]["startup"], "disabled")
+        self.assertFalse(container.get_service("bagstore-layout").is_running())
+        # Back to the Caddyfile of the image
+        self.assertEqual(container.pull("/srv/Caddyfile").read(), IMAGE_CADDYFILE)
+
+    def test_default_deployment_keeps_the_image_configuration(self):
+        self.harness.begin()
+        self.harness.set_can_connect(self.name, True)
+        container = self.harness.model.unit.get_container(self.name)
+        container.push("/srv/Caddyfile", IMAGE_CADDYFILE, make_dirs=True)
+        self.harness.container_pebble_ready(self.name)
+
+        self.assertEqual(container.pull("/srv/Caddyfile").read(), IMAGE_CADDYFILE)
+        self.assertFalse(container.exists("/opt/ros2bag-fileserver/bagstore"))
+        self.assertFalse(container.exists("/srv/bagstore-limits.json"))
+
+    def test_invalid_storage_layout(self):
+        self.harness.update_config({"storage-layout": "nested"})
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+
+        self.assertIsInstance(self.harness.model.unit.status, ops.BlockedStatus)
+
+    @patch("socket.getfqdn", return_value="ros2bag-fileserver-k8s-0.testmodel.svc")
+    def test_fqdn_resolved_once(self, mock_getfqdn):
+        self.harness.add_relation("ingress-http", "traefik")
+        rel_tcp_id = self.harness.add_relation("ingress-tcp", "traefik")
+
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+
+        mock_getfqdn.assert_called_once()
+        rel_tcp_data = self.harness.get_relation_data(rel_tcp_id, self.harness.charm.unit.name)
+        self.assertEqual(rel_tcp_data["host"], "ros2bag-fileserver-k8s-0.testmodel.svc")
+
+    def test_ingress_ready_skips_unchanged_workload(self):
+        self.harness.update_config({"time-index": True})
+        rel_id = self.harness.add_relation("ingress-http", "traefik")
+        self.harness.add_relation_unit(rel_id, "traefik/0")
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+        self.mock_set_server_port.reset_mock()
+
+        mocks = []
+        for patcher in (
+            patch.object(ops.model.Container, "get_plan"),
+            patch.object(ops.model.Container, "can_connect"),
+            patch.object(ops.model.Container, "pull"),
+            patch("charm.os.statvfs"),
+        ):
+            mocks.append(patcher.start())
+            self.addCleanup(patcher.stop)
+        self.harness.update_relation_data(
+            rel_id, "traefik", {"ingress": json.dumps({"url": "http://10.0.0.1/testmodel"})}
+        )
+
+        # Nothing is read from the workload, nor from the storage
+        for mock in mocks:
+            mock.assert_not_called()
+        self.mock_set_server_port.assert_not_called()
+        self.assertEqual(self.harness.model.unit.status, ops.ActiveStatus())
+
+    def test_pebble_ready_checks_fingerprint_marker(self):
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+        self.mock_set_server_port.reset_mock()
+
+        # The workload already runs the configuration recorded in the marker
+        self.harness.charm._stored.workload_fingerprint = ""
+        self.harness.container_pebble_ready(self.name)
+        self.mock_set_server_port.assert_not_called()
+
+        # A fresh workload container has no marker
+        self.harness.model.unit.get_container(self.name).remove_path("/srv/.charm-fingerprint")
+        self.harness.container_pebble_ready(self.name)
+        self.mock_set_server_port.assert_called_once()
+
+    def test_h2c_upstream(self):
+        rel_id = self.harness.add_relation("ingress-http", "traefik")
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+
+        rel_data = self.harness.get_relation_data(rel_id, self.harness.charm.app.name)
+        self.assertEqual(rel_data.get("scheme", '"http"'), '"http"')
+
+        self.harness.update_config({"enable-h2c": True})
+
+        rel_data = self.harness.get_relation_data(rel_id, self.harness.charm.app.name)
+        self.assertEqual(rel_data["scheme"], '"h2c"')
+        caddyfile = self.harness.model.unit.get_container(self.name).pull("/srv/Caddyfile").read()
+        self.assertIn("protocols h1 h2c", caddyfile)
+        # Probes and the catalogue keep using plain HTTP URLs
+        self.assertTrue(self.harness.charm.internal_url.startswith("http://"))
+
+    def test_http_upload(self):
+        rel_id = self.harness.add_relation("auth-devices-keys", "cos-registration-server")
+        self.harness.add_relation_unit(rel_id, "cos-registration-server/0")
+        self.harness.update_config({"http-upload": True})
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+
+        self.harness.update_relation_data(
+            rel_id,
+            "cos-registration-server",
+            {"auth_devices_keys": json.dumps(AUTH_DEVICES_KEYS_DATA)},
+        )
+
+        container = self.harness.model.unit.get_container(self.name)
+        self.assertTrue(container.get_service("bagstore-upload").is_running())
+        caddyfile = container.pull("/srv/Caddyfile").read()
+        self.assertIn("reverse_proxy @upload 127.0.0.1:8081", caddyfile)
+        self.assertIn("\t\tnot path /upload/metrics\n", caddyfile)
+        self.assertEqual(
+            container.pull("/root/.ssh/allowed_signers").read(),
+            'rob-cos-demo-robot-1 namespaces="ros2bag-upload" ssh-rsa public-key-ash\n'
+            'rob-cos-demo-robot-2 namespaces="ros2bag-upload" ssh-rsa AAAAB3NzaC1yc2EAAAmVDT4Njl\n',
+        )
+
+    def test_upload_admission_limits(self):
+        rel_id = self.harness.add_relation("auth-devices-keys", "cos-registration-server")
+        self.harness.add_relation_unit(rel_id, "cos-registration-server/0")
+        self.harness.update_config({"upload-max-concurrent": 8, "upload-rate-limit": 1024})
+        self.harness.begin_with_initial_hooks()
+        devices = [dict(AUTH_DEVICES_KEYS_DATA[0], upload_rate_limit=256)]
+        self.harness.update_relation_data(
+            rel_id, "cos-registration-server", {"auth_devices_keys": json.dumps(devices)}
+        )
+
+        container = self.harness.model.unit.get_container(self.name)
+        limits = json.loads(container.pull("/srv/bagstore-limits.json").read())
+        self.assertEqual(limits["max_concurrent"], 8)
+        self.assertEqual(limits["rate_limits"], {"rob-cos-demo-robot-1": 256})
+        authorized_keys = container.pull("/root/.ssh/authorized_keys").read()
+        self.assertTrue(authorized_keys.startswith('command="env PYTHONPATH='))
+        self.assertIn("ssh-gate --uid rob-cos-demo-robot-1", authorized_keys)
+        self.assertTrue(container.exists("/opt/ros2bag-fileserver/bagstore/admission.py"))
+
+        # Lifting the limits gives the devices their plain keys back
+        self.harness.update_config({"upload-max-concurrent": 0, "upload-rate-limit": 0})
+        self.harness.update_relation_data(
+            rel_id,
+            "cos-registration-server",
+            {"auth_devices_keys": json.dumps(AUTH_DEVICES_KEYS_DATA)},
+        )
+        self.assertEqual(
+            container.pull("/root/.ssh/authorized_keys").read(),
+            "ssh-rsa public-key-ash\nssh-rsa AAAAB3NzaC1yc2EAAAmVDT4Njl\n",
+        )
+
+    def test_upload_metrics(self):
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+        plan = self.harness.get_container_pebble_plan(self.name).to_dict()
+        self.assertNotIn("bagstore-metrics", plan["services"])
+
+        # Served without HTTP uploads too, on a port the ingress does not route to
+        self.harness.update_config({"upload-max-concurrent": 8})
+        plan = self.harness.get_container_pebble_plan(self.name).to_dict()
+        self.assertIn(
+            "serve-metrics --listen 0.0.0.0:8084 --limits /srv/bagstore-limits.json",
+            plan["services"]["bagstore-metrics"]["command"],
+        )
+        container = self.harness.model.unit.get_container(self.name)
+        self.assertTrue(container.get_service("bagstore-metrics").is_running())
+
+        self.harness.update_config({"upload-max-concurrent": 0})
+        plan = self.harness.get_container_pebble_plan(self.name).to_dict()
+        self.assertEqual(plan["services"]["bagstore-metrics"]["startup"], "disabled")
+
+    def test_upload_preallocate(self):
+        rel_id = self.harness.add_relation("auth-devices-keys", "cos-registration-server")
+        self.harness.add_relation_unit(rel_id, "cos-registration-server/0")
+        self.harness.update_config({"upload-preallocate": True, "http-upload": True})
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+        self.harness.update_relation_data(
+            rel_id,
+            "cos-registration-server",
+            {"auth_devices_keys": json.dumps(AUTH_DEVICES_KEYS_DATA)},
+        )
+
+        container = self.harness.model.unit.get_container(self.name)
+        authorized_keys = container.pull("/root/.ssh/authorized_keys").read()
+        self.assertIn("ssh-gate --uid rob-cos-demo-robot-1", authorized_keys)
+        self.assertIn("--preallocate", authorized_keys)
+        plan = self.harness.get_container_pebble_plan(self.name).to_dict()
+        self.assertTrue(plan["services"]["bagstore-upload"]["command"].endswith("--preallocate"))
+
+    def test_post_upload_pipeline(self):
+        self.harness.update_config({"verify-uploads": True})
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+
+        plan = self.harness.get_container_pebble_plan(self.name).to_dict()
+        command = plan["services"]["bagstore-pipeline"]["command"]
+        self.assertIn("process --verify --interval 10", command)
+        container = self.harness.model.unit.get_container(self.name)
+        self.assertTrue(container.get_service("bagstore-pipeline").is_running())
+
+    def test_previews(self):
+        self.harness.update_config({"previews": True})
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+
+        plan = self.harness.get_container_pebble_plan(self.name).to_dict()
+        self.assertIn("process --previews", plan["services"]["bagstore-pipeline"]["command"])
+        container = self.harness.model.unit.get_container(self.name)
+        caddyfile = container.pull("/srv/Caddyfile").read()
+        self.assertIn("handle_path /_previews/* {", caddyfile)
+        self.assertIn("root * /var/lib/caddy-fileserver/.bagstore/previews", caddyfile)
+        self.assertIn("\t\t@preview not path / /index.html\n", caddyfile)
+        self.assertIn(
+            '\t\theader @preview Cache-Control "public, max-age=31536000, immutable"\n', caddyfile
+        )
+
+        adapted = caddy_adapt(caddyfile)
+        if adapted is not None:
+            # The previews but their listing are immutable
+            matches = [
+                route.get("match")
+                for route in routes(adapted)
+                if {"handler": "headers", "response": {"set": {"Cache-Control": [IMMUTABLE]}}}
+                in route.get("handle", [])
+            ]
+            self.assertIn([{"not": [{"path": ["/", "/index.html"]}]}], matches)
+
+    def test_caching_headers(self):
+        self.harness.update_config({"verify-uploads": True})
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+
+        container = self.harness.model.unit.get_container(self.name)
+        caddyfile = container.pull("/srv/Caddyfile").read()
+        self.assertIn("\t@final file {path}.sha256\n", caddyfile)
+        self.assertIn(
+            '\theader @final Cache-Control "public, max-age=31536000, immutable"\n', caddyfile
+        )
+        self.assertIn('\theader @listing Cache-Control "public, max-age=10"\n', caddyfile)
+        self.assertIn("\theader @pending Cache-Control no-cache\n", caddyfile)
+        self.assertIn("\t\tetag_file_extensions .sha256\n", caddyfile)
+        self.assertIn("\t\thide .bagstore *.sha256 *.sha256.tmp\n", caddyfile)
+
+        # Without the pipeline no file has an ETag, nor needs a recent Caddy
+        self.harness.update_config({"verify-uploads": False, "http-upload": True})
+        caddyfile = container.pull("/srv/Caddyfile").read()
+        self.assertNotIn("@pending", caddyfile)
+        self.assertNotIn("etag_file_extensions", caddyfile)
+        self.assertIn('\theader @listing Cache-Control "public, max-age=10"\n', caddyfile)
+
+    def test_time_index(self):
+        self.harness.update_config({"time-index": True})
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+
+        plan = self.harness.get_container_pebble_plan(self.name).to_dict()
+        self.assertIn("process --time-index", plan["services"]["bagstore-pipeline"]["command"])
+        self.assertIn(
+            "serve-index --listen 127.0.0.1:8082", plan["services"]["bagstore-index"]["command"]
+        )
+        container = self.harness.model.unit.get_container(self.name)
+        self.assertIn(
+            "reverse_proxy @index 127.0.0.1:8082", container.pull("/srv/Caddyfile").read()
+        )
+        self.assertIn("\t\tnot path /_index/metrics\n", container.pull("/srv/Caddyfile").read())
+        catch_up = plan["services"]["bagstore-catch-up"]
+        self.assertTrue(catch_up["command"].endswith(" catch-up"))
+        self.assertEqual(catch_up["on-success"], "ignore")
+
+    def test_catch_up_status(self):
+        self.harness.update_config({"time-index": True})
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+        container = self.harness.model.unit.get_container(self.name)
+        progress = {"total": 250000, "done": 12000, "started": 0, "rate": 140.2, "eta": 4860}
+        container.push(
+            "/var/lib/caddy-fileserver/.bagstore/catch-up.json",
+            json.dumps(progress),
+            make_dirs=True,
+        )
+
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            ActiveStatus("Indexing backlog: 12000/250000 bags, ETA 1h21m"),
+        )
+        # Skipped updates keep the last progress, without reading it again
+        with patch.object(ops.model.Container, "pull") as mock_pull:
+            self.harness.charm.on.config_changed.emit()
+        mock_pull.assert_not_called()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            ActiveStatus("Indexing backlog: 12000/250000 bags, ETA 1h21m"),
+        )
+
+        progress["done"] = progress["total"]
+        container.push("/var/lib/caddy-fileserver/.bagstore/catch-up.json", json.dumps(progress))
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_preview_bags(self):
+        self.harness.update_config({"preview-bag-rate": 1.5})
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+
+        plan = self.harness.get_container_pebble_plan(self.name).to_dict()
+        self.assertIn(
+            "process --preview-bags --preview-rate 1.5",
+            plan["services"]["bagstore-pipeline"]["command"],
+        )
+
+    def test_recompress_bags(self):
+        self.harness.update_config(
+            {"recompress-bags": True, "recompress-cpu-budget": 1.5, "recompress-nice": 19}
+        )
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+
+        plan = self.harness.get_container_pebble_plan(self.name).to_dict()
+        self.assertIn(
+            "recompress --cpu-budget 1.5 --nice 19 --interval 3600",
+            plan["services"]["bagstore-recompress"]["command"],
+        )
+        self.assertEqual(plan["services"]["bagstore-recompress"]["on-success"], "ignore")
+
+        # The recompression makes the MCAP files final
+        self.harness.update_config({"verify-uploads": True})
+        plan = self.harness.get_container_pebble_plan(self.name).to_dict()
+        self.assertTrue(
+            plan["services"]["bagstore-pipeline"]["command"].endswith("--recompression")
+        )
+
+    def test_resource_scheduler(self):
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+        plan = self.harness.get_container_pebble_plan(self.name).to_dict()
+        self.assertNotIn("bagstore-scheduler", plan["services"])
+
+        self.harness.update_config({"recompress-bags": True, "http-upload": True})
+        plan = self.harness.get_container_pebble_plan(self.name).to_dict()
+        self.assertIn(
+            "schedule --probe-url http://127.0.0.1:80/"
+            " --upload-metrics http://127.0.0.1:8081/upload/metrics",
+            plan["services"]["bagstore-scheduler"]["command"],
+        )
+
+    def test_inspection_actions(self):
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+        commands = []
+
+        def inspect(args):
+            commands.append(args.command)
+            bags = [{"bag": "robot-1/a", "size": 10}, {"bag": "robot-1/b", "size": 20}]
+            return ops.testing.ExecResult(
+                stdout=json.dumps({"bags": bags, "next-cursor": "robot-1/b"})
+            )
+
+        self.harness.handle_exec(self.name, ["python3", "-m", "bagstore"], handler=inspect)
+        output = self.harness.run_action("list-bags", {"uid": "robot-1", "limit": 2})
+        self.assertEqual(json.loads(output.results["bags"])[1]["bag"], "robot-1/b")
+        self.assertEqual(output.results["next-cursor"], "robot-1/b")
+        self.assertEqual(
+            commands[0][-6:], ["inspect", "list-bags", "--uid", "robot-1", "--limit", "2"]
+        )
+
+    def test_storage_usage_status(self):
+        self.harness.update_config({"storage-high-water": 95})
+        self.harness.add_storage("database", attach=True)
+        self.harness.begin_with_initial_hooks()
+        self.harness.container_pebble_ready(self.name)
+        container = self.harness.model.unit.get_container(self.name)
+        self.assertIn('"high_water": 95', container.pull("/srv/bagstore-limits.json").read())
+
+        usage = os.statvfs_result((4096, 4096, 100, 20, 3, 0, 0, 0, 0, 255))
+        with patch("os.statvfs", return_value=usage):
+            self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.model.unit.status,
+            BlockedStatus("Storage 97% full, new uploads are refused"),
+        )
+
+        usage = os.statvfs_result((4096, 4096, 100, 20, 8, 0, 0, 0, 0, 255))
+        with patch("os.statvfs", return_value=usage):
+            self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus("Storage 92% full"))
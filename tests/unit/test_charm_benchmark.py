@@ -0,0 +1,242 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# Hook latency benchmarks, run them with `tox -e benchmark`.
+#
+# Every run appends one JSON line to the file named by
+# CHARM_BENCHMARK_RESULTS and prints how each hook compares to the previous
+# run, so that regressions in hook cost show up over time. The import time
+# check also runs with the unit tests, to keep the dispatch cold start cheap.
+
+import collections
+import datetime
+import gc
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+import unittest
+
+import ops
+import ops.testing
+import yaml
+
+from charm import Ros2bagFileserverCharm
+
+ops.testing.SIMULATE_CAN_CONNECT = True
+
+BENCHMARK_RESULTS = os.environ.get("CHARM_BENCHMARK_RESULTS")
+
+# Libraries that no hook should pay for unless it uses them
+HEAVY_MODULES = [
+    "pydantic",
+    "jsonschema",
+    "charms.traefik_k8s.v2.ingress",
+    "charms.traefik_k8s.v1.ingress_per_unit",
+    "charms.blackbox_exporter_k8s.v0.blackbox_probes",
+    "charms.catalogue_k8s.v0.catalogue",
+]
+
+RESULTS = {}
+
+SSHD_CONFIG = "Include /etc/ssh/sshd_config.d/*.conf\n#Port 22\nPermitRootLogin yes\n"
+
+
+def auth_devices_keys(count):
+    return [
+        {"uid": f"robot-{i}", "public_ssh_key": f"ssh-ed25519 AAAAC3NzaC1lZDI1NTE5{i:040d}"}
+        for i in range(count)
+    ]
+
+
+class PebbleCallCounter:
+    """Count the calls made on a Pebble client, per method."""
+
+    def __init__(self, client):
+        self.calls = collections.Counter()
+        for name in dir(client):
+            method = getattr(client, name)
+            if not name.startswith("_") and callable(method):
+                setattr(client, name, self._wrap(name, method))
+
+    def _wrap(self, name, method):
+        def counted(*args, **kwargs):
+            self.calls[name] += 1
+            return method(*args, **kwargs)
+
+        return counted
+
+
+def tearDownModule():
+    if not (BENCHMARK_RESULTS and RESULTS):
+        return
+
+    previous = None
+    if os.path.exists(BENCHMARK_RESULTS):
+        with open(BENCHMARK_RESULTS) as f:
+            lines = f.read().splitlines()
+        previous = json.loads(lines[-1])["hooks"] if lines else None
+
+    record = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": _git_commit(),
+        "hooks": dict(sorted(RESULTS.items())),
+    }
+    os.makedirs(os.path.dirname(BENCHMARK_RESULTS) or ".", exist_ok=True)
+    with open(BENCHMARK_RESULTS, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+    print(f"\n{'hook':<40} {'wall ms':>10} {'peak KiB':>10} {'pebble':>7} {'vs prev':>8}")
+    for hook, result in record["hooks"].items():
+        change = ""
+        if previous and hook in previous and previous[hook]["wall_ms"]:
+            change = f"{result['wall_ms'] / previous[hook]['wall_ms']:.2f}x"
+        print(
+            f"{hook:<40} {result['wall_ms']:>10.2f} {result.get('peak_kib', '-'):>10}"
+            f" {result.get('pebble_calls', '-'):>7} {change:>8}"
+        )
+
+
+class TestImportTime(unittest.TestCase):
+    def test_charm_import_skips_heavy_libraries(self):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import charm"],
+            env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+
+        # import time: self [us] | cumulative | imported package
+        cumulative_us = {}
+        for line in result.stderr.splitlines():
+            if line.startswith("import time:") and "imported package" not in line:
+                _, cumulative, module = line[len("import time:") :].split("|")
+                cumulative_us[module.strip()] = int(cumulative)
+
+        for module in HEAVY_MODULES:
+            self.assertNotIn(module, cumulative_us)
+        RESULTS["import-charm"] = {"wall_ms": cumulative_us["charm"] / 1000}
+
+
+@unittest.skipUnless(BENCHMARK_RESULTS, "set CHARM_BENCHMARK_RESULTS to run the benchmarks")
+class TestHookBenchmark(unittest.TestCase):
+    def make_harness(self):
+        harness = ops.testing.Harness(Ros2bagFileserverCharm)
+        self.addCleanup(harness.cleanup)
+        harness.set_model_name("testmodel")
+        harness.set_leader(True)
+        harness.handle_exec("ros2bag-fileserver", [], result=0)
+        harness.add_network("1.2.3.4")
+        return harness
+
+    def benchmark(self, hook, scenario):
+        """Run the hook of a scenario twice: once timed, once traced.
+
+        A scenario prepares a fresh harness and returns a callable firing the
+        hook, so that tracemalloc overhead does not leak into the wall time.
+        """
+        fire = scenario(self.make_harness())
+        gc.collect()
+        start = time.perf_counter()
+        fire()
+        wall_ms = (time.perf_counter() - start) * 1000
+
+        harness = self.make_harness()
+        fire = scenario(harness)
+        container = harness.model.unit.get_container("ros2bag-fileserver")
+        counter = PebbleCallCounter(container._pebble)
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        fire()
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        blocks = sum(
+            s.count_diff for s in after.compare_to(before, "filename") if s.count_diff > 0
+        )
+
+        RESULTS[hook] = {
+            "wall_ms": round(wall_ms, 3),
+            "peak_kib": round(peak / 1024, 1),
+            "allocated_blocks": blocks,
+            "pebble_calls": sum(counter.calls.values()),
+            "pebble_calls_by_method": dict(sorted(counter.calls.items())),
+        }
+
+    def started(self, harness):
+        harness.set_can_connect("ros2bag-fileserver", True)
+        harness.model.unit.get_container("ros2bag-fileserver").push(
+            "/etc/ssh/sshd_config", SSHD_CONFIG, make_dirs=True
+        )
+        harness.begin_with_initial_hooks()
+
+    def test_pebble_ready(self):
+        def scenario(harness):
+            self.started(harness)
+            return lambda: harness.container_pebble_ready("ros2bag-fileserver")
+
+        self.benchmark("pebble-ready", scenario)
+
+    def test_config_changed(self):
+        def scenario(harness):
+            self.started(harness)
+            harness.container_pebble_ready("ros2bag-fileserver")
+            return lambda: harness.update_config({"ssh-port": 2223})
+
+        self.benchmark("config-changed", scenario)
+        # sshd is moved to the new port, the hook is not a no-op
+        self.assertGreater(RESULTS["config-changed"]["pebble_calls_by_method"]["exec"], 0)
+
+    def test_auth_devices_keys_changed(self):
+        for count in (10, 1000, 10000):
+            keys = json.dumps(auth_devices_keys(count))
+
+            def scenario(harness, keys=keys):
+                rel_id = harness.add_relation("auth-devices-keys", "cos-registration-server")
+                harness.add_relation_unit(rel_id, "cos-registration-server/0")
+                self.started(harness)
+                harness.container_pebble_ready("ros2bag-fileserver")
+                return lambda: harness.update_relation_data(
+                    rel_id, "cos-registration-server", {"auth_devices_keys": keys}
+                )
+
+            self.benchmark(f"auth-devices-keys-relation-changed-{count}", scenario)
+
+    def test_ingress_http_ready(self):
+        def scenario(harness):
+            rel_id = harness.add_relation("ingress-http", "traefik")
+            harness.add_relation_unit(rel_id, "traefik/0")
+            self.started(harness)
+            harness.container_pebble_ready("ros2bag-fileserver")
+            url = {"url": "http://10.0.0.1/testmodel-ros2bag-fileserver-k8s"}
+            return lambda: harness.update_relation_data(
+                rel_id, "traefik", {"ingress": json.dumps(url)}
+            )
+
+        self.benchmark("ingress-http-ready", scenario)
+
+    def test_ingress_tcp_ready(self):
+        def scenario(harness):
+            rel_id = harness.add_relation("ingress-tcp", "traefik")
+            harness.add_relation_unit(rel_id, "traefik/0")
+            self.started(harness)
+            harness.container_pebble_ready("ros2bag-fileserver")
+            url = {harness.charm.unit.name: {"url": "10.0.0.1:2222"}}
+            return lambda: harness.update_relation_data(
+                rel_id, "traefik", {"ingress": yaml.safe_dump(url)}
+            )
+
+        self.benchmark("ingress-tcp-ready", scenario)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,130 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# Download throughput and CPU cost of MCAP extraction, run it with
+# `tox -e benchmark`.
+#
+# A MCAP file of DOWNLOAD_BENCHMARK_MIB is written to DOWNLOAD_BENCHMARK_DIR,
+# then downloaded whole from the time index service, where its chunks go
+# through `sendfile`, and from Caddy's static file server if `caddy` is
+# installed. The CPU time of each server is read from /proc.
+
+import http.client
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from bagstore.mcap import Channel, McapWriter, Schema
+
+BENCHMARK_DIR = os.environ.get("DOWNLOAD_BENCHMARK_DIR")
+
+FILE_SIZE = int(os.environ.get("DOWNLOAD_BENCHMARK_MIB", "256")) << 20
+MESSAGE_SIZE = 64 << 10
+DOWNLOADS = 5
+READ_SIZE = 1 << 20
+BAG_PATH = "robot-1/bag/rosbag_0.mcap"
+
+CADDYFILE = """{{
+\tadmin off
+}}
+http://127.0.0.1:{port} {{
+\troot * {root}
+\tfile_server
+}}
+"""
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _cpu_seconds(pid):
+    """Return the user and system CPU time of a process."""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rpartition(")")[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def _write_bag(path):
+    os.makedirs(os.path.dirname(path))
+    channel = Channel(1, "/points", Schema(1, "sensor_msgs/msg/PointCloud2", "ros2msg"), "cdr")
+    payload = os.urandom(MESSAGE_SIZE)
+    with open(path, "wb") as f:
+        writer = McapWriter(f, chunk_size=4 << 20)
+        writer.compression = ""
+        for i in range(FILE_SIZE // MESSAGE_SIZE):
+            writer.write_message(channel, i * 10**8, i * 10**8, payload)
+        writer.finish()
+
+
+@unittest.skipUnless(BENCHMARK_DIR, "set DOWNLOAD_BENCHMARK_DIR to run the benchmark")
+class TestDownloadBenchmark(unittest.TestCase):
+    def setUp(self):
+        os.makedirs(BENCHMARK_DIR, exist_ok=True)
+        tmp_dir = tempfile.TemporaryDirectory(dir=BENCHMARK_DIR)
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        _write_bag(os.path.join(self.root, BAG_PATH))
+
+    def start(self, args, port):
+        process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.addCleanup(process.wait)
+        self.addCleanup(process.terminate)
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            self.fail(f"{args[0]} did not start")
+        return process
+
+    def download(self, process, port, path):
+        """Return the throughput in MiB/s and the server CPU seconds per GiB."""
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        self.addCleanup(connection.close)
+        buffer = bytearray(READ_SIZE)
+        size = 0
+        cpu = _cpu_seconds(process.pid)
+        start = time.perf_counter()
+        for _ in range(DOWNLOADS):
+            connection.request("GET", path)
+            response = connection.getresponse()
+            self.assertEqual(response.status, 200)
+            while read := response.readinto(buffer):
+                size += read
+        seconds = time.perf_counter() - start
+        cpu = _cpu_seconds(process.pid) - cpu
+        return size / (1 << 20) / seconds, cpu / (size / (1 << 30))
+
+    def test_download_throughput(self):
+        results = {}
+        port = _free_port()
+        process = self.start(
+            [sys.executable, "-m", "bagstore", "--root", self.root, "serve-index"]
+            + ["--listen", f"127.0.0.1:{port}"],
+            port,
+        )
+        path = f"/_index/extract/{BAG_PATH}?start=0&end={2**63 - 1}"
+        results["extract (sendfile)"] = self.download(process, port, path)
+
+        if shutil.which("caddy"):
+            port = _free_port()
+            caddyfile = os.path.join(BENCHMARK_DIR, "Caddyfile")
+            with open(caddyfile, "w") as f:
+                f.write(CADDYFILE.format(port=port, root=self.root))
+            self.addCleanup(os.remove, caddyfile)
+            process = self.start(["caddy", "run", "--config", caddyfile], port)
+            results["caddy file_server"] = self.download(process, port, f"/{BAG_PATH}")
+
+        print(f"\n{'server':<20} {'MiB/s':>10} {'CPU s/GiB':>10}")
+        for server, (throughput, cpu) in results.items():
+            print(f"{server:<20} {throughput:>10.1f} {cpu:>10.3f}")
@@ -0,0 +1,189 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import http.client
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from bagstore.admission import Admission
+from bagstore.index import BagIndex
+from bagstore.layout import PartitionedLayout, RedirectServer, UploadWatch
+
+# 2023-07-22T04:26:40Z
+METADATA = """rosbag2_bagfile_information:
+  version: 5
+  storage_identifier: mcap
+  duration:
+    nanoseconds: 1000000000
+  starting_time:
+    nanoseconds_since_epoch: 1690000000000000000
+  message_count: 0
+"""
+
+
+class TestPartitionedLayout(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = os.path.join(tmp_dir.name, "storage")
+        self.snippet = os.path.join(tmp_dir.name, "snippets", "redirects.caddy")
+        os.makedirs(self.root)
+
+    def make_bag(self, path, metadata=METADATA, age=120):
+        bag_dir = os.path.join(self.root, path)
+        os.makedirs(bag_dir)
+        files = {"metadata.yaml": metadata, "rosbag_0.mcap": "data"}
+        for name, content in files.items():
+            file_path = os.path.join(bag_dir, name)
+            with open(file_path, "w") as f:
+                f.write(content)
+            os.utime(file_path, (time.time() - age,) * 2)
+        return bag_dir
+
+    def test_incident_bags_preempt_the_others(self):
+        self.make_bag("robot-1/nightly/rosbag2_2023_07_22")
+        self.make_bag("robot-2/incident/rosbag2_2023_07_22")
+        admission = Admission(self.root)
+        layout = PartitionedLayout(self.root, self.snippet, admission=admission)
+
+        # While an incident is being uploaded, only incident bags are moved
+        with admission.admit("robot-3", priority="high"):
+            self.assertEqual(layout.run_once(), 1)
+        self.assertEqual(list(layout.redirects), ["/robot-2/incident/rosbag2_2023_07_22"])
+
+        self.assertEqual(layout.run_once(), 1)
+
+    def test_completed_bag_is_partitioned(self):
+        self.make_bag("robot-1/field-test/rosbag2_2023_07_22")
+
+        layout = PartitionedLayout(self.root, self.snippet, settle_seconds=60)
+
+        self.assertEqual(layout.run_once(), 1)
+        self.assertTrue(
+            os.path.isfile(
+                os.path.join(self.root, "robot-1/2023/07/22/rosbag2_2023_07_22/rosbag_0.mcap")
+            )
+        )
+        self.assertEqual(
+            layout.redirects,
+            {"/robot-1/field-test/rosbag2_2023_07_22": "/robot-1/2023/07/22/rosbag2_2023_07_22"},
+        )
+        with open(os.path.join(self.root, ".bagstore", "redirects.json")) as f:
+            self.assertEqual(json.load(f), layout.redirects)
+        self.assertEqual(
+            layout.redirect("/robot-1/field-test/rosbag2_2023_07_22/rosbag_0.mcap"),
+            "/robot-1/2023/07/22/rosbag2_2023_07_22/rosbag_0.mcap",
+        )
+        self.assertEqual(
+            layout.redirect("/robot-1/field-test/rosbag2_2023_07_22/"),
+            "/robot-1/2023/07/22/rosbag2_2023_07_22/",
+        )
+        self.assertIsNone(layout.redirect("/robot-1/field-test/rosbag2_2023_07_2"))
+
+        # Partitioned bags are left alone
+        self.assertEqual(layout.run_once(), 0)
+
+    def test_uploaded_bags_are_moved_without_walking(self):
+        index = BagIndex(self.root)
+        self.addCleanup(index.close)
+        uploads = UploadWatch(self.root, index)
+        layout = PartitionedLayout(self.root, self.snippet, index=index, uploads=uploads)
+        self.make_bag("robot-1/missed")
+        self.make_bag("robot-1/uploaded")
+        index.record_upload("robot-1/uploaded")
+
+        self.assertEqual(layout.run_once(full=False), 1)
+        self.assertEqual(list(layout.redirects), ["/robot-1/uploaded"])
+        # Where it moved is recorded for the pipeline, and needs no move
+        self.assertEqual(uploads.bags(), [os.path.join(self.root, "robot-1/2023/07/22/uploaded")])
+        self.assertEqual(layout.run_once(full=False), 0)
+        self.assertEqual(uploads.bags(), [])
+
+        self.assertEqual(layout.run_once(), 1)
+
+    def test_uploads_do_not_walk_the_partitions(self):
+        index = BagIndex(self.root)
+        self.addCleanup(index.close)
+        uploads = UploadWatch(self.root, index)
+        self.make_bag("robot-1/2023/07/22/moved")
+        self.make_bag("robot-1/uploaded")
+        index.record_upload("robot-1")
+
+        self.assertEqual(uploads.bags(), [os.path.join(self.root, "robot-1/uploaded")])
+
+    def test_bag_still_uploading_is_left_in_place(self):
+        bag_dir = self.make_bag("robot-1/rosbag2_recent", age=0)
+        self.make_bag("robot-2/rosbag2_rsync", age=120)
+        with open(os.path.join(self.root, "robot-2/rosbag2_rsync/.rosbag_1.mcap.Ab12Cd"), "w"):
+            pass
+
+        layout = PartitionedLayout(self.root, self.snippet, settle_seconds=60)
+
+        self.assertEqual(layout.run_once(), 0)
+        self.assertTrue(os.path.isdir(bag_dir))
+
+    def test_name_collision_in_partition(self):
+        self.make_bag("robot-1/a/rosbag2")
+        self.make_bag("robot-1/b/rosbag2")
+
+        layout = PartitionedLayout(self.root, self.snippet, settle_seconds=60)
+
+        self.assertEqual(layout.run_once(), 2)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.root, "robot-1/2023/07/22"))),
+            ["rosbag2", "rosbag2-1"],
+        )
+
+    def test_first_redirect_of_a_path_is_kept(self):
+        self.make_bag("robot-1/latest")
+        layout = PartitionedLayout(self.root, self.snippet, settle_seconds=60)
+        self.assertEqual(layout.run_once(), 1)
+
+        # Another bag uploaded to the same path, and moved in turn
+        self.make_bag("robot-1/latest")
+        self.assertEqual(layout.run_once(), 1)
+        self.assertEqual(layout.redirects, {"/robot-1/latest": "/robot-1/2023/07/22/latest"})
+        self.assertTrue(os.path.isdir(os.path.join(self.root, "robot-1/2023/07/22/latest-1")))
+
+    def test_bag_without_start_time_is_skipped(self):
+        bag_dir = self.make_bag("robot-1/broken", metadata="rosbag2_bagfile_information: {}\n")
+
+        layout = PartitionedLayout(self.root, self.snippet, settle_seconds=60)
+
+        self.assertEqual(layout.run_once(), 0)
+        self.assertTrue(os.path.isdir(bag_dir))
+
+    def test_redirect_server(self):
+        layout = PartitionedLayout(self.root, self.snippet)
+        layout.redirects["/robot-1/bag"] = "/robot-1/2023/07/22/bag"
+        server = RedirectServer(("127.0.0.1", 0), layout)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        def get(path, headers=None):
+            connection = http.client.HTTPConnection(*server.server_address)
+            self.addCleanup(connection.close)
+            connection.request("GET", path, headers=headers or {})
+            response = connection.getresponse()
+            response.read()
+            return response
+
+        response = get("/robot-1/bag/rosbag_0.mcap?x=1", {"X-Forwarded-Prefix": "/model-app"})
+        self.assertEqual(response.status, 308)
+        self.assertEqual(
+            response.getheader("Location"), "/model-app/robot-1/2023/07/22/bag/rosbag_0.mcap?x=1"
+        )
+        self.assertEqual(get("/robot-1/other").status, 404)
+
+        # A single route, whatever the number of moved bags
+        self.assertTrue(layout.write_snippet())
+        with open(self.snippet) as f:
+            snippet = f.read()
+        self.assertIn("@bagstore_moved expression {err.status_code} == 404", snippet)
+        self.assertIn("reverse_proxy @bagstore_moved 127.0.0.1:8083", snippet)
+        self.assertFalse(layout.write_snippet())
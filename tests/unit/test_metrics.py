@@ -0,0 +1,44 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+from bagstore.admission import Admission
+from bagstore.metrics import MetricsServer
+from bagstore.scheduler import decision_path
+
+
+class TestMetricsServer(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        self.admission = Admission(self.root)
+        server = MetricsServer(("127.0.0.1", 0), self.admission)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def test_metrics(self):
+        os.makedirs(os.path.dirname(decision_path(self.root)), exist_ok=True)
+        with open(decision_path(self.root), "w") as f:
+            json.dump({"level": 0.5, "reasons": [], "signals": {}, "updated": time.time()}, f)
+        with self.admission.admit("robot-1"):
+            with urllib.request.urlopen(f"{self.url}/metrics") as response:
+                metrics = response.read().decode()
+        self.assertIn('bagstore_upload_active{priority="normal"} 1\n', metrics)
+        self.assertIn('bagstore_upload_queue_depth{priority="normal"} 0\n', metrics)
+        self.assertIn("bagstore_storage_size_bytes ", metrics)
+        self.assertIn("bagstore_scheduler_level 0.5\n", metrics)
+
+        with self.assertRaises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(f"{self.url}/upload/metrics")
+        self.assertEqual(e.exception.code, 404)
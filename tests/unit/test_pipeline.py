@@ -0,0 +1,254 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from bagstore.index import BagIndex
+from bagstore.layout import UploadWatch, record_upload
+from bagstore.pipeline import (
+    BufferPool,
+    Pipeline,
+    ScanConsumer,
+    Stage,
+    remove_stale_etags,
+    scan_file,
+)
+
+
+class Collect(ScanConsumer):
+    def __init__(self, delay=0.0):
+        self.data = bytearray()
+        self.delay = delay
+
+    def update(self, offset, chunk):
+        assert offset == len(self.data)
+        time.sleep(self.delay)
+        self.data += chunk
+
+
+class CountingFile(io.BytesIO):
+    reads = 0
+
+    def readinto(self, buffer):
+        self.reads += 1
+        return super().readinto(buffer)
+
+
+class RecordingStage(Stage):
+    name = "recording"
+
+    def __init__(self):
+        self.files = []
+        self.bags = []
+        self.lock = threading.Lock()
+
+    def consumers(self, job, path, f, size):
+        consumer = Collect()
+        with self.lock:
+            self.files.append((os.path.basename(path), consumer))
+        return [consumer]
+
+    def finish(self, job):
+        with self.lock:
+            self.bags.append(job.bag)
+
+
+class TestScanFile(unittest.TestCase):
+    def test_consumers_share_one_read_pass(self):
+        content = os.urandom(10_000)
+        f = CountingFile(content)
+        consumers = [Collect(), Collect(delay=0.001)]
+
+        # Far fewer buffers than chunks, the reader waits for the slow consumer
+        self.assertEqual(scan_file(f, consumers, BufferPool(2, 512)), len(content))
+        self.assertEqual(f.reads, 21)
+        for consumer in consumers:
+            self.assertEqual(bytes(consumer.data), content)
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        self.index = BagIndex(self.root)
+        self.addCleanup(self.index.close)
+
+    def make_bag(self, path, age=120):
+        bag_dir = os.path.join(self.root, path)
+        os.makedirs(bag_dir)
+        for name in ("metadata.yaml", "rosbag_0.mcap"):
+            with open(os.path.join(bag_dir, name), "wb") as f:
+                f.write(name.encode())
+            os.utime(os.path.join(bag_dir, name), (time.time() - age,) * 2)
+
+    def test_bags_are_processed_once_by_priority(self):
+        self.make_bag("robot-1/nightly/bag")
+        self.make_bag("robot-1/incident/bag")
+        self.make_bag("robot-2/recording/bag", age=0)
+        stage = RecordingStage()
+        pipeline = Pipeline(self.root, self.index, [stage], workers=1)
+
+        pipeline.run_once()
+        self.assertEqual(stage.bags, ["robot-1/incident/bag", "robot-1/nightly/bag"])
+        self.assertEqual(
+            [(name, bytes(consumer.data)) for name, consumer in stage.files[:2]],
+            [("metadata.yaml", b"metadata.yaml"), ("rosbag_0.mcap", b"rosbag_0.mcap")],
+        )
+        row = next(self.index.files())
+        self.assertEqual(row["sha256"], hashlib.sha256(b"metadata.yaml").hexdigest())
+
+        pipeline.run_once()
+        self.assertEqual(len(stage.bags), 2)
+
+    def test_job_queue_survives_restarts(self):
+        self.make_bag("robot-1/bag")
+        pipeline = Pipeline(self.root, self.index, [])
+        self.assertEqual(pipeline.discover(), 1)
+        # Killed while processing the bag
+        self.assertEqual(self.index.claim_job(), "robot-1/bag")
+
+        stage = RecordingStage()
+        Pipeline(self.root, self.index, [stage]).run_once()
+        self.assertEqual(stage.bags, ["robot-1/bag"])
+        self.assertIsNone(self.index.job_state("robot-1/bag"))
+
+    def test_failed_bags_are_processed_again_once_uploaded_again(self):
+        self.make_bag("robot-1/bag")
+        stage = RecordingStage()
+        pipeline = Pipeline(self.root, self.index, [stage])
+        with patch.object(stage, "finish", side_effect=ValueError("corrupt")):
+            for _ in range(4):
+                pipeline.run_once()
+        self.assertEqual(self.index.job_state("robot-1/bag"), "failed")
+        self.assertEqual(pipeline.discover(), 0)
+
+        # The robot uploads a fixed file
+        path = os.path.join(self.root, "robot-1/bag/rosbag_0.mcap")
+        with open(path, "wb") as f:
+            f.write(b"fixed")
+        os.utime(path, (time.time() - 60,) * 2)
+        self.assertEqual(pipeline.discover(), 1)
+        pipeline.run_once()
+        self.assertEqual(stage.bags, ["robot-1/bag"])
+        self.assertIsNone(self.index.job_state("robot-1/bag"))
+
+    def test_processed_files_have_etags(self):
+        self.make_bag("robot-1/bag")
+        pipeline = Pipeline(self.root, self.index, [])
+        pipeline.run_once()
+        path = os.path.join(self.root, "robot-1/bag/rosbag_0.mcap")
+        with open(path + ".sha256") as f:
+            self.assertEqual(f.read(), f'"{hashlib.sha256(b"rosbag_0.mcap").hexdigest()}"')
+        # The ETag does not make the bag look changed
+        self.assertEqual(os.path.getmtime(path + ".sha256"), os.path.getmtime(path))
+        self.assertEqual(pipeline.restore_etags(), 0)
+
+        # Uploaded again, the file is not final until processed
+        with open(path, "ab") as f:
+            f.write(b"more")
+        os.utime(path, (time.time() - 120,) * 2)
+        self.assertEqual(pipeline.discover(), 1)
+        self.assertFalse(os.path.exists(path + ".sha256"))
+        pipeline.run_once()
+        with open(path + ".sha256") as f:
+            self.assertEqual(f.read(), f'"{hashlib.sha256(b"rosbag_0.mcapmore").hexdigest()}"')
+
+        # Processed before the ETags were written
+        os.remove(path + ".sha256")
+        self.assertEqual(pipeline.restore_etags(), 1)
+        self.assertTrue(os.path.exists(path + ".sha256"))
+
+    def test_uploads_trigger_discovery(self):
+        self.make_bag("robot-1/old/bag")
+        stage = RecordingStage()
+        pipeline = Pipeline(
+            self.root, self.index, [stage], uploads=UploadWatch(self.root, self.index)
+        )
+        self.make_bag("robot-1/new/bag", age=0)
+        record_upload(self.root, self.index, os.path.join(self.root, "robot-1/new/bag/x.mcap"))
+
+        # Only the bag uploaded to is looked at, until it settles
+        with patch("bagstore.pipeline.iter_bags") as iter_bags:
+            pipeline.run_once(full=False)
+            self.assertEqual(stage.bags, [])
+            for name in ("metadata.yaml", "rosbag_0.mcap"):
+                os.utime(
+                    os.path.join(self.root, "robot-1/new/bag", name), (time.time() - 120,) * 2
+                )
+            pipeline.run_once(full=False)
+        iter_bags.assert_not_called()
+        self.assertEqual(stage.bags, ["robot-1/new/bag"])
+        self.assertEqual(pipeline.uploads.bags(), [])
+
+        # The storage is still walked from time to time
+        pipeline.run_once()
+        self.assertEqual(stage.bags, ["robot-1/new/bag", "robot-1/old/bag"])
+
+    def test_stale_etags_are_removed(self):
+        self.make_bag("robot-1/bag")
+        Pipeline(self.root, self.index, []).run_once()
+        bag_dir = os.path.join(self.root, "robot-1/bag")
+        self.assertEqual(remove_stale_etags(bag_dir), 0)
+
+        # Replaced by rsync, with the mtime of the device
+        path = os.path.join(bag_dir, "rosbag_0.mcap")
+        with open(path, "wb") as f:
+            f.write(b"new")
+        self.assertEqual(remove_stale_etags(os.path.join(self.root, "robot-1")), 1)
+        self.assertFalse(os.path.exists(path + ".sha256"))
+        self.assertTrue(os.path.exists(os.path.join(bag_dir, "metadata.yaml.sha256")))
+
+    @patch("bagstore.mcap.can_compress_chunks", return_value=True)
+    def test_recompression_makes_mcap_files_final(self, _):
+        self.make_bag("robot-1/bag")
+        pipeline = Pipeline(self.root, self.index, [], recompression=True)
+        pipeline.run_once()
+        path = os.path.join(self.root, "robot-1/bag/rosbag_0.mcap")
+        self.assertFalse(os.path.exists(path + ".sha256"))
+        self.assertTrue(
+            os.path.exists(os.path.join(self.root, "robot-1/bag/metadata.yaml.sha256"))
+        )
+        self.assertEqual(pipeline.restore_etags(), 0)
+
+        # Left as it is by the recompression
+        stat = os.stat(path)
+        self.index.record_recompression(
+            "robot-1/bag/rosbag_0.mcap", stat.st_size, stat.st_mtime, 0
+        )
+        self.assertEqual(pipeline.restore_etags(), 1)
+
+    def test_processed_bags_are_listed_by_page(self):
+        for path in ("robot-1/a", "robot-1/b", "robot-2/c"):
+            self.make_bag(path)
+        Pipeline(self.root, self.index, []).run_once()
+
+        page = self.index.list_bags(limit=2)
+        self.assertEqual([row["bag"] for row in page], ["robot-1/a", "robot-1/b"])
+        self.assertEqual((page[0]["files"], page[0]["size"], page[0]["corrupt"]), (2, 26, 0))
+        page = self.index.list_bags(after=page[-1]["bag"], limit=2)
+        self.assertEqual([row["bag"] for row in page], ["robot-2/c"])
+        self.assertEqual(
+            [row["bag"] for row in self.index.list_bags(uid="robot-2")], ["robot-2/c"]
+        )
+
+        self.assertEqual(
+            self.index.stats("robot-1"),
+            {
+                "devices": 1,
+                "bags": 2,
+                "files": 4,
+                "size": 52,
+                "corrupt-files": 0,
+                "pending-jobs": 0,
+                "failed-jobs": 0,
+                "recompression-saved": 0,
+            },
+        )
@@ -0,0 +1,256 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import os
+import struct
+import tempfile
+import time
+import unittest
+
+from bagstore.index import BagIndex
+from bagstore.mcap import CdrReader, McapStream
+from bagstore.pipeline import Pipeline
+from bagstore.preview_bags import PreviewBagStage, downsample_point_cloud, downscale_image
+from bagstore.previews import PreviewStage, thumbnail
+
+METADATA = """rosbag2_bagfile_information:
+  version: 5
+  duration:
+    nanoseconds: 10000000000
+  starting_time:
+    nanoseconds_since_epoch: 1690000000000000000
+  relative_file_paths:
+    - rosbag_0.mcap
+  topics_with_message_count:
+    - topic_metadata:
+        name: /camera/image_raw
+        type: sensor_msgs/msg/Image
+      message_count: 3
+"""
+
+START = 1690000000000000000
+MAGIC = b"\x89MCAP0\r\n"
+
+
+class CdrWriter:
+    def __init__(self):
+        self.data = bytearray(b"\x00\x01\x00\x00")
+
+    def _pack(self, fmt, size, *values):
+        self.data += b"\x00" * (-(len(self.data) - 4) % size)
+        self.data += struct.pack(fmt, *values)
+        return self
+
+    def uint32(self, value):
+        return self._pack("<I", 4, value)
+
+    def string(self, value):
+        encoded = value.encode() + b"\x00"
+        self.uint32(len(encoded))
+        self.data += encoded
+        return self
+
+    def header(self, frame_id="map"):
+        return self._pack("<iI", 4, 1, 0).string(frame_id)
+
+
+def image(width, height, value):
+    writer = CdrWriter().header("camera").uint32(height).uint32(width).string("rgb8")
+    writer._pack("<B", 1, 0).uint32(width * 3).uint32(width * height * 3)
+    writer.data += bytes((value, 0, 255 - value)) * width * height
+    return bytes(writer.data)
+
+
+def odometry(x, y):
+    writer = CdrWriter().header("odom").string("base_link")
+    return bytes(writer._pack("<3d", 8, x, y, 0.0).data)
+
+
+def point_cloud(points):
+    writer = CdrWriter().header("lidar").uint32(1).uint32(len(points)).uint32(3)
+    for i, name in enumerate("xyz"):
+        writer.string(name).uint32(i * 4)._pack("<B", 1, 7).uint32(1)
+    writer._pack("<B", 1, 0).uint32(16).uint32(16 * len(points)).uint32(16 * len(points))
+    for x, y, z in points:
+        writer.data += struct.pack("<3f4x", x, y, z)
+    return bytes(writer._pack("<B", 1, 1).data)
+
+
+def record(opcode, content):
+    return struct.pack("<BQ", opcode, len(content)) + content
+
+
+def string(value):
+    return struct.pack("<I", len(value)) + value.encode()
+
+
+def mcap_file(messages):
+    """Return a MCAP file of `(topic, type, log time, data)` messages, without summary."""
+    content = MAGIC + record(0x01, string("") + string("test"))
+    channels = {}
+    for topic, message_type, log_time, data in messages:
+        if topic not in channels:
+            channels[topic] = len(channels) + 1
+            content += record(
+                0x03,
+                struct.pack("<H", channels[topic])
+                + string(message_type)
+                + string("ros2msg")
+                + struct.pack("<I", 0),
+            )
+            content += record(
+                0x04,
+                struct.pack("<HH", channels[topic], channels[topic])
+                + string(topic)
+                + string("cdr")
+                + struct.pack("<I", 0),
+            )
+        content += record(
+            0x05, struct.pack("<HIQQ", channels[topic], 0, log_time, log_time) + data
+        )
+    content += record(0x0F, struct.pack("<I", 0))
+    footer = struct.pack("<BQQQI", 0x02, 20, 0, 0, 0)
+    return content + footer + MAGIC
+
+
+class TestMcapStream(unittest.TestCase):
+    def test_messages_across_buffers(self):
+        messages = [
+            ("/odom", "nav_msgs/msg/Odometry", START + i, odometry(i, 0)) for i in range(5)
+        ]
+        content = mcap_file(messages)
+        received = []
+        stream = McapStream(lambda channel, log_time, data: received.append(log_time))
+        for offset in range(0, len(content), 7):
+            stream.update(offset, memoryview(content)[offset : offset + 7])
+        stream.finish()
+
+        self.assertEqual(received, [START + i for i in range(5)])
+        [channel] = stream.channels.values()
+        self.assertEqual((channel.topic, channel.message_count), ("/odom", 5))
+
+    def test_cdr(self):
+        reader = CdrReader(odometry(1.5, -2.0))
+        self.assertEqual(reader.header(), "odom")
+        self.assertEqual(reader.string(), "base_link")
+        self.assertEqual(reader.float64(2), (1.5, -2.0))
+
+
+class TestPreviews(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        self.index = BagIndex(self.root)
+        self.addCleanup(self.index.close)
+        self.stage = PreviewStage(self.root, self.index)
+        self.pipeline = Pipeline(self.root, self.index, [self.stage], buffer_size=1 << 10)
+        self.previews = os.path.join(self.root, ".bagstore/previews")
+
+    def make_bag(self, path, content):
+        bag_dir = os.path.join(self.root, path)
+        os.makedirs(bag_dir)
+        for name, data in (("metadata.yaml", METADATA.encode()), ("rosbag_0.mcap", content)):
+            file_path = os.path.join(bag_dir, name)
+            with open(file_path, "wb") as f:
+                f.write(data)
+            os.utime(file_path, (time.time() - 120,) * 2)
+
+    def test_thumbnail_is_downscaled(self):
+        extension, png = thumbnail(image(640, 480, 10))
+        self.assertEqual(extension, "png")
+        self.assertEqual(struct.unpack(">II", png[16:24]), (160, 120))
+
+    def test_bag_preview(self):
+        messages = [
+            (
+                "/camera/image_raw",
+                "sensor_msgs/msg/Image",
+                START + i * 4_000_000_000,
+                image(8, 6, i),
+            )
+            for i in range(3)
+        ]
+        messages += [
+            ("/odom", "nav_msgs/msg/Odometry", START + i * 1_000_000_000, odometry(i, i * i))
+            for i in range(10)
+        ]
+        self.make_bag("robot-1/bag", mcap_file(messages))
+        self.pipeline.run_once()
+
+        [(bag, summary)] = self.index.previews()
+        self.assertEqual(bag, "robot-1/bag")
+        summary = json.loads(summary)
+        self.assertEqual(
+            summary["topics"]["/odom"], {"type": "nav_msgs/msg/Odometry", "count": 10, "rate": 1.0}
+        )
+        # The first frame from the middle of the bag
+        frame = summary["frames"]["/camera/image_raw"]
+        self.assertTrue(frame.endswith(".png"))
+        self.assertTrue(os.path.exists(os.path.join(self.previews, frame)))
+        with open(os.path.join(self.previews, summary["trajectory"])) as f:
+            self.assertIn("<polyline", f.read())
+        with open(os.path.join(self.previews, "index.html")) as f:
+            listing = f.read()
+        self.assertIn('href="../robot-1/bag/"', listing)
+        self.assertIn(f'src="{frame}"', listing)
+
+        # The listing follows moved bags
+        self.index.move("robot-1/bag", "robot-1/2023/07/22/bag")
+        self.pipeline.run_once()
+        with open(os.path.join(self.previews, "index.html")) as f:
+            self.assertIn('href="../robot-1/2023/07/22/bag/"', f.read())
+
+
+class TestPreviewBags(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        self.index = BagIndex(self.root)
+        self.addCleanup(self.index.close)
+        self.pipeline = Pipeline(self.root, self.index, [PreviewBagStage(rate=2.0)])
+
+    def test_image_is_downscaled(self):
+        reader = CdrReader(downscale_image(image(1280, 720, 10)))
+        reader.header()
+        self.assertEqual((reader.uint32(), reader.uint32(), reader.string()), (180, 320, "rgb8"))
+        reader.uint8()
+        self.assertEqual(reader.uint32(), 320 * 3)
+        self.assertEqual(bytes(reader.bytes()[:6]), bytes((10, 0, 245)) * 2)
+
+    def test_point_cloud_is_voxel_downsampled(self):
+        points = [(0.01 * i, 0.0, 1.0) for i in range(100)] + [(float("nan"), 0.0, 0.0)]
+        reader = CdrReader(downsample_point_cloud(point_cloud(points)))
+        reader.header()
+        # One point every 20 cm along 1 m
+        self.assertEqual((reader.uint32(), reader.uint32()), (1, 5))
+
+    def test_preview_bag(self):
+        messages = [
+            ("/points", "sensor_msgs/msg/PointCloud2", START + i * 100_000_000, point_cloud([]))
+            for i in range(20)
+        ]
+        messages.append(("/tf_static", "tf2_msgs/msg/TFMessage", START, b"\x00\x01\x00\x00"))
+        messages.append(("/tf_static", "tf2_msgs/msg/TFMessage", START + 1, b"\x00\x01\x00\x00"))
+        bag_dir = os.path.join(self.root, "robot-1/bag")
+        os.makedirs(bag_dir)
+        for name, data in (
+            ("metadata.yaml", METADATA.encode()),
+            ("rosbag_0.mcap", mcap_file(messages)),
+        ):
+            with open(os.path.join(bag_dir, name), "wb") as f:
+                f.write(data)
+            os.utime(os.path.join(bag_dir, name), (time.time() - 120,) * 2)
+
+        self.pipeline.run_once()
+        self.assertEqual(os.listdir(os.path.join(bag_dir, "preview")), ["rosbag_0.mcap"])
+        with open(os.path.join(bag_dir, "preview/rosbag_0.mcap"), "rb") as f:
+            content = f.read()
+        received = []
+        stream = McapStream(lambda channel, log_time, data: received.append(channel.topic))
+        stream.update(0, memoryview(content))
+        # 2 Hz over 2 s, and every static transform
+        self.assertEqual(received.count("/points"), 4)
+        self.assertEqual(received.count("/tf_static"), 2)
@@ -0,0 +1,166 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import hashlib
+import io
+import os
+import struct
+import tempfile
+import time
+import unittest
+import zlib
+from unittest.mock import patch
+
+from bagstore.index import BagIndex
+from bagstore.mcap import (
+    OP_ATTACHMENT,
+    Channel,
+    McapIndex,
+    McapWriter,
+    Schema,
+    _pack_string,
+    can_compress_chunks,
+)
+from bagstore.pipeline import BufferPool, Pipeline, scan_file
+from bagstore.recompress import ContentDigest, Recompressor
+from bagstore.timeindex import TimeIndexStage
+
+START = 1690034520000000000
+METADATA = """rosbag2_bagfile_information:
+  version: 5
+  relative_file_paths:
+    - rosbag_0.mcap
+"""
+
+
+def recording():
+    """Return a MCAP file recorded without compression, in small chunks."""
+    f = io.BytesIO()
+    writer = McapWriter(f, chunk_size=1000)
+    writer.compression = ""
+    odom = Channel(1, "/odom", Schema(1, "nav_msgs/msg/Odometry", "ros2msg"), "cdr")
+    writer.add_channel(Channel(2, "/silent", None, "cdr", {"offered_qos_profiles": ""}))
+    for i in range(1000):
+        writer.write_message(odom, START + i * 10**7, START + i * 10**7 + 1, bytes(200), i * 2)
+    calibration = b"fx: 525.0"
+    writer.write_record(
+        OP_ATTACHMENT,
+        struct.pack("<QQ", START, START)
+        + _pack_string("calibration.yaml")
+        + _pack_string("application/yaml")
+        + struct.pack("<Q", len(calibration))
+        + calibration
+        + struct.pack("<I", zlib.crc32(calibration)),
+    )
+    writer.finish()
+    return f.getvalue()
+
+
+def content_digest(path):
+    digest = ContentDigest()
+    with open(path, "rb", buffering=0) as f:
+        scan_file(f, [digest], BufferPool(2, 1 << 16))
+    return digest
+
+
+@unittest.skipUnless(can_compress_chunks(), "a zstd module is required")
+class TestRecompress(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        self.index = BagIndex(self.root)
+        self.addCleanup(self.index.close)
+
+        bag_dir = os.path.join(self.root, "robot-7", "bag")
+        os.makedirs(bag_dir)
+        for name, data in (("metadata.yaml", METADATA.encode()), ("rosbag_0.mcap", recording())):
+            with open(os.path.join(bag_dir, name), "wb") as f:
+                f.write(data)
+            os.utime(os.path.join(bag_dir, name), (time.time() - 120,) * 2)
+        self.path = os.path.join(bag_dir, "rosbag_0.mcap")
+        self.pipeline = Pipeline(
+            self.root, self.index, [TimeIndexStage(self.index)], recompression=True
+        )
+        self.pipeline.run_once()
+
+    def test_recompress(self):
+        size, mtime = os.path.getsize(self.path), os.path.getmtime(self.path)
+        original = content_digest(self.path)
+        recompressor = Recompressor(self.root, self.index, chunk_size=64 << 10, cpu_budget=0)
+        # Not final until the recompression is done with it
+        self.assertFalse(os.path.exists(self.path + ".sha256"))
+
+        rewritten, saved = recompressor.run_once()
+        self.assertEqual(rewritten, 1)
+        self.assertEqual(os.path.getsize(self.path), size - saved)
+        self.assertEqual(os.path.getmtime(self.path), mtime)
+        recompressed = content_digest(self.path)
+        self.assertEqual(recompressed.digest, original.digest)
+        self.assertEqual(recompressed.message_count, 1000)
+        self.assertEqual(os.listdir(recompressor.staging), [])
+        with open(self.path, "rb") as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+        with open(self.path + ".sha256") as f:
+            self.assertEqual(f.read(), f'"{sha256}"')
+
+        with open(self.path, "rb") as f:
+            mcap = McapIndex(f)
+        self.assertTrue(mcap.indexed)
+        self.assertEqual({chunk.compression for chunk in mcap.chunks}, {"zstd"})
+        self.assertLess(len(mcap.chunks), 10)
+        self.assertIn(2, mcap.channels)
+
+        # The index follows the new file, the pipeline has nothing to do
+        [chunk, *_] = self.index.find_chunks("robot-7", START, START + 10**9)
+        with open(self.path, "rb") as f:
+            f.seek(chunk["chunk_offset"])
+            self.assertEqual(f.read(1), b"\x06")
+        self.assertEqual(self.pipeline.discover(), 0)
+        self.assertEqual(self.index.stats()["recompression-saved"], saved)
+
+        self.assertEqual(recompressor.run_once(), (0, 0))
+
+    def test_small_savings_are_not_kept(self):
+        recompressor = Recompressor(self.root, self.index, cpu_budget=0, min_saving=0.99)
+        with open(self.path, "rb") as f:
+            content = f.read()
+
+        self.assertEqual(recompressor.run_once(), (0, 0))
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(recompressor.candidates(), [])
+        with open(self.path + ".sha256") as f:
+            self.assertEqual(f.read(), f'"{hashlib.sha256(content).hexdigest()}"')
+
+
+class TestWithoutZstd(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        self.index = BagIndex(self.root)
+        self.addCleanup(self.index.close)
+
+    def test_files_are_kept_as_they_are(self):
+        bag_dir = os.path.join(self.root, "robot-7", "bag")
+        os.makedirs(bag_dir)
+        for name, data in (("metadata.yaml", METADATA.encode()), ("rosbag_0.mcap", recording())):
+            with open(os.path.join(bag_dir, name), "wb") as f:
+                f.write(data)
+            os.utime(os.path.join(bag_dir, name), (time.time() - 120,) * 2)
+        path = os.path.join(bag_dir, "rosbag_0.mcap")
+
+        with patch("bagstore.mcap.can_compress_chunks", return_value=False):
+            # Final right away, the recompression cannot rewrite them
+            Pipeline(self.root, self.index, [], recompression=True).run_once()
+        self.assertTrue(os.path.exists(path + ".sha256"))
+
+        # Processed while the recompression could compress them
+        os.remove(path + ".sha256")
+        with patch("bagstore.recompress.can_compress_chunks", return_value=False):
+            recompressor = Recompressor(self.root, self.index, cpu_budget=0)
+            self.assertEqual(recompressor.candidates(), ["robot-7/bag/rosbag_0.mcap"])
+            self.assertEqual(recompressor.run_once(), (0, 0))
+        self.assertTrue(os.path.exists(path + ".sha256"))
+        self.assertEqual(recompressor.candidates(), [])
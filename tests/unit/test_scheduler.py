@@ -0,0 +1,163 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from bagstore.scheduler import (
+    ResourceScheduler,
+    Throttle,
+    decision_metrics,
+    decision_path,
+    read_decision,
+)
+
+CALM = "some avg10=0.00 avg60=0.00 avg300=0.00 total=0\n"
+STALLED = "some avg10=50.00 avg60=10.00 avg300=2.00 total=1000\n"
+
+
+class TestResourceScheduler(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = os.path.join(tmp_dir.name, "srv")
+        self.cgroup = os.path.join(tmp_dir.name, "cgroup")
+        os.makedirs(self.cgroup)
+        for resource in ("cpu", "memory", "io"):
+            self.write(f"{resource}.pressure", CALM)
+        self.write("memory.max", "1000\n")
+        self.write("memory.current", "100\n")
+        self.scheduler = ResourceScheduler(self.root, cgroup=self.cgroup)
+
+    def write(self, name, content):
+        with open(os.path.join(self.cgroup, name), "w") as f:
+            f.write(content)
+
+    def test_throttle_under_pressure(self):
+        self.assertEqual(self.scheduler.update()["level"], 1.0)
+
+        self.write("io.pressure", STALLED)
+        levels = [self.scheduler.update()["level"] for _ in range(6)]
+        self.assertEqual(levels, [0.5, 0.25, 0.125, 0.0625, 0.0, 0.0])
+        decision = read_decision(self.root)
+        self.assertEqual(decision["reasons"], ["io-pressure"])
+        self.assertEqual(decision["signals"]["io_pressure"], 0.5)
+        metrics = decision_metrics(decision)
+        self.assertIn("bagstore_scheduler_level 0.0\n", metrics)
+        self.assertIn('bagstore_scheduler_throttled{reason="io-pressure"} 1\n', metrics)
+        self.assertIn('bagstore_scheduler_throttled{reason="latency"} 0\n', metrics)
+        self.assertIn('bagstore_container_pressure_ratio{resource="io"} 0.5\n', metrics)
+        self.assertIn("bagstore_container_memory_limit_bytes 1000\n", metrics)
+
+        # The share is given back slowly
+        self.write("io.pressure", CALM)
+        levels = [self.scheduler.update()["level"] for _ in range(3)]
+        self.assertEqual(levels, [0.1, 0.2, 0.3])
+
+    def test_memory_usage(self):
+        self.write("memory.current", "950\n")
+        decision = self.scheduler.update()
+        self.assertEqual(decision["reasons"], ["memory-usage"])
+        self.assertEqual(decision["signals"]["memory_ratio"], 0.95)
+
+    def test_foreground_degradation(self):
+        signals = self.scheduler.sample()
+        for latency in (0.01, 0.02, 0.015):
+            self.assertEqual(self.scheduler.reasons({**signals, "latency": latency}), [])
+        # Slow, but within what is always tolerated
+        self.assertEqual(self.scheduler.reasons({**signals, "latency": 0.2}), [])
+        self.assertEqual(self.scheduler.reasons({**signals, "latency": 0.5}), ["latency"])
+
+        for throughput in (8e6, 10e6, 7e6):
+            self.assertEqual(
+                self.scheduler.reasons({**signals, "upload_throughput": throughput}), []
+            )
+        self.assertEqual(
+            self.scheduler.reasons({**signals, "upload_throughput": 4e6}), ["upload-throughput"]
+        )
+
+    def test_no_decision(self):
+        self.assertIsNone(read_decision(self.root))
+        self.assertEqual(decision_metrics(None), "")
+
+
+class TestThrottle(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        os.makedirs(os.path.dirname(decision_path(self.root)))
+
+    def decide(self, level, age=0):
+        with open(decision_path(self.root), "w") as f:
+            json.dump(
+                {"level": level, "reasons": [], "signals": {}, "updated": time.time() - age}, f
+            )
+
+    def test_level(self):
+        self.assertEqual(Throttle(self.root).level, 1.0)
+        self.decide(0.25)
+        self.assertEqual(Throttle(self.root).level, 0.25)
+        # The scheduler stopped
+        self.decide(0.25, age=120)
+        self.assertEqual(Throttle(self.root).level, 1.0)
+
+    @patch("bagstore.scheduler.time.sleep")
+    def test_rest(self, sleep):
+        self.decide(0.25)
+        throttle = Throttle(self.root)
+        throttle.rest(2.0)
+        sleep.assert_called_once_with(6.0)
+
+        sleep.reset_mock()
+        self.decide(1.0)
+        Throttle(self.root).rest(2.0)
+        sleep.assert_not_called()
+
+    def test_paused(self):
+        self.decide(0.0)
+        throttle = Throttle(self.root)
+
+        def resume(seconds):
+            self.decide(0.5)
+            throttle._read = 0.0
+
+        with patch("bagstore.scheduler.time.sleep", side_effect=resume) as sleep:
+            throttle.wait()
+        sleep.assert_called_once_with(1.0)
+        self.assertEqual(throttle.level, 0.5)
+
+    @patch("bagstore.scheduler.time.process_time", return_value=0.0)
+    def test_io_bound_reads(self, _):
+        clock = [1000.0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        def read(throttle, mib, seconds):
+            """Read `mib` MiB without using any CPU, a MiB every `seconds`."""
+            start = clock[0]
+            for _ in range(mib):
+                clock[0] += seconds
+                throttle.update(0, memoryview(bytes(1 << 20)))
+            return clock[0] - start
+
+        with patch("bagstore.scheduler.time.monotonic", side_effect=lambda: clock[0]):
+            with patch("bagstore.scheduler.time.sleep", side_effect=sleep):
+                throttle = Throttle(self.root)
+                # Unthrottled, the disk reads 10 MiB/s
+                self.assertAlmostEqual(read(throttle, 20, 0.1), 2.0)
+
+                # Pressure on the I/O: a quarter of the rate, whatever the CPU time
+                self.decide(0.25)
+                throttle._read = 0.0
+                self.assertAlmostEqual(read(throttle, 20, 0.1), 8.0, delta=0.5)
+
+                # A given rate, even at the full share
+                self.decide(1.0)
+                throttle = Throttle(self.root, io_rate=5 << 20)
+                self.assertAlmostEqual(read(throttle, 20, 0.1), 4.0, delta=0.5)
@@ -0,0 +1,210 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+from bagstore.catchup import CatchUp, progress_metrics, read_progress
+from bagstore.index import BagIndex
+from bagstore.mcap import Channel, McapIndex, McapStream, McapWriter, Schema
+from bagstore.pipeline import CorruptFile, Pipeline
+from bagstore.timeindex import ChunkQueryServer, TimeIndexStage, parse_time
+
+START = 1690034520000000000  # 2023-07-22T14:02:00Z
+SECOND = 1_000_000_000
+
+METADATA = """rosbag2_bagfile_information:
+  version: 5
+  relative_file_paths:
+    - rosbag_0.mcap
+"""
+
+
+def recording(finish=True):
+    """Return a MCAP file of 10 s of camera and odometry, in chunks of about 1 s."""
+    f = io.BytesIO()
+    writer = McapWriter(f, chunk_size=1000)
+    image = Channel(1, "/camera/image_raw", Schema(1, "sensor_msgs/msg/Image", "ros2msg"), "cdr")
+    odom = Channel(2, "/odom", Schema(2, "nav_msgs/msg/Odometry", "ros2msg"), "cdr")
+    for i in range(100):
+        log_time = START + i * SECOND // 10
+        writer.write_message(odom, log_time, log_time, bytes(90))
+        if i % 10 == 0:
+            writer.write_message(image, log_time, log_time, bytes(90))
+    if finish:
+        writer.finish()
+    else:
+        writer._flush_chunk()
+    return f.getvalue()
+
+
+class TestTimeIndex(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        self.index = BagIndex(self.root)
+        self.addCleanup(self.index.close)
+        self.pipeline = Pipeline(self.root, self.index, [TimeIndexStage(self.index)])
+
+    def make_bag(self, path, content):
+        bag_dir = os.path.join(self.root, path)
+        os.makedirs(bag_dir)
+        for name, data in (("metadata.yaml", METADATA.encode()), ("rosbag_0.mcap", content)):
+            with open(os.path.join(bag_dir, name), "wb") as f:
+                f.write(data)
+            os.utime(os.path.join(bag_dir, name), (time.time() - 120,) * 2)
+
+    def read_index(self, content):
+        with tempfile.TemporaryFile() as f:
+            f.write(content)
+            f.flush()
+            return McapIndex(f)
+
+    def test_chunks_from_summary_or_data(self):
+        summary = self.read_index(recording())
+        data = self.read_index(recording(finish=False))
+        self.assertTrue(summary.indexed)
+        self.assertFalse(data.indexed)
+        self.assertGreater(len(summary.chunks), 5)
+        self.assertEqual(
+            [(c.start, c.end, c.offset, c.length, c.channels) for c in summary.chunks],
+            [(c.start, c.end, c.offset, c.length, c.channels) for c in data.chunks],
+        )
+        self.assertEqual(summary.channels[2].topic, "/odom")
+
+        # Chunks are skipped over, not read
+        content = bytearray(recording(finish=False))
+        for chunk in data.chunks:
+            content[chunk.offset + 60 : chunk.offset + chunk.length] = bytes(chunk.length - 60)
+        self.assertEqual(len(self.read_index(bytes(content)).chunks), len(data.chunks))
+        with self.assertRaises(CorruptFile):
+            self.read_index(METADATA.encode())
+
+    def test_lookup(self):
+        self.make_bag("robot-7/bag", recording())
+        self.make_bag("robot-8/bag", recording(finish=False))
+        self.pipeline.run_once()
+
+        chunks = self.index.find_chunks("robot-7", START + 3 * SECOND, START + 4 * SECOND)
+        self.assertTrue(chunks)
+        for chunk in chunks:
+            self.assertEqual(chunk["path"], "robot-7/bag/rosbag_0.mcap")
+            self.assertLessEqual(chunk["start_time"], START + 4 * SECOND)
+            self.assertGreaterEqual(chunk["end_time"], START + 3 * SECOND)
+        odom = self.index.find_chunks("robot-7", START, START + 10 * SECOND, "/odom")
+        self.assertEqual({chunk["topic"] for chunk in odom}, {"/odom"})
+        camera = self.index.find_chunks("robot-8", START, START + 10 * SECOND, "/camera/*")
+        self.assertEqual({chunk["topic"] for chunk in camera}, {"/camera/image_raw"})
+        self.assertEqual(self.index.find_chunks("robot-9", START, START + SECOND), [])
+        self.assertEqual(
+            [row["bag"] for row in self.index.find_bags("/camera/*", since=START + SECOND)],
+            ["robot-7/bag", "robot-8/bag"],
+        )
+        self.assertEqual(
+            [row["bag"] for row in self.index.find_bags("/odom", after="robot-7/bag")],
+            ["robot-8/bag"],
+        )
+
+        # Lookups follow moved bags
+        self.index.move("robot-7/bag", "robot-7/2023/07/22/bag")
+        [chunk, *_] = self.index.find_chunks("robot-7", START, START + SECOND)
+        self.assertEqual(chunk["path"], "robot-7/2023/07/22/bag/rosbag_0.mcap")
+
+    def test_http_lookup(self):
+        self.make_bag("robot-7/bag", recording())
+        self.pipeline.run_once()
+        server = ChunkQueryServer(("127.0.0.1", 0), self.index)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_address[1]}/_index/chunks"
+
+        query = "?uid=robot-7&topic=/camera/*&start=2023-07-22T14:02:03Z&end=2023-07-22T14:02:05"
+        with urllib.request.urlopen(url + query) as response:
+            chunks = json.load(response)["chunks"]
+        self.assertTrue(chunks)
+        self.assertEqual(chunks[0]["url"], "/robot-7/bag/rosbag_0.mcap")
+        self.assertEqual(chunks[0]["topics"], ["/camera/image_raw"])
+
+        # The byte range is the chunk record
+        with open(os.path.join(self.root, "robot-7/bag/rosbag_0.mcap"), "rb") as f:
+            f.seek(chunks[0]["offset"])
+            self.assertEqual(f.read(1), b"\x06")
+
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            urllib.request.urlopen(url + "?uid=robot-7&start=yesterday&end=0")
+        self.assertEqual(cm.exception.code, 400)
+
+    def test_http_extract(self):
+        self.make_bag("robot-7/bag", recording())
+        self.make_bag("robot-8/bag", recording(finish=False))
+        server = ChunkQueryServer(("127.0.0.1", 0), self.index)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_address[1]}/_index/extract"
+
+        query = f"?start={START + 3 * SECOND}&end={START + 4 * SECOND}&topic=/odom"
+        with urllib.request.urlopen(url + "/robot-7/bag/rosbag_0.mcap" + query) as response:
+            content = response.read()
+        received = []
+        stream = McapStream(lambda channel, log_time, data: received.append(log_time))
+        stream.update(0, memoryview(content))
+        self.assertEqual(content[-8:], b"\x89MCAP0\r\n")
+        self.assertEqual(
+            {channel.topic for channel in stream.channels.values()}, {"/odom", "/camera/image_raw"}
+        )
+        # Whole chunks around the time range
+        self.assertIn(START + 3 * SECOND, received)
+        self.assertIn(START + 4 * SECOND, received)
+        self.assertLess(len(received), 40)
+
+        # Files without summary are extracted too
+        with urllib.request.urlopen(url + "/robot-8/bag/rosbag_0.mcap" + query) as response:
+            self.assertEqual(response.read()[-8:], b"\x89MCAP0\r\n")
+
+        for path, code in (("/robot-8/bag/metadata.yaml", 422), ("/.bagstore/index.db", 404)):
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                urllib.request.urlopen(url + path + query)
+            self.assertEqual(cm.exception.code, code)
+
+    def test_catch_up(self):
+        self.make_bag("robot-7/bag", recording())
+        self.make_bag("robot-8/bag", recording(finish=False))
+        # Processed before the time index was enabled
+        Pipeline(self.root, self.index, []).run_once()
+        self.assertEqual(self.index.find_chunks("robot-7", START, START + SECOND), [])
+
+        catch_up = CatchUp(self.root, self.index, processes=2, batch_size=1)
+        self.assertEqual(catch_up.pending(), ["robot-7/bag", "robot-8/bag"])
+        self.assertEqual(catch_up.run(), 2)
+        for uid in ("robot-7", "robot-8"):
+            self.assertTrue(self.index.find_chunks(uid, START, START + SECOND, "/odom"))
+        progress = read_progress(self.root)
+        self.assertEqual((progress["total"], progress["done"]), (2, 2))
+
+        server = ChunkQueryServer(
+            ("127.0.0.1", 0), self.index, metrics=lambda: progress_metrics(progress)
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_address[1]}/_index/metrics"
+        with urllib.request.urlopen(url) as response:
+            self.assertIn("bagstore_catch_up_bags_done 2\n", response.read().decode())
+
+        self.assertEqual(catch_up.pending(), [])
+        self.assertEqual(catch_up.run(), 0)
+
+    def test_parse_time(self):
+        self.assertEqual(parse_time(str(START)), START)
+        self.assertEqual(parse_time("2023-07-22T14:02:00Z"), START)
+        self.assertEqual(parse_time("2023-07-22T16:02:00.5+02:00"), START + SECOND // 2)
@@ -0,0 +1,231 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import base64
+import http.client
+import json
+import os
+import secrets
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+from bagstore.index import BagIndex
+from bagstore.upload import (
+    SIGNATURE_NAMESPACE,
+    DeviceAuthenticator,
+    UploadServer,
+    UploadStore,
+    signed_message,
+)
+
+
+@unittest.skipUnless(shutil.which("ssh-keygen"), "ssh-keygen is required")
+class TestUploadServer(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp = tmp_dir.name
+        self.root = os.path.join(self.tmp, "storage")
+        os.makedirs(self.root)
+
+        self.key = os.path.join(self.tmp, "id_ed25519")
+        subprocess.run(["ssh-keygen", "-q", "-t", "ed25519", "-N", "", "-f", self.key], check=True)
+        with open(self.key + ".pub") as f:
+            public_key = f.read().strip()
+        allowed_signers = os.path.join(self.tmp, "allowed_signers")
+        with open(allowed_signers, "w") as f:
+            f.write(f'robot-1 namespaces="{SIGNATURE_NAMESPACE}" {public_key}\n')
+
+        self.index = BagIndex(self.root)
+        self.addCleanup(self.index.close)
+        self.store = UploadStore(self.root, fsync_bytes=4, index=self.index)
+        self.server = UploadServer(
+            ("127.0.0.1", 0), self.store, DeviceAuthenticator(allowed_signers)
+        )
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def authorization(self, method, resource, uid="robot-1"):
+        created, nonce = int(time.time()), secrets.token_hex(16)
+        signature = subprocess.run(
+            ["ssh-keygen", "-Y", "sign", "-f", self.key, "-n", SIGNATURE_NAMESPACE],
+            input=signed_message(uid, created, nonce, method, resource),
+            capture_output=True,
+            check=True,
+        ).stdout
+        encoded = base64.b64encode(signature).decode()
+        return f'Signature uid="{uid}",created="{created}",nonce="{nonce}",signature="{encoded}"'
+
+    def request(self, method, path, headers=None, body=None):
+        connection = http.client.HTTPConnection(*self.server.server_address)
+        self.addCleanup(connection.close)
+        connection.request(method, path, body=body, headers={"Tus-Resumable": "1.0.0", **headers})
+        response = connection.getresponse()
+        response.read()
+        return response
+
+    def create(self, filename, length, authorization=None, **headers):
+        metadata = "filename " + base64.b64encode(filename.encode()).decode()
+        if authorization is None:
+            authorization = self.authorization("POST", filename)
+        return self.request(
+            "POST",
+            "/upload/",
+            {
+                "Authorization": authorization,
+                "Upload-Length": str(length),
+                "Upload-Metadata": metadata,
+                "X-Forwarded-Prefix": "/testmodel-ros2bag-fileserver",
+                **headers,
+            },
+        )
+
+    def patch(self, location, offset, data, authorization=None, **headers):
+        if authorization is None:
+            authorization = self.authorization("PATCH", location.rsplit("/", 1)[1])
+        return self.request(
+            "PATCH",
+            location,
+            {
+                "Authorization": authorization,
+                "Upload-Offset": str(offset),
+                "Content-Type": "application/offset+octet-stream",
+                **headers,
+            },
+            data,
+        )
+
+    def head(self, location):
+        authorization = self.authorization("HEAD", location.rsplit("/", 1)[1])
+        return self.request("HEAD", location, {"Authorization": authorization})
+
+    def test_resumable_upload(self):
+        # Uploaded again over a processed file
+        destination = os.path.join(self.root, "robot-1", "rosbag2", "rosbag_0.mcap")
+        os.makedirs(os.path.dirname(destination))
+        for path in (destination, destination + ".sha256"):
+            with open(path, "w") as f:
+                f.write("old")
+
+        response = self.create("rosbag2/rosbag_0.mcap", 10)
+        self.assertEqual(response.status, 201)
+        location = response.getheader("Location")
+        self.assertTrue(location.startswith("/testmodel-ros2bag-fileserver/upload/"))
+        path = location[len("/testmodel-ros2bag-fileserver") :]
+
+        response = self.patch(path, 0, b"01234")
+        self.assertEqual(response.status, 204)
+        self.assertEqual(response.getheader("Upload-Offset"), "5")
+
+        # Chunks must follow each other
+        self.assertEqual(self.patch(path, 3, b"34567").status, 409)
+
+        response = self.head(path)
+        self.assertEqual(response.getheader("Upload-Offset"), "5")
+
+        self.assertEqual(self.patch(path, 5, b"56789").status, 204)
+        with open(destination, "rb") as f:
+            self.assertEqual(f.read(), b"0123456789")
+        self.assertFalse(os.path.exists(destination + ".sha256"))
+        self.assertEqual(os.listdir(self.store.staging), [])
+        # For the background workers to find the bag
+        self.assertEqual(self.index.uploads(), [(1, "robot-1/rosbag2")])
+
+    def test_upload_resumes_from_synced_data_after_restart(self):
+        location = self.create("rosbag_0.mcap", 10).getheader("Location")
+        path = location[len("/testmodel-ros2bag-fileserver") :]
+        # Only the first fsync batch of 4 bytes is durable
+        self.patch(path, 0, b"0123")
+        self.patch(path, 4, b"45")
+
+        self.server.store = UploadStore(self.root, fsync_bytes=4)
+
+        response = self.head(path)
+        self.assertEqual(response.getheader("Upload-Offset"), "4")
+        self.assertEqual(self.patch(path, 4, b"456789").status, 204)
+        with open(os.path.join(self.root, "robot-1", "rosbag_0.mcap"), "rb") as f:
+            self.assertEqual(f.read(), b"0123456789")
+
+    def test_preallocated_upload(self):
+        self.server.store = UploadStore(self.root, fsync_bytes=4, preallocate=True)
+        location = self.create("rosbag_0.mcap", 10).getheader("Location")
+        path = location[len("/testmodel-ros2bag-fileserver") :]
+        self.patch(path, 0, b"0123")
+        self.patch(path, 4, b"45")
+        [data_path] = [p for p in os.listdir(self.store.staging) if p.endswith(".part")]
+        self.assertEqual(os.path.getsize(os.path.join(self.store.staging, data_path)), 10)
+
+        # Resumed in place, the file keeps its space
+        self.server.store = UploadStore(self.root, fsync_bytes=4)
+        response = self.head(path)
+        self.assertEqual(response.getheader("Upload-Offset"), "4")
+        self.assertEqual(os.path.getsize(os.path.join(self.store.staging, data_path)), 10)
+        self.assertEqual(self.patch(path, 4, b"456789").status, 204)
+        with open(os.path.join(self.root, "robot-1", "rosbag_0.mcap"), "rb") as f:
+            self.assertEqual(f.read(), b"0123456789")
+
+    def test_segmented_upload(self):
+        response = self.create("rosbag_0.mcap", 10, **{"Upload-Segments": "3"})
+        self.assertEqual(response.status, 201)
+        self.assertEqual(response.getheader("Upload-Segment-Size"), "4")
+        path = response.getheader("Location")[len("/testmodel-ros2bag-fileserver") :]
+
+        # Segments are sent in any order, each one in order
+        segment = {"Upload-Segment": "2"}
+        self.assertEqual(self.patch(path, 8, b"89", **segment).status, 204)
+        segment = {"Upload-Segment": "1"}
+        self.assertEqual(self.patch(path, 4, b"456", **segment).status, 204)
+        self.assertEqual(self.patch(path, 7, b"7x", **segment).status, 413)
+
+        response = self.head(path)
+        self.assertEqual(response.getheader("Upload-Offset"), "0")
+        self.assertEqual(response.getheader("Upload-Segment-Offsets"), "0,7,10")
+
+        self.assertEqual(self.patch(path, 7, b"7", **segment).status, 204)
+        self.assertEqual(self.patch(path, 0, b"0123").status, 204)
+        with open(os.path.join(self.root, "robot-1", "rosbag_0.mcap"), "rb") as f:
+            self.assertEqual(f.read(), b"0123456789")
+
+        connection = http.client.HTTPConnection(*self.server.server_address)
+        self.addCleanup(connection.close)
+        connection.request(
+            "GET",
+            "/upload/stats",
+            headers={
+                "Tus-Resumable": "1.0.0",
+                "Authorization": self.authorization("GET", "stats"),
+            },
+        )
+        stats = json.loads(connection.getresponse().read())
+        self.assertEqual(stats["robot-1"]["bytes"], 10)
+
+    def test_unauthenticated_requests_are_rejected(self):
+        self.assertEqual(self.create("rosbag_0.mcap", 1, authorization="").status, 401)
+        # Signed by robot-1 but claimed by robot-2
+        authorization = self.authorization("POST", "rosbag_0.mcap")
+        forged = authorization.replace('uid="robot-1"', 'uid="robot-2"')
+        self.assertEqual(self.create("rosbag_0.mcap", 1, authorization=forged).status, 401)
+
+    def test_signatures_are_bound_to_one_request(self):
+        location = self.create("rosbag_0.mcap", 10).getheader("Location")
+        path = location[len("/testmodel-ros2bag-fileserver") :]
+        authorization = self.authorization("PATCH", path.rsplit("/", 1)[1])
+        self.assertEqual(self.patch(path, 0, b"01234", authorization=authorization).status, 204)
+
+        # Replayed, or used for another request
+        self.assertEqual(self.patch(path, 5, b"56789", authorization=authorization).status, 401)
+        authorization = self.authorization("HEAD", path.rsplit("/", 1)[1])
+        self.assertEqual(self.patch(path, 5, b"56789", authorization=authorization).status, 401)
+        authorization = self.authorization("POST", "rosbag_1.mcap")
+        self.assertEqual(self.create("rosbag_2.mcap", 1, authorization=authorization).status, 401)
+        self.assertEqual(self.patch(path, 5, b"56789").status, 204)
+
+    def test_filename_outside_device_directory_is_rejected(self):
+        self.assertEqual(self.create("../robot-2/rosbag_0.mcap", 1).status, 400)
+        self.assertEqual(self.create(".bagstore/redirects.json", 1).status, 400)
@@ -0,0 +1,90 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# Download throughput of uploaded bags, run it with `tox -e benchmark`.
+#
+# Several devices upload at once, by small requests, to a directory of
+# UPLOAD_BENCHMARK_DIR, with and without preallocation. The files are then
+# dropped from the page cache and read back sequentially, as a download
+# would. Point UPLOAD_BENCHMARK_DIR at the storage volume to measure: a tmpfs
+# does not fragment.
+
+import io
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from bagstore.upload import UploadStore
+
+BENCHMARK_DIR = os.environ.get("UPLOAD_BENCHMARK_DIR")
+
+DEVICES = 4
+FILE_SIZE = int(os.environ.get("UPLOAD_BENCHMARK_MIB", "256")) << 20
+# A PATCH request of a device on a slow link
+REQUEST_SIZE = 256 << 10
+READ_SIZE = 1 << 20
+
+
+def _extents(path):
+    """Return the number of extents of a file, None if unknown."""
+    if not shutil.which("filefrag"):
+        return None
+    result = subprocess.run(["filefrag", path], capture_output=True, text=True)
+    match = re.search(r"(\d+) extents? found", result.stdout)
+    return int(match.group(1)) if match else None
+
+
+def _read_throughput(path):
+    """Return the throughput in MiB/s of reading a file from the disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        buffer = bytearray(READ_SIZE)
+        size = 0
+        start = time.perf_counter()
+        with open(fd, "rb", buffering=0, closefd=False) as f:
+            while read := f.readinto(buffer):
+                size += read
+        return size / (1 << 20) / (time.perf_counter() - start)
+    finally:
+        os.close(fd)
+
+
+@unittest.skipUnless(BENCHMARK_DIR, "set UPLOAD_BENCHMARK_DIR to run the benchmark")
+class TestUploadBenchmark(unittest.TestCase):
+    def upload_concurrently(self, root, preallocate):
+        """Upload the files of every device at once, request by request."""
+        store = UploadStore(root, preallocate=preallocate)
+        uploads = [
+            store.create(f"robot-{i}", "bag/rosbag_0.mcap", FILE_SIZE) for i in range(DEVICES)
+        ]
+        data = os.urandom(REQUEST_SIZE)
+        start = time.perf_counter()
+        for offset in range(0, FILE_SIZE, REQUEST_SIZE):
+            for upload in uploads:
+                store.write(upload, 0, offset, io.BytesIO(data), REQUEST_SIZE)
+        seconds = time.perf_counter() - start
+        return DEVICES * FILE_SIZE / (1 << 20) / seconds
+
+    def test_download_throughput(self):
+        os.makedirs(BENCHMARK_DIR, exist_ok=True)
+        print(f"\n{'mode':<14} {'write MiB/s':>12} {'read MiB/s':>11} {'extents':>8}")
+        for preallocate in (False, True):
+            with tempfile.TemporaryDirectory(dir=BENCHMARK_DIR) as root:
+                write = self.upload_concurrently(root, preallocate)
+                paths = [
+                    os.path.join(root, f"robot-{i}", "bag/rosbag_0.mcap") for i in range(DEVICES)
+                ]
+                read = sum(_read_throughput(path) for path in paths) / DEVICES
+                extents = [_extents(path) for path in paths]
+                for path in paths:
+                    self.assertEqual(os.path.getsize(path), FILE_SIZE)
+
+            mode = "preallocated" if preallocate else "appended"
+            average = "-" if None in extents else sum(extents) // DEVICES
+            print(f"{mode:<14} {write:>12.1f} {read:>11.1f} {average:>8}")
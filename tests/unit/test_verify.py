@@ -0,0 +1,141 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import os
+import sqlite3
+import struct
+import tempfile
+import time
+import unittest
+import zlib
+
+from bagstore.index import BagIndex
+from bagstore.pipeline import Pipeline
+from bagstore.verify import VerifyStage
+
+METADATA = """rosbag2_bagfile_information:
+  version: 5
+  relative_file_paths:
+    - rosbag_0.{suffix}
+  starting_time:
+    nanoseconds_since_epoch: 1690000000000000000
+"""
+
+MAGIC = b"\x89MCAP0\r\n"
+
+
+def mcap_file() -> bytes:
+    """Return a minimal MCAP file, with data and summary CRCs."""
+    profile, library = b"", b"test"
+    header = struct.pack(f"<I{len(profile)}sI{len(library)}s", 0, profile, 4, library)
+    data = MAGIC + struct.pack("<BQ", 0x01, len(header)) + header
+    data_end = struct.pack("<BQI", 0x0F, 4, zlib.crc32(data))
+    footer = struct.pack("<BQQQ", 0x02, 20, 0, 0)
+    return data + data_end + footer + struct.pack("<I", zlib.crc32(footer)) + MAGIC
+
+
+class TestVerifier(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.root = tmp_dir.name
+        self.index = BagIndex(self.root)
+        self.addCleanup(self.index.close)
+        self.pipeline = Pipeline(self.root, self.index, [VerifyStage(self.root)])
+
+    def quarantined(self):
+        quarantine = os.path.join(self.root, ".bagstore/quarantine")
+        return sorted(
+            os.path.relpath(dirpath, quarantine)
+            for dirpath, _, filenames in os.walk(quarantine)
+            if "QUARANTINED" in filenames
+        )
+
+    def make_bag(self, path, files, suffix="mcap"):
+        bag_dir = os.path.join(self.root, path)
+        os.makedirs(bag_dir)
+        files = {"metadata.yaml": METADATA.format(suffix=suffix).encode(), **files}
+        for name, content in files.items():
+            file_path = os.path.join(bag_dir, name)
+            with open(file_path, "wb") as f:
+                f.write(content)
+            os.utime(file_path, (time.time() - 120,) * 2)
+        return bag_dir
+
+    def test_intact_bag_is_indexed_once(self):
+        self.make_bag("robot-1/bag", {"rosbag_0.mcap": mcap_file()})
+
+        self.pipeline.run_once()
+        self.assertEqual(self.quarantined(), [])
+        _, row = self.index.files()
+        self.assertEqual(row["path"], "robot-1/bag/rosbag_0.mcap")
+        self.assertEqual(row["status"], "ok")
+        self.assertEqual(len(row["sha256"]), 64)
+
+        # Nothing changed, nothing is read again
+        self.pipeline.run_once()
+        self.assertEqual(self.pipeline.discover(), 0)
+        self.assertEqual(list(self.index.files())[1]["verified"], row["verified"])
+
+    def test_truncated_bag_is_quarantined(self):
+        self.make_bag("robot-1/bag", {"rosbag_0.mcap": mcap_file()[:-5]})
+
+        self.pipeline.run_once()
+        self.assertEqual(self.quarantined(), ["robot-1/bag"])
+        self.assertFalse(os.path.exists(os.path.join(self.root, "robot-1/bag")))
+        # rsync uploads to the directory of the device
+        self.assertTrue(os.path.isdir(os.path.join(self.root, "robot-1")))
+        quarantined = os.path.join(self.root, ".bagstore/quarantine/robot-1/bag")
+        with open(os.path.join(quarantined, "QUARANTINED")) as f:
+            self.assertIn("truncated", f.read())
+        [row] = self.index.files("corrupt")
+        self.assertEqual(row["path"], "robot-1/bag/rosbag_0.mcap")
+
+    def test_corrupt_data_section_is_detected(self):
+        data = bytearray(mcap_file())
+        data[20] ^= 0xFF
+        self.make_bag("robot-1/bag", {"rosbag_0.mcap": bytes(data)})
+        self.pipeline.run_once()
+        self.assertEqual(self.quarantined(), ["robot-1/bag"])
+
+    def test_missing_bag_file_is_detected(self):
+        self.make_bag("robot-1/bag", {})
+        self.pipeline.run_once()
+        self.assertEqual(self.quarantined(), ["robot-1/bag"])
+
+    def test_sqlite_bag(self):
+        db_path = os.path.join(self.root, "db3")
+        db = sqlite3.connect(db_path)
+        db.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY, data BLOB)")
+        db.executemany("INSERT INTO messages (data) VALUES (?)", [(b"x" * 4000,)] * 10)
+        db.commit()
+        db.close()
+        with open(db_path, "rb") as f:
+            content = f.read()
+
+        # Characters that mean something in a SQLite URI
+        self.make_bag("robot-1/intact?#%", {"rosbag_0.db3": content}, suffix="db3")
+        self.make_bag("robot-2/truncated", {"rosbag_0.db3": content[:-4096]}, suffix="db3")
+
+        self.pipeline.run_once()
+        self.assertEqual(self.quarantined(), ["robot-2/truncated"])
+        self.assertEqual(
+            {r["bag"] for r in self.index.files("ok")},
+            {"robot-1/intact?#%", "robot-2/truncated"},
+        )
+        self.assertEqual([r["bag"] for r in self.index.files("corrupt")], ["robot-2/truncated"])
+        # Opened where it is, not at the path the URI would cut it at
+        self.assertEqual(os.listdir(os.path.join(self.root, "robot-1")), ["intact?#%"])
+
+    def test_index_follows_moved_bags(self):
+        self.make_bag("robot-1/bag", {"rosbag_0.mcap": mcap_file()})
+        self.pipeline.run_once()
+
+        self.index.move("robot-1/bag", "robot-1/2023/07/22/bag")
+        self.assertEqual(
+            [(row["path"], row["bag"]) for row in self.index.files()],
+            [
+                ("robot-1/2023/07/22/bag/metadata.yaml", "robot-1/2023/07/22/bag"),
+                ("robot-1/2023/07/22/bag/rosbag_0.mcap", "robot-1/2023/07/22/bag"),
+            ],
+        )